@@ -0,0 +1,50 @@
+# Copyright 2026 Twixes
+
+# This file is part of Somsiad - the Polish Discord bot.
+
+# Somsiad is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# Somsiad is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Somsiad.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""A separate ClickHouse database for benchmarks, so that they don't touch the bot's tables.
+
+Requires the usual environment (.env) and a reachable ClickHouse, whose user may create databases.
+"""
+
+import contextlib
+from typing import AsyncIterator, Optional, Tuple
+
+import aiochclient
+import aiohttp
+
+from configuration import configuration
+
+BENCHMARK_DATABASE = 'somsiad_benchmark'
+
+
+def create_client(session: aiohttp.ClientSession, database: Optional[str] = None) -> aiochclient.ChClient:
+    kwargs = {'database': database} if database is not None else {}
+    return aiochclient.ChClient(
+        session,
+        url=configuration['clickhouse_url'],
+        user=configuration['clickhouse_user'],
+        password=configuration['clickhouse_password'],
+        **kwargs,
+    )
+
+
+@contextlib.asynccontextmanager
+async def benchmark_database() -> AsyncIterator[Tuple[aiohttp.ClientSession, aiochclient.ChClient]]:
+    """Create `BENCHMARK_DATABASE`, yielding a session and a client using the database, which is dropped afterwards."""
+    async with aiohttp.ClientSession() as session:
+        admin_client = create_client(session)
+        await admin_client.execute(f'CREATE DATABASE IF NOT EXISTS {BENCHMARK_DATABASE}')
+        try:
+            yield session, create_client(session, BENCHMARK_DATABASE)
+        finally:
+            await admin_client.execute(f'DROP DATABASE {BENCHMARK_DATABASE}')
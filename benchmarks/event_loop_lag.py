@@ -0,0 +1,87 @@
+# Copyright 2026 Twixes
+
+# This file is part of Somsiad - the Polish Discord bot.
+
+# Somsiad is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# Somsiad is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Somsiad.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Event loop lag under database load: synchronous `data.session` vs `data.async_session`.
+
+Simulates the per-command/per-message opt-out lookup done by listeners, with `CONCURRENCY` workers hammering
+Postgres while a ticker measures how late the loop wakes it up. Requires the usual environment (.env) and a reachable
+DATABASE_URL. Run from the repository root: `python -m benchmarks.event_loop_lag`.
+"""
+
+import asyncio
+import random
+import statistics
+import time
+from typing import List
+
+from sqlalchemy import select
+
+import data
+from core import DataProcessingOptOut
+
+DURATION_SECONDS = 10.0
+TICK_INTERVAL_SECONDS = 0.01
+CONCURRENCY = 32
+
+
+async def measure_lag(duration: float) -> List[float]:
+    lags = []
+    deadline = time.perf_counter() + duration
+    while time.perf_counter() < deadline:
+        expected = time.perf_counter() + TICK_INTERVAL_SECONDS
+        await asyncio.sleep(TICK_INTERVAL_SECONDS)
+        lags.append(max(0.0, time.perf_counter() - expected))
+    return lags
+
+
+async def sync_worker(deadline: float) -> int:
+    queries = 0
+    while time.perf_counter() < deadline:
+        with data.session() as session:
+            session.query(DataProcessingOptOut).get(random.getrandbits(62))
+        queries += 1
+        await asyncio.sleep(0)
+    return queries
+
+
+async def async_worker(deadline: float) -> int:
+    queries = 0
+    while time.perf_counter() < deadline:
+        async with data.async_session() as session:
+            await session.execute(select(DataProcessingOptOut).filter_by(user_id=random.getrandbits(62)))
+        queries += 1
+    return queries
+
+
+async def run_scenario(name: str, worker) -> None:
+    deadline = time.perf_counter() + DURATION_SECONDS
+    lags, *query_counts = await asyncio.gather(
+        measure_lag(DURATION_SECONDS), *(worker(deadline) for _ in range(CONCURRENCY))
+    )
+    lags_ms = sorted(lag * 1000 for lag in lags)
+    print(
+        f'{name:>6}: {sum(query_counts) / DURATION_SECONDS:>8.1f} queries/s | loop lag '
+        f'p50 {statistics.median(lags_ms):>7.2f} ms, p99 {lags_ms[int(len(lags_ms) * 0.99)]:>7.2f} ms, '
+        f'max {lags_ms[-1]:>7.2f} ms ({len(lags_ms)} ticks, expected {DURATION_SECONDS / TICK_INTERVAL_SECONDS:.0f})'
+    )
+
+
+async def main():
+    data.create_all_tables()
+    await run_scenario('sync', sync_worker)
+    await run_scenario('async', async_worker)
+    await data.async_engine.dispose()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+# Copyright 2026 Twixes
+
+# This file is part of Somsiad - the Polish Discord bot.
+
+# Somsiad is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# Somsiad is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Somsiad.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Import time of the bot with all plugins, broken down by top-level package, based on `python -X importtime`.
+
+Imports `run` and every module in `plugins/` in a fresh interpreter, the way startup does (minus connecting), so
+modules loaded lazily (see `utilities.LazyModule`) don't count. Requires the usual environment (.env), but no
+services. Run from the repository root: `python -m benchmarks.import_time [--top N] [--budget-ms MS]`. With a budget,
+exits with status 1 if the total exceeds it, so the script can guard against regressions.
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+from typing import DefaultDict, Dict
+
+IMPORTTIME_LINE_REGEX = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure() -> Dict[str, int]:
+    """Return self import time in microseconds per top-level package."""
+    plugins = sorted(path.name[:-3] for path in os.scandir('plugins') if path.is_file() and path.name.endswith('.py'))
+    code = '; '.join(['import run', *(f'import plugins.{plugin}' for plugin in plugins)])
+    process = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True
+    )
+    self_us_by_package: DefaultDict[str, int] = defaultdict(int)
+    for line in process.stderr.splitlines():
+        match = IMPORTTIME_LINE_REGEX.match(line)
+        if match is not None:
+            self_us, _, _, module_name = match.groups()
+            package = module_name if module_name.startswith('plugins.') else module_name.split('.')[0]
+            self_us_by_package[package] += int(self_us)
+    return self_us_by_package
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--top', type=int, default=25, help='number of packages to list')
+    parser.add_argument('--budget-ms', type=float, help='fail if the total import time exceeds this')
+    arguments = parser.parse_args()
+    self_us_by_package = measure()
+    total_ms = sum(self_us_by_package.values()) / 1000
+    for package, self_us in sorted(self_us_by_package.items(), key=lambda item: item[1], reverse=True)[
+        : arguments.top
+    ]:
+        print(f'{self_us / 1000:>9.1f} ms {self_us / 10 / total_ms:>5.1f}%  {package}')
+    print(f'{total_ms:>9.1f} ms total ({len(self_us_by_package)} packages)')
+    if arguments.budget_ms is not None and total_ms > arguments.budget_ms:
+        print(f'Over budget of {arguments.budget_ms:n} ms!')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
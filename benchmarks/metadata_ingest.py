@@ -0,0 +1,138 @@
+# Copyright 2026 Twixes
+
+# This file is part of Somsiad - the Polish Discord bot.
+
+# Somsiad is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# Somsiad is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Somsiad.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Message metadata ingest throughput: text `INSERT ... VALUES` of dataclass rows vs compressed Native column blocks.
+
+Encodes `ROW_COUNT` synthetic messages in batches of `BATCH_SIZE` both ways, first client-side only, then inserting
+them into `message_metadata_cache` in the benchmark database, reporting rows per second and request body size. Then
+crawls them again Native, which includes reading back the cached versions of the messages for reconciling with the
+rollup, as re-crawls do. Requires a reachable ClickHouse, like `benchmarks.clickhouse`.
+Run from the repository root: `python -m benchmarks.metadata_ingest`.
+"""
+
+import asyncio
+import dataclasses
+import datetime as dt
+import gzip
+import random
+import time
+import uuid
+from types import SimpleNamespace
+from typing import List, Sequence
+
+import aiochclient
+from aiochclient.types import rows2ch
+
+from benchmarks.clickhouse import benchmark_database
+from plugins.activity import MessageMetadata, MetadataCache
+
+ROW_COUNT = 1_000_000
+BATCH_SIZE = 10_000
+
+
+def generate_batches() -> List[List[MessageMetadata]]:
+    random.seed(0)
+    started_at = dt.datetime(2024, 1, 1)
+    batches = []
+    for batch_start in range(0, ROW_COUNT, BATCH_SIZE):
+        batches.append(
+            [
+                MessageMetadata(
+                    id=(i + 1) << 22,
+                    server_id=random.randint(1, 20),
+                    channel_id=random.randint(1000, 1080),
+                    user_id=random.randint(100_000, 102_000),
+                    word_count=random.randint(0, 30),
+                    character_count=random.randint(0, 200),
+                    created_at=started_at + dt.timedelta(seconds=i),
+                )
+                for i in range(batch_start, min(batch_start + BATCH_SIZE, ROW_COUNT))
+            ]
+        )
+    return batches
+
+
+def legacy_encode(metadata_batch: Sequence[MessageMetadata]) -> bytes:
+    return rows2ch(*map(dataclasses.astuple, metadata_batch))
+
+
+def native_encode(metadata_cache: MetadataCache, metadata_batch: Sequence[MessageMetadata]) -> bytes:
+    columns = metadata_cache.new_columns()
+    columns.extend(metadata_batch)
+    return gzip.compress(columns.encode_native(), compresslevel=1)
+
+
+async def legacy_insert(client: aiochclient.ChClient, metadata_batch: Sequence[MessageMetadata]):
+    await client.execute('INSERT INTO message_metadata_cache VALUES', *map(dataclasses.astuple, metadata_batch))
+
+
+async def native_insert(metadata_cache: MetadataCache, metadata_batch: Sequence[MessageMetadata]):
+    columns = metadata_cache.new_columns()
+    columns.extend(metadata_batch)
+    # Skip cursor bookkeeping in Redis, which isn't what's measured
+    await metadata_cache._post_insert(gzip.compress(columns.encode_native(), compresslevel=1), uuid.uuid4().hex)
+
+
+async def native_recrawl_insert(metadata_cache: MetadataCache, metadata_batch: Sequence[MessageMetadata]):
+    columns = metadata_cache.new_columns()
+    columns.extend(metadata_batch)
+    # Skip the rollup gate and cursor bookkeeping in Redis, which aren't what's measured
+    unchanged_ids = await metadata_cache._reconcile(columns, set(columns.arrays[0]))
+    await metadata_cache._insert_parts(columns.without(unchanged_ids))
+
+
+def print_result(name: str, duration: float, body_size: int = 0):
+    size_part = f', {body_size / ROW_COUNT:>5.1f} B/row' if body_size else ''
+    print(f'{name:>24}: {ROW_COUNT / duration:>12,.0f} rows/s{size_part}')
+
+
+async def main():
+    batches = generate_batches()
+    metadata_cache = MetadataCache(SimpleNamespace())
+
+    print('Encoding')
+    started_at = time.perf_counter()
+    body_size = sum(len(legacy_encode(batch)) for batch in batches)
+    print_result('text VALUES', time.perf_counter() - started_at, body_size)
+    started_at = time.perf_counter()
+    body_size = sum(len(native_encode(metadata_cache, batch)) for batch in batches)
+    print_result('Native, gzip', time.perf_counter() - started_at, body_size)
+    print()
+
+    async with benchmark_database() as (session, client):
+        metadata_cache = MetadataCache(SimpleNamespace(ch_client=client, session=session))
+        await client.execute('DROP TABLE IF EXISTS message_metadata_cache')
+        await metadata_cache.prepare()
+
+        print('Encoding and inserting')
+        started_at = time.perf_counter()
+        for batch in batches:
+            await legacy_insert(client, batch)
+        print_result('text VALUES', time.perf_counter() - started_at)
+        await client.execute('TRUNCATE TABLE message_metadata_cache')
+        started_at = time.perf_counter()
+        for batch in batches:
+            await native_insert(metadata_cache, batch)
+        print_result('Native, gzip', time.perf_counter() - started_at)
+        inserted_count = await client.fetchval('SELECT count() FROM message_metadata_cache')
+        assert inserted_count == ROW_COUNT, f'{inserted_count:,} rows inserted instead of {ROW_COUNT:,}'
+        started_at = time.perf_counter()
+        for batch in batches:
+            await native_recrawl_insert(metadata_cache, batch)
+        print_result('Native, gzip, re-crawl', time.perf_counter() - started_at)
+        inserted_count = await client.fetchval('SELECT count() FROM message_metadata_cache')
+        assert inserted_count == ROW_COUNT, f'{inserted_count - ROW_COUNT:,} unchanged rows inserted again'
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,114 @@
+# Copyright 2026 Twixes
+
+# This file is part of Somsiad - the Polish Discord bot.
+
+# Somsiad is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# Somsiad is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Somsiad.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Messages per second through command prefix resolution: per-message list building vs precompiled matchers.
+
+Both variants are fed the same mix of messages (mostly ordinary chatter, some commands, some DMs) across
+`SERVER_COUNT` servers with custom prefixes, then the prefix is picked the way `discord.ext.commands` does it. Prefixes
+are preloaded, so no database is needed. Run from the repository root: `python -m benchmarks.prefix_resolution`.
+"""
+
+import asyncio
+import random
+import time
+from types import SimpleNamespace
+from typing import Callable, List, Optional
+
+from configuration import configuration
+from somsiad import Somsiad
+
+MESSAGE_COUNT = 200_000
+SERVER_COUNT = 1000
+COMMAND_SHARE = 0.05
+DM_SHARE = 0.02
+COMMAND_CONTENTS = ('help', 'prefix', '8ball czy to szybkie?', 'wiki Polska')
+CHAT_CONTENTS = ('hej', 'co tam?', 'xD', 'Ktoś na CS-a wieczorem?', 'https://example.com/obrazek.png')
+PREFIX_SAFE_ALIASES = tuple(
+    variant
+    for alias in ('prefix', 'prefiks', 'help', 'pomocy', 'pomoc')
+    for variant in (configuration['command_prefix'] + ' ' + alias, configuration['command_prefix'] + alias)
+)
+
+
+class FakeUser:
+    id = 708244475520172093
+
+    def __str__(self):
+        return 'Somsiad#0000'
+
+
+def legacy_get_prefix(bot: Somsiad, message) -> List[str]:
+    """Prefix resolution as it was before precompiled matchers."""
+    if message.guild is not None:
+        prefixes = [f'<@!{bot.user.id}> ', f'<@{bot.user.id}> ', f'{bot.user} ']
+        for extra_prefix in bot.prefixes.get(message.guild.id) or (configuration['command_prefix'],):
+            prefixes.append(extra_prefix + ' ')
+            prefixes.append(extra_prefix)
+    else:
+        prefixes = [configuration['command_prefix'] + ' ', configuration['command_prefix'], '']
+    if message.content.lower().startswith(PREFIX_SAFE_ALIASES) and configuration['command_prefix'] not in prefixes:
+        prefixes.append(configuration['command_prefix'] + ' ')
+        prefixes.append(configuration['command_prefix'])
+    prefixes.sort(key=len, reverse=True)
+    return prefixes
+
+
+def pick_prefix(prefixes: List[str], content: str) -> Optional[str]:
+    """The matching step of `commands.Bot.get_context`."""
+    if content.startswith(tuple(prefixes)):
+        return next(prefix for prefix in prefixes if content.startswith(prefix))
+    return None
+
+
+def generate_messages(bot: Somsiad) -> list:
+    rng = random.Random(2137)
+    servers = [SimpleNamespace(id=server_id) for server_id in range(1, SERVER_COUNT + 1)]
+    for server in servers:
+        custom_prefixes = rng.sample(('!', '?', '.', 'ss ', 'hej'), rng.randint(1, 3)) if rng.random() < 0.5 else ()
+        bot.set_prefixes(server.id, custom_prefixes)
+    messages = []
+    for _ in range(MESSAGE_COUNT):
+        server = None if rng.random() < DM_SHARE else rng.choice(servers)
+        if rng.random() < COMMAND_SHARE:
+            server_prefixes = bot.prefixes[server.id] if server is not None else ()
+            prefix = rng.choice((*server_prefixes, configuration['command_prefix']))
+            content = f'{prefix}{rng.choice(COMMAND_CONTENTS)}'
+        else:
+            content = rng.choice(CHAT_CONTENTS)
+        messages.append(SimpleNamespace(guild=server, content=content))
+    return messages
+
+
+async def run_scenario(name: str, messages: list, get_prefix: Callable) -> None:
+    started_at = time.perf_counter()
+    for message in messages:
+        prefixes = get_prefix(message)
+        if asyncio.iscoroutine(prefixes):
+            prefixes = await prefixes
+        pick_prefix(prefixes, message.content)
+    elapsed = time.perf_counter() - started_at
+    print(f'{name:>11}: {len(messages) / elapsed:>10.0f} messages/s')
+
+
+async def main():
+    bot = Somsiad()
+    bot._connection.user = FakeUser()
+    bot.prefix_safe_aliases = PREFIX_SAFE_ALIASES
+    bot._compile_prefix_safe_alias_regex()
+    messages = generate_messages(bot)
+    await run_scenario('legacy', messages, lambda message: legacy_get_prefix(bot, message))
+    await run_scenario('precompiled', messages, lambda message: bot._get_prefix(bot, message))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,159 @@
+# Copyright 2026 Twixes
+
+# This file is part of Somsiad - the Polish Discord bot.
+
+# Somsiad is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# Somsiad is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Somsiad.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Activity report query latency: eight parallel queries (over raw rows and over the rollup) vs a single-pass summary.
+
+Fills `message_metadata_cache` in the benchmark database with `ROW_COUNT` synthetic messages spread over
+`SERVER_COUNT` servers (half of them on the first one), rolls them up, then times server, member and last-30-days
+report queries for the first server. Requires a reachable ClickHouse, like `benchmarks.clickhouse`.
+Run from the repository root: `python -m benchmarks.report_query`.
+"""
+
+import asyncio
+import datetime as dt
+import statistics
+import time
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List
+
+import aiochclient
+
+from benchmarks.clickhouse import benchmark_database
+from plugins.activity import MetadataCache
+
+ROW_COUNT = 50_000_000
+SERVER_COUNT = 20
+CHANNELS_PER_SERVER = 80
+USERS_PER_SERVER = 2000
+HISTORY_DAYS = 3 * 365
+RUNS = 10
+
+LEGACY_SELECTS = (
+    'SELECT * FROM {table} WHERE {where} ORDER BY id ASC LIMIT 1',
+    'SELECT * FROM {table} WHERE {where} ORDER BY id DESC LIMIT 1',
+    'SELECT COUNT(*), SUM(word_count), SUM(character_count) FROM {table} WHERE {where}',
+    'SELECT COUNT(*) AS message_count, date FROM {table} WHERE {where} GROUP BY date ORDER BY date',
+    'SELECT COUNT(*) AS message_count, weekday FROM {table} WHERE {where} GROUP BY weekday ORDER BY weekday',
+    'SELECT COUNT(*) AS message_count, hour FROM {table} WHERE {where} GROUP BY hour ORDER BY hour',
+    'SELECT COUNT(*) AS message_count, SUM(word_count), SUM(character_count), user_id FROM {table} WHERE {where} '
+    'GROUP BY user_id ORDER BY message_count DESC',
+    'SELECT COUNT(*) AS message_count, SUM(word_count), SUM(character_count), channel_id FROM {table} WHERE {where} '
+    'GROUP BY channel_id ORDER BY message_count DESC',
+)
+ROLLUP_SELECTS = (
+    'SELECT min(first_message_id) FROM {table} WHERE {where}',
+    'SELECT max(last_message_id) FROM {table} WHERE {where}',
+    'SELECT sum(messages), sum(words), sum(characters) FROM {table} WHERE {where}',
+    'SELECT sum(messages), date FROM {table} WHERE {where} GROUP BY date ORDER BY date',
+    'SELECT sum(messages), toDayOfWeek(date) - 1 AS weekday FROM {table} WHERE {where} '
+    'GROUP BY weekday ORDER BY weekday',
+    'SELECT sum(messages), hour FROM {table} WHERE {where} GROUP BY hour ORDER BY hour',
+    'SELECT sum(messages) AS message_count, sum(words), sum(characters), user_id FROM {table} WHERE {where} '
+    'GROUP BY user_id ORDER BY message_count DESC',
+    'SELECT sum(messages) AS message_count, sum(words), sum(characters), channel_id FROM {table} WHERE {where} '
+    'GROUP BY channel_id ORDER BY message_count DESC',
+)
+
+
+async def fill(client: aiochclient.ChClient, metadata_cache: MetadataCache):
+    await client.execute('DROP TABLE IF EXISTS message_metadata_cache')
+    await client.execute('DROP TABLE IF EXISTS message_activity_rollup')
+    await metadata_cache.prepare()
+    print(f'Inserting {ROW_COUNT:,} synthetic messages…')
+    started_at = time.perf_counter()
+    await client.execute(
+        f'''
+        INSERT INTO message_metadata_cache (id, server_id, channel_id, user_id, word_count, character_count, created_at)
+        SELECT
+            number + 1,
+            if(number % 2 = 0, 1, 2 + number % {SERVER_COUNT - 1}),
+            cityHash64(number, 1) % {CHANNELS_PER_SERVER} + 1000,
+            cityHash64(number, 2) % {USERS_PER_SERVER} + 100000,
+            cityHash64(number, 3) % 30,
+            cityHash64(number, 4) % 200,
+            toDateTime64(now() - {HISTORY_DAYS * 86400}, 3) + intDiv(number * {HISTORY_DAYS * 86400}, {ROW_COUNT})
+        FROM numbers({ROW_COUNT})
+    '''
+    )
+    await client.execute(
+        f'''
+        INSERT INTO message_activity_rollup
+        {MetadataCache.ROLLUP_SELECT.format(source='message_metadata_cache')}
+        GROUP BY server_id, channel_id, user_id, date, hour
+    '''
+    )
+    await client.execute('OPTIMIZE TABLE message_activity_rollup FINAL')
+    rollup_row_count = await client.fetchval('SELECT count() FROM message_activity_rollup')
+    print(f'Filled in {time.perf_counter() - started_at:.1f} s, {rollup_row_count:,} rollup rows\n')
+
+
+async def time_runs(run: Callable[[], Awaitable[Any]]) -> List[float]:
+    await run()  # Warm up
+    durations = []
+    for _ in range(RUNS):
+        started_at = time.perf_counter()
+        await run()
+        durations.append(time.perf_counter() - started_at)
+    return durations
+
+
+async def run_scenario(client: aiochclient.ChClient, metadata_cache: MetadataCache, name: str, constraints: Dict):
+    print(name)
+    raw_constraints, raw_params = MetadataCache._build_constraints_and_params(**constraints)
+    raw_where = MetadataCache._build_where(raw_constraints, raw_params)
+    rollup_where, rollup_params = MetadataCache._build_rollup_where(**constraints)
+    variants = {
+        'eight raw queries': lambda: asyncio.gather(
+            *(
+                client.fetch(select.format(table='message_metadata_cache', where=raw_where), params=raw_params)
+                for select in LEGACY_SELECTS
+            )
+        ),
+        'eight rollup queries': lambda: asyncio.gather(
+            *(
+                client.fetch(select.format(table='message_activity_rollup', where=rollup_where), params=rollup_params)
+                for select in ROLLUP_SELECTS
+            )
+        ),
+        'single rollup pass': lambda: metadata_cache.fetch_activity_summary(**constraints),
+    }
+    for variant_name, run in variants.items():
+        durations = await time_runs(run)
+        print(
+            f'{variant_name:>22}: median {statistics.median(durations) * 1000:>8.1f} ms, '
+            f'max {max(durations) * 1000:>8.1f} ms'
+        )
+    print()
+
+
+async def main():
+    async with benchmark_database() as (_, client):
+        metadata_cache = MetadataCache(SimpleNamespace(ch_client=client))
+        await fill(client, metadata_cache)
+        metadata_cache.rollup_migrated = True  # Filled directly, without the view
+        channel_ids = list(range(1000, 1000 + CHANNELS_PER_SERVER))
+        today = dt.datetime.combine(dt.date.today(), dt.time())
+        await run_scenario(client, metadata_cache, 'Server report', {'server_id': 1, 'channel_id': channel_ids})
+        await run_scenario(
+            client, metadata_cache, 'Member report', {'server_id': 1, 'channel_id': channel_ids, 'user_id': 100000}
+        )
+        await run_scenario(
+            client,
+            metadata_cache,
+            'Server report, last 30 days',
+            {'server_id': 1, 'channel_id': channel_ids, 'after': today - dt.timedelta(29)},
+        )
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,5 +1,119 @@
-import redis
+import datetime as dt
+import json
+from collections import Counter
+from typing import Any, Collection, Mapping, Optional, Sequence, Tuple, Union
+
+import redis.asyncio
 
 from configuration import configuration
 
-redis_connection = redis.Redis.from_url(configuration["redis_url"])
+STATUS_KEY = 'somsiad/status'
+STATUS_TTL = dt.timedelta(days=7)  # Counts and version outlive the bot going down, freshness is told by the heartbeat
+COMMAND_LATENCY_KEY = 'somsiad/command_latency'  # Suffixed with /<worker ID>
+COMMAND_LATENCY_TTL = dt.timedelta(days=1)
+POPULATION_KEY = 'somsiad/population'
+POPULATION_TTL = dt.timedelta(minutes=1)  # Counts of a worker that's gone down shouldn't linger
+POPULATION_USER_IDS_KEY = 'somsiad/population/user_ids'  # Suffixed with /<worker ID>, a HyperLogLog
+POPULATION_USER_IDS_BATCH_SIZE = 10_000
+COMMANDS_BEING_PROCESSED_KEY = 'somsiad/commands_being_processed'  # Suffixed with /<worker ID>
+PREFIXES_KEY = 'somsiad/prefixes'  # Suffixed with /<server ID>
+PREFIXES_TTL = dt.timedelta(days=1)
+
+async_redis_pool = redis.asyncio.BlockingConnectionPool.from_url(
+    configuration["redis_url"], max_connections=32, timeout=10
+)
+async_redis_connection = redis.asyncio.Redis(connection_pool=async_redis_pool)
+
+
+async def write_status(fields: Mapping[str, Union[str, int]]):
+    """Write bot status fields for the website in a single round trip."""
+    async with async_redis_connection.pipeline(transaction=True) as pipeline:
+        pipeline.hset(STATUS_KEY, mapping=fields)
+        pipeline.expire(STATUS_KEY, STATUS_TTL)
+        await pipeline.execute()
+
+
+async def write_command_latencies(worker_id: int, summary: Mapping[str, Any]):
+    """Replace the worker's exported command latency summary (a JSON object per command) in a single round trip."""
+    key = f'{COMMAND_LATENCY_KEY}/{worker_id}'
+    async with async_redis_connection.pipeline(transaction=True) as pipeline:
+        pipeline.delete(key)
+        if summary:
+            pipeline.hset(key, mapping={command_name: json.dumps(phases) for command_name, phases in summary.items()})
+            pipeline.expire(key, COMMAND_LATENCY_TTL)
+        await pipeline.execute()
+
+
+async def write_worker_population(worker_id: int, server_count: int, user_ids: Collection[int], *, replace: bool):
+    """Write the worker's server count and add user IDs to its user ID HyperLogLog, rebuilding it if `replace`.
+
+    A rebuild fills a separate key a batch per round trip, so that Redis isn't blocked by one huge transaction, and
+    only then swaps it in.
+    """
+    key = f'{POPULATION_USER_IDS_KEY}/{worker_id}'
+    user_ids = list(user_ids)
+    if replace:
+        rebuilt_key = f'{key}/rebuilt'
+        async with async_redis_connection.pipeline(transaction=True) as pipeline:
+            pipeline.delete(rebuilt_key)
+            pipeline.pfadd(rebuilt_key)  # Create the HyperLogLog even if there are no users
+            pipeline.expire(rebuilt_key, POPULATION_TTL)
+            await pipeline.execute()
+        for batch_start in range(0, len(user_ids), POPULATION_USER_IDS_BATCH_SIZE):
+            await async_redis_connection.pfadd(
+                rebuilt_key, *user_ids[batch_start : batch_start + POPULATION_USER_IDS_BATCH_SIZE]
+            )
+        user_ids = []
+    async with async_redis_connection.pipeline(transaction=True) as pipeline:
+        pipeline.hset(POPULATION_KEY, f'{worker_id}/server_count', server_count)
+        pipeline.expire(POPULATION_KEY, POPULATION_TTL)
+        if replace:
+            pipeline.rename(rebuilt_key, key)
+        if user_ids:
+            pipeline.pfadd(key, *user_ids)
+        pipeline.expire(key, POPULATION_TTL)
+        await pipeline.execute()
+
+
+async def read_cluster_population(worker_count: int) -> Tuple[int, int]:
+    """Return the server count summed over workers and the user count estimated over the union of their HyperLogLogs.
+
+    Servers are split between workers, but users are not, so a user on servers of several workers is counted once.
+    """
+    async with async_redis_connection.pipeline(transaction=False) as pipeline:
+        pipeline.hmget(POPULATION_KEY, [f'{worker_id}/server_count' for worker_id in range(worker_count)])
+        pipeline.pfcount(*(f'{POPULATION_USER_IDS_KEY}/{worker_id}' for worker_id in range(worker_count)))
+        server_counts, user_count = await pipeline.execute()
+    return sum(int(count or 0) for count in server_counts), user_count
+
+
+async def change_commands_being_processed(worker_id: int, command_name: str, change: int):
+    await async_redis_connection.hincrby(f'{COMMANDS_BEING_PROCESSED_KEY}/{worker_id}', command_name, change)
+
+
+async def clear_commands_being_processed(worker_id: int):
+    """Forget commands left over by the worker's previous run."""
+    await async_redis_connection.delete(f'{COMMANDS_BEING_PROCESSED_KEY}/{worker_id}')
+
+
+async def read_commands_being_processed(worker_count: int) -> Counter:
+    async with async_redis_connection.pipeline(transaction=False) as pipeline:
+        for worker_id in range(worker_count):
+            pipeline.hgetall(f'{COMMANDS_BEING_PROCESSED_KEY}/{worker_id}')
+        commands_being_processed: Counter = Counter()
+        for worker_commands_being_processed in await pipeline.execute():
+            for command_name, number in worker_commands_being_processed.items():
+                commands_being_processed[command_name.decode()] += int(number)
+    return commands_being_processed
+
+
+async def read_prefixes(server_id: int) -> Optional[Tuple[str, ...]]:
+    """Return the server's cached custom prefixes (empty if there are none), or None if they aren't cached."""
+    joined_prefixes = await async_redis_connection.get(f'{PREFIXES_KEY}/{server_id}')
+    if joined_prefixes is None:
+        return None
+    return tuple(joined_prefixes.decode().split('|')) if joined_prefixes else ()
+
+
+async def write_prefixes(server_id: int, prefixes: Sequence[str]):
+    await async_redis_connection.set(f'{PREFIXES_KEY}/{server_id}', '|'.join(prefixes), ex=PREFIXES_TTL)
@@ -0,0 +1,258 @@
+# Copyright 2026 Twixes
+
+# This file is part of Somsiad - the Polish Discord bot.
+
+# Somsiad is free software: you can redistribute it and/or modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later version.
+
+# Somsiad is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+# of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License along with Somsiad.
+# If not, see <https://www.gnu.org/licenses/>.
+
+"""Running the bot as a cluster of worker processes, each connecting its own range of shards.
+
+The supervisor (`launch`) only spawns and restarts workers. State shared between workers lives in Redis, and work that
+must happen once per cluster is coordinated through `Lease` (continuous work) and `claim_once` (occurrences).
+"""
+
+import asyncio
+import datetime as dt
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import uuid
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Sequence
+
+import discord
+
+from cache import async_redis_connection
+from configuration import configuration
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID_VARIABLE = 'SOMSIAD_WORKER_ID'
+WORKER_COUNT_VARIABLE = 'SOMSIAD_WORKER_COUNT'
+SHARD_IDS_VARIABLE = 'SOMSIAD_SHARD_IDS'
+SHARD_COUNT_VARIABLE = 'SOMSIAD_SHARD_COUNT'
+
+
+class Layout:
+    """Which shards this process connects, out of how many, as which worker of the cluster."""
+
+    __slots__ = ('worker_id', 'worker_count', 'shard_ids', 'shard_count')
+
+    worker_id: int
+    worker_count: int
+    shard_ids: Optional[List[int]]  # None means all shards, with the count recommended by Discord
+    shard_count: Optional[int]
+
+    def __init__(
+        self, worker_id: int, worker_count: int, shard_ids: Optional[Sequence[int]], shard_count: Optional[int]
+    ):
+        self.worker_id = worker_id
+        self.worker_count = worker_count
+        self.shard_ids = list(shard_ids) if shard_ids is not None else None
+        self.shard_count = shard_count
+
+    def __repr__(self) -> str:
+        return (
+            f'Layout(worker_id={self.worker_id}, worker_count={self.worker_count}, shard_ids={self.shard_ids}, '
+            f'shard_count={self.shard_count})'
+        )
+
+    @classmethod
+    def from_environment(cls) -> 'Layout':
+        """The layout passed down by the supervisor, or a whole single-process cluster if not run by one."""
+        if WORKER_ID_VARIABLE not in os.environ:
+            return cls(0, 1, None, None)
+        return cls(
+            int(os.environ[WORKER_ID_VARIABLE]),
+            int(os.environ[WORKER_COUNT_VARIABLE]),
+            [int(shard_id) for shard_id in os.environ[SHARD_IDS_VARIABLE].split(',')],
+            int(os.environ[SHARD_COUNT_VARIABLE]),
+        )
+
+    def to_environment(self) -> Dict[str, str]:
+        assert self.shard_ids is not None and self.shard_count is not None
+        return {
+            WORKER_ID_VARIABLE: str(self.worker_id),
+            WORKER_COUNT_VARIABLE: str(self.worker_count),
+            SHARD_IDS_VARIABLE: ','.join(map(str, self.shard_ids)),
+            SHARD_COUNT_VARIABLE: str(self.shard_count),
+        }
+
+    @classmethod
+    def split(cls, shard_count: int, worker_count: int) -> List['Layout']:
+        """Split shards into contiguous ranges as equal as possible, one per worker."""
+        shard_count = max(shard_count, worker_count)  # Every worker needs at least one shard
+        return [
+            cls(
+                worker_id,
+                worker_count,
+                range(shard_count * worker_id // worker_count, shard_count * (worker_id + 1) // worker_count),
+                shard_count,
+            )
+            for worker_id in range(worker_count)
+        ]
+
+
+layout = Layout.from_environment()
+process_token = f'{layout.worker_id}:{uuid.uuid4().hex}'  # Unique to this run of this worker
+
+
+class Lease:
+    """A Redis lease making sure that only one worker of the cluster does some continuous work at a time.
+
+    Holding expires `ttl` after the last renewal, so work of a worker that went down is taken over by another one.
+    """
+
+    KEY_PREFIX = 'somsiad/lease/'
+    RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) and 1 or 0
+"""
+    RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+    __slots__ = ('name', 'ttl')
+
+    def __init__(self, name: str, ttl: dt.timedelta):
+        self.name = name
+        self.ttl = ttl
+
+    @property
+    def key(self) -> str:
+        return self.KEY_PREFIX + self.name
+
+    async def hold(self) -> bool:
+        """Acquire the lease or renew it, returning whether this worker holds it now."""
+        return bool(
+            await async_redis_connection.eval(
+                self.RENEW_SCRIPT, 1, self.key, process_token, int(self.ttl.total_seconds() * 1000)
+            )
+        )
+
+    async def release(self):
+        await async_redis_connection.eval(self.RELEASE_SCRIPT, 1, self.key, process_token)
+
+    async def run_while_held(self, coroutine_function: Callable[..., Coroutine[Any, Any, Any]], *args):
+        """Run the work whenever this worker holds the lease, cancelling it as soon as the lease is lost."""
+        renewal_interval = self.ttl.total_seconds() / 3
+        while True:
+            while not await self.hold():
+                await asyncio.sleep(renewal_interval)
+            logger.info(f'Acquired lease "{self.name}"')
+            task = asyncio.get_running_loop().create_task(coroutine_function(*args))
+            try:
+                while True:
+                    done, _ = await asyncio.wait((task,), timeout=renewal_interval)
+                    if done:
+                        return task.result()
+                    try:
+                        held = await self.hold()
+                    except Exception as e:
+                        logger.warning(f'Could not renew lease "{self.name}": {e}')
+                        held = False
+                    if not held:
+                        logger.warning(f'Lost lease "{self.name}"')
+                        task.cancel()
+                        break
+            except asyncio.CancelledError:
+                task.cancel()
+                await self.release()
+                raise
+
+
+async def claim_once(occurrence: str, ttl: dt.timedelta) -> bool:
+    """Claim an occurrence of some work (e.g. a daily task on some date) for this worker, returning if it's first."""
+    return bool(await async_redis_connection.set(f'somsiad/claim/{occurrence}', process_token, nx=True, ex=ttl))
+
+
+async def fetch_recommended_shard_count() -> int:
+    http = discord.http.HTTPClient(asyncio.get_running_loop())
+    try:
+        await http.static_login(configuration['discord_token'])
+        shard_count, _ = await http.get_bot_gateway()
+    finally:
+        await http.close()
+    return shard_count
+
+
+class Supervisor:
+    """Spawns a worker process per `Layout` and restarts any that exit, until told to stop."""
+
+    RESTART_BACKOFF_SECONDS = (1, 5, 15, 60)
+    POLL_INTERVAL_SECONDS = 1
+    STABLE_RUN_SECONDS = 300  # A worker running this long without crashing gets its backoff reset
+
+    layouts: List[Layout]
+    processes: Dict[int, subprocess.Popen]
+
+    def __init__(self, layouts: Sequence[Layout], arguments: Sequence[str]):
+        self.layouts = list(layouts)
+        self.arguments = list(arguments)
+        self.processes = {}
+        self._started_at: Dict[int, float] = {}
+        self._restart_counts: Dict[int, int] = {}
+        self._stopping = False
+
+    def spawn(self, worker_layout: Layout):
+        logger.info(f'Starting worker {worker_layout.worker_id} with shards {worker_layout.shard_ids}')
+        self.processes[worker_layout.worker_id] = subprocess.Popen(
+            [sys.executable, *self.arguments], env={**os.environ, **worker_layout.to_environment()}
+        )
+        self._started_at[worker_layout.worker_id] = time.monotonic()
+
+    def stop(self, signum: int, frame: Any):
+        logger.info(f'Received {signum} signal, stopping workers')
+        self._stopping = True
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signum)
+
+    def run(self) -> int:
+        for worker_layout in self.layouts:
+            self.spawn(worker_layout)
+        restart_at: Dict[int, float] = {}
+        while True:
+            time.sleep(self.POLL_INTERVAL_SECONDS)
+            if self._stopping:
+                return max((process.wait() for process in self.processes.values()), default=0)
+            for worker_layout in self.layouts:
+                worker_id = worker_layout.worker_id
+                return_code = self.processes[worker_id].poll()
+                if return_code is None:
+                    continue
+                if worker_id not in restart_at:
+                    if time.monotonic() - self._started_at[worker_id] >= self.STABLE_RUN_SECONDS:
+                        self._restart_counts[worker_id] = 0
+                    backoff = self.RESTART_BACKOFF_SECONDS[
+                        min(self._restart_counts.get(worker_id, 0), len(self.RESTART_BACKOFF_SECONDS) - 1)
+                    ]
+                    logger.warning(f'Worker {worker_id} exited with code {return_code}, restarting in {backoff} s')
+                    restart_at[worker_id] = time.monotonic() + backoff
+                elif time.monotonic() >= restart_at[worker_id]:
+                    del restart_at[worker_id]
+                    self._restart_counts[worker_id] = self._restart_counts.get(worker_id, 0) + 1
+                    self.spawn(worker_layout)
+
+
+def launch(worker_count: int, arguments: Sequence[str]) -> int:
+    """Run the bot as a cluster of `worker_count` processes, each started with `arguments`. Blocks until stopped."""
+    shard_count = asyncio.run(fetch_recommended_shard_count())
+    logger.info(f'Launching {worker_count} workers for {shard_count} shards')
+    supervisor = Supervisor(Layout.split(shard_count, worker_count), arguments)
+    signal.signal(signal.SIGTERM, supervisor.stop)
+    signal.signal(signal.SIGINT, supervisor.stop)
+    return supervisor.run()
@@ -118,6 +118,31 @@ SETTINGS = (
     Setting('last_fm_key', description='Klucz API Last.fm', optional=True),
     Setting('openai_api_key', description='Klucz API OpenAI', optional=True),
     Setting('perplexity_api_key', description='Klucz API Perplexity', optional=True),
+    Setting(
+        'report_worker_count', description='Liczba równolegle przetwarzanych raportów aktywności', default_value=4
+    ),
+    Setting(
+        'backfill_hours',
+        description='Godziny uzupełniania historii wiadomości w tle (poza szczytem)',
+        default_value='1-7',
+    ),
+    Setting(
+        'backfill_requests_per_minute',
+        description='Budżet zapytań uzupełniania historii wiadomości',
+        unit='zapytań/min',
+        default_value=30,
+    ),
+    Setting(
+        'backfill_requests_per_minute_per_server',
+        description='Budżet zapytań uzupełniania historii wiadomości na serwer',
+        unit='zapytań/min',
+        default_value=6,
+    ),
+    Setting(
+        'cluster_worker_count',
+        description='Liczba procesów roboczych (dzielących między siebie shardy)',
+        default_value=1,
+    ),
     Setting(
         'disco_max_file_size_in_mib', description='Maksymalny rozmiar pliku utworu disco', unit='MiB', default_value=16
     ),
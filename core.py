@@ -12,23 +12,53 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import contextvars
 import datetime as dt
+import hashlib
+import heapq
+import itertools
+import logging
 import random
-from typing import List, Optional, Sequence, TypedDict, Union
-from cachetools import TTLCache, cached
-from cachetools.keys import hashkey
+import time
+from collections import defaultdict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    Type,
+    TypedDict,
+    Union,
+)
+from aiochclient.records import Record
+import aiohttp
 
 import discord
 from discord.ext import commands, tasks
-from sqlalchemy.sql import functions
+from redis.exceptions import NoScriptError, RedisError
+from sqlalchemy import Index, func, select, tuple_, update
 
+import cluster
 import data
-from cache import redis_connection
+from cache import (
+    async_redis_connection,
+    read_cluster_population,
+    write_command_latencies,
+    write_status,
+    write_worker_population,
+)
 from configuration import configuration
 from somsiad import Somsiad, SomsiadMixin, OptedOutOfDataProcessing
 from utilities import human_amount_of_time, word_number_form
 from version import __copyright__, __version__
-from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
 
 
 class Invocation(data.MemberRelated, data.ChannelRelated, data.Base):
@@ -44,12 +74,597 @@ class Invocation(data.MemberRelated, data.ChannelRelated, data.Base):
     error = data.Column(data.String(MAX_ERROR_LENGTH))
 
 
+class InvocationAnalytics(SomsiadMixin):
+    """Invocation analytics storage in ClickHouse. Replaces the unbounded `invocations` table in Postgres."""
+
+    RETENTION_DAYS = 730
+    COLUMNS = (
+        'id',
+        'message_id',
+        'server_id',
+        'channel_id',
+        'user_id',
+        'prefix',
+        'full_command',
+        'root_command',
+        'created_at',
+        'exited_at',
+        'error',
+    )
+    IMPORT_BATCH_SIZE = 10_000
+    IMPORT_KEY = 'somsiad/invocations_import'  # Hash of the last imported ID and, once done, the completion time
+    IMPORT_LEASE = cluster.Lease('invocations_import', dt.timedelta(seconds=30))
+    DEDUPLICATION_WINDOW = 1000
+
+    async def prepare(self):
+        await self.bot.ch_client.execute(
+            f'''
+            CREATE TABLE IF NOT EXISTS invocations (
+                id UInt64 Codec(DoubleDelta, LZ4),
+                message_id UInt64 Codec(T64, LZ4),
+                server_id Nullable(UInt64),
+                channel_id UInt64 Codec(T64, LZ4),
+                user_id UInt64 Codec(T64, LZ4),
+                prefix Nullable(String),
+                full_command LowCardinality(String),
+                root_command LowCardinality(String),
+                created_at DateTime64(3) Codec(DoubleDelta, LZ4),
+                exited_at Nullable(DateTime64(3)),
+                error Nullable(String)
+            ) ENGINE = MergeTree
+            ORDER BY (created_at, id)
+            PARTITION BY toYYYYMM(created_at)
+            TTL toDateTime(created_at) + INTERVAL {self.RETENTION_DAYS} DAY
+        '''
+        )
+        await self.bot.ch_client.execute(
+            f'''
+            ALTER TABLE invocations
+            MODIFY SETTING non_replicated_deduplication_window = {self.DEDUPLICATION_WINDOW}
+        '''
+        )
+
+    async def insert(self, rows: Sequence[Dict[str, Any]], *, deduplication_token: Optional[str] = None):
+        query = 'INSERT INTO invocations'
+        if deduplication_token is not None:
+            query += f" SETTINGS insert_deduplication_token = '{deduplication_token}'"
+        query += ' VALUES'
+        values = [tuple(row[column] for column in self.COLUMNS) for row in rows]
+        try:
+            await self.bot.ch_client.execute(query, *values)
+        except (aiohttp.ClientOSError, aiohttp.ServerDisconnectedError):
+            # Retry once
+            await self.bot.ch_client.execute(query, *values)
+
+    async def import_from_postgres(self):
+        """Copy the legacy Postgres `invocations` table over, once per cluster, resuming after an interruption."""
+        await self.IMPORT_LEASE.run_while_held(self._import_from_postgres)
+
+    async def _import_from_postgres(self):
+        last_id_raw, completed_at = await async_redis_connection.hmget(self.IMPORT_KEY, ['last_id', 'completed_at'])
+        if completed_at is not None:
+            return
+        if last_id_raw is not None:
+            last_id = int(last_id_raw)
+        else:
+            # Imports from before the marker existed left no trace in Redis, so resume after what ClickHouse has of
+            # the legacy IDs (which are far below the snowflake IDs of live invocations)
+            async with data.async_session() as session:
+                legacy_max_id = (await session.execute(select(func.max(Invocation.id)))).scalar()
+            last_id = -1
+            if legacy_max_id is not None:
+                imported_max_id = await self.bot.ch_client.fetchval(
+                    'SELECT max(id) FROM invocations WHERE id <= {legacy_max_id}',
+                    params={'legacy_max_id': legacy_max_id},
+                )
+                last_id = imported_max_id or -1  # max() of no rows is 0 in ClickHouse
+        while True:
+            async with data.async_session() as session:
+                invocations = (
+                    await session.execute(
+                        select(Invocation)
+                        .where(Invocation.id > last_id)
+                        .order_by(Invocation.id)
+                        .limit(self.IMPORT_BATCH_SIZE)
+                    )
+                ).scalars().all()
+            if not invocations:
+                break
+            # Batches start after the recorded ID, so one inserted just before an interruption gets the same token
+            await self.insert(
+                [{column: getattr(invocation, column) for column in self.COLUMNS} for invocation in invocations],
+                deduplication_token=f'postgres-import-{invocations[0].id}-{invocations[-1].id}',
+            )
+            last_id = invocations[-1].id
+            await async_redis_connection.hset(self.IMPORT_KEY, 'last_id', last_id)
+        await async_redis_connection.hset(self.IMPORT_KEY, 'completed_at', dt.datetime.now().isoformat())
+
+    async def delete_user_data(self, user_id: int):
+        await self.bot.ch_client.execute(
+            'ALTER TABLE invocations DELETE WHERE user_id = {user_id}', params={'user_id': user_id}
+        )
+
+    async def fetch_usage_report(self, *, after: dt.datetime, before: Optional[dt.datetime] = None) -> List[Record]:
+        """Per-command call counts, error rates and p50/p95 durations in milliseconds."""
+        params: Dict[str, Any] = {'after': after, 'before': before or dt.datetime.now()}
+        return await self.bot.ch_client.fetch(
+            '''
+            SELECT
+                full_command,
+                count() AS call_count,
+                countIf(error IS NOT NULL) / call_count AS error_rate,
+                quantiles(0.5, 0.95)(
+                    toUnixTimestamp64Milli(exited_at) - toUnixTimestamp64Milli(created_at)
+                ) AS duration_quantiles_ms
+            FROM invocations
+            WHERE created_at > {after} AND created_at <= {before}
+            GROUP BY full_command
+            ORDER BY call_count DESC
+        ''',
+            params=params,
+        )
+
+
+class ActiveUserSketches(SomsiadMixin):
+    """Per-day HyperLogLog sketches of users invoking commands, kept in Redis for constant-time DAU/WAU/MAU."""
+
+    KEY_PREFIX = 'somsiad/active_users/'
+    BACKFILLED_KEY = 'somsiad/active_users_backfilled'
+    RETENTION_DAYS = 31
+
+    @classmethod
+    def key(cls, date: dt.date) -> str:
+        return f'{cls.KEY_PREFIX}{date.isoformat()}'
+
+    async def add(self, user_ids_by_date: Dict[dt.date, Set[int]]):
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            for date, user_ids in user_ids_by_date.items():
+                key = self.key(date)
+                pipeline.pfadd(key, *user_ids)
+                pipeline.expireat(key, dt.datetime.combine(date, dt.time()) + dt.timedelta(self.RETENTION_DAYS + 1))
+            await pipeline.execute()
+
+    async def count(self, *days: int) -> List[int]:
+        """Count unique users active in the last N days (today included) for each N provided, in one round trip."""
+        today = dt.date.today()
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            for n in days:
+                pipeline.pfcount(*(self.key(today - dt.timedelta(offset)) for offset in range(n)))
+            return await pipeline.execute()
+
+    async def backfill(self):
+        """Seed the sketches from the invocations table, once."""
+        if await async_redis_connection.exists(self.BACKFILLED_KEY):
+            return
+        user_ids_by_date: Dict[dt.date, Set[int]] = defaultdict(set)
+        async for row in self.bot.ch_client.iterate(
+            'SELECT DISTINCT toDate(created_at) AS date, user_id FROM invocations WHERE created_at > {after}',
+            params={'after': dt.datetime.combine(dt.date.today(), dt.time()) - dt.timedelta(self.RETENTION_DAYS)},
+        ):
+            user_ids_by_date[row['date']].add(row['user_id'])
+        if user_ids_by_date:
+            await self.add(user_ids_by_date)
+        await async_redis_connection.set(self.BACKFILLED_KEY, dt.datetime.now().isoformat())
+
+
 class DataProcessingOptOut(data.UserSpecific, data.Base):
     pass
 
-@cached(cache=TTLCache(maxsize=5000, ttl=300), key=lambda _, user_id: hashkey(user_id))
-def is_user_opted_out_of_data_processing(session: Session, user_id: int) -> bool:
-    return session.query(DataProcessingOptOut).get(user_id) is not None
+class DataProcessingOptOutIndex:
+    """Process-wide set of IDs of users who opted out of data processing, answering membership without the database.
+
+    Loaded at startup and kept current across processes through Redis pub/sub.
+    """
+
+    CHANNEL = 'somsiad/data_processing_opt_outs'
+    RESUBSCRIBE_DELAY_SECONDS = 5
+
+    _user_ids: Set[int]
+
+    def __init__(self):
+        self._user_ids = set()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._user_ids
+
+    async def load(self):
+        async with data.async_session() as session:
+            self._user_ids = set((await session.execute(select(DataProcessingOptOut.user_id))).scalars())
+
+    async def opt_out(self, user_id: int):
+        self._user_ids.add(user_id)
+        await async_redis_connection.publish(self.CHANNEL, f'out:{user_id}')
+
+    async def opt_in(self, user_id: int):
+        self._user_ids.discard(user_id)
+        await async_redis_connection.publish(self.CHANNEL, f'in:{user_id}')
+
+    async def listen(self):
+        """Apply opt-outs and opt-ins published by other processes."""
+        while True:
+            try:
+                async with async_redis_connection.pubsub() as pubsub:
+                    await pubsub.subscribe(self.CHANNEL)
+                    await self.load()  # Catch up on anything published while we weren't subscribed
+                    async for message in pubsub.listen():
+                        if message['type'] != 'message':
+                            continue
+                        action, user_id = message['data'].decode().split(':')
+                        if action == 'out':
+                            self._user_ids.add(int(user_id))
+                        else:
+                            self._user_ids.discard(int(user_id))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Opt-out index subscription failed, resubscribing...')
+                await asyncio.sleep(self.RESUBSCRIBE_DELAY_SECONDS)
+
+
+data_processing_opt_outs = DataProcessingOptOutIndex()
+
+
+class TimerScheduler:
+    """Durable scheduler of one-off timers (reminders, burnings, ballots), each being a row with a due time column and
+    a done flag column.
+
+    Only timers due within `HORIZON` are paged in from the database (via a partial index on the due time of pending
+    rows) into a min-heap, from which they are fired with at most `MAX_CONCURRENCY` handlers running at once. Fired
+    timers are marked done in one `UPDATE` per model every `MARK_DONE_INTERVAL_SECONDS`. A failed handler is retried
+    on later pages, up to `MAX_ATTEMPTS` times in total, unless it failed after calling `mark_delivered`. Pages are
+    keyset-paginated by due time and primary key, so a backlog bigger than `PAGE_SIZE` is paged through rather than
+    re-read. In a cluster, timers only fire on the worker holding `LEASE`.
+    """
+
+    HORIZON = dt.timedelta(minutes=5)
+    PAGE_SIZE = 1000
+    MAX_CONCURRENCY = 16
+    MAX_ATTEMPTS = 3
+    MARK_DONE_INTERVAL_SECONDS = 1.0
+    NEXT_PAGE_DELAY = dt.timedelta(seconds=1)  # Between full pages of overdue timers, so that firing can keep up
+    PAGE_REQUEST_CHANNEL = 'somsiad/timer_page_requests'
+    LEASE = cluster.Lease('timer_scheduler', dt.timedelta(seconds=30))
+
+    class Timer:
+        __slots__ = ('model', 'due_column', 'done_column', 'primary_key_column', 'handler', 'index')
+
+        def __init__(
+            self,
+            model: Type[data.Base],
+            due_column: data.Column,
+            done_column: data.Column,
+            handler: Optional[Callable[[Any], Awaitable[None]]],
+        ):
+            self.model = model
+            self.due_column = due_column
+            self.done_column = done_column
+            self.primary_key_column = model.__mapper__.primary_key[0]
+            self.handler = handler
+            self.index = Index(
+                f'ix_{model.__tablename__}_pending_{due_column.name}',
+                due_column,
+                postgresql_where=done_column.is_(False),
+                sqlite_where=done_column.is_(False),
+            )
+
+    _timers: Dict[Type[data.Base], Timer]
+    _heap: List[Tuple[dt.datetime, int, Type[data.Base], Any]]
+    _known_keys: Set[Tuple[Type[data.Base], Any]]  # Paged in, but not marked done in the database yet
+    _done_keys: Dict[Type[data.Base], List[Any]]
+    _attempts: Dict[Tuple[Type[data.Base], Any], int]
+    _page_cursors: Dict[Type[data.Base], Tuple[dt.datetime, Any]]  # Due time and primary key ending the last full page
+    _delivered: contextvars.ContextVar[bool] = contextvars.ContextVar('timer_delivered', default=False)
+
+    def __init__(self):
+        self._timers = {}
+        self._heap = []
+        self._known_keys = set()
+        self._done_keys = defaultdict(list)
+        self._attempts = defaultdict(int)
+        self._page_cursors = {}
+        self._sequence = itertools.count()
+        self._wake_up = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        self._running = False
+        self._page_requested = False
+        # Held by paging in and by marking done, so that a page can't see a row as pending once it's no longer known
+        self._database_lock = asyncio.Lock()
+        self._tasks: Set[asyncio.Task] = set()  # The loop only keeps weak references to tasks
+
+    def register(
+        self,
+        model: Type[data.Base],
+        handler: Callable[[Any], Awaitable[None]],
+        *,
+        due_column: data.Column,
+        done_column: data.Column,
+    ):
+        """Have `handler` called with each pending row of `model` once its `due_column` time comes."""
+        if model not in self._timers:
+            self._timers[model] = self.Timer(model, due_column, done_column, handler)
+        else:
+            self._timers[model].handler = handler
+        self._wake_up.set()
+
+    def unregister(self, model: Type[data.Base]):
+        self._timers[model].handler = None  # The timer itself stays, as fired rows may still have to be marked done
+        self._heap = [entry for entry in self._heap if entry[2] is not model]
+        heapq.heapify(self._heap)
+        self._known_keys = {key for key in self._known_keys if key[0] is not model or key[1] in self._done_keys[model]}
+
+    def schedule(self, row: data.Base):
+        """Make a just inserted (and committed) row known to the scheduler without waiting for the next page."""
+        timer = self._timers[type(row)]
+        if getattr(row, timer.due_column.key) <= dt.datetime.now() + self.HORIZON:
+            if self._running:
+                self._push(timer, row)
+                self._wake_up.set()
+            else:  # The scheduler runs on another worker of the cluster
+                self._create_task(async_redis_connection.publish(self.PAGE_REQUEST_CHANNEL, ''))
+
+    async def run(self, bot: Somsiad):
+        """Fire timers. Must only run on one worker of the cluster at a time, which `LEASE` takes care of."""
+        await bot.wait_until_ready()
+        for timer in list(self._timers.values()):
+            await asyncio.to_thread(timer.index.create, data.engine, checkfirst=True)
+        # Rows pushed during a previous run may have since been fired by another worker, so start from the database
+        self._heap.clear()
+        self._page_cursors.clear()
+        self._known_keys = {(model, key) for model, primary_keys in self._done_keys.items() for key in primary_keys}
+        self._running = True
+        mark_done_task = bot.loop.create_task(self._mark_done_periodically(bot))
+        page_request_listener = bot.loop.create_task(self._listen_for_page_requests())
+        try:
+            next_page_at = dt.datetime.min
+            while True:
+                now = dt.datetime.now()
+                if now >= next_page_at or self._page_requested:
+                    self._page_requested = False
+                    next_page_at = await self._page_in(now)
+                while self._heap and self._heap[0][0] <= now:
+                    _, _, model, row = heapq.heappop(self._heap)
+                    await self._semaphore.acquire()
+                    self._create_task(self._fire(bot, self._timers[model], row))
+                next_wake_up_at = min(next_page_at, self._heap[0][0]) if self._heap else next_page_at
+                self._wake_up.clear()
+                try:
+                    await asyncio.wait_for(
+                        self._wake_up.wait(), max((next_wake_up_at - dt.datetime.now()).total_seconds(), 0)
+                    )
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._running = False
+            page_request_listener.cancel()
+            mark_done_task.cancel()
+            await self._mark_done()
+
+    async def _listen_for_page_requests(self):
+        """Page in again whenever another worker schedules a row."""
+        while True:
+            try:
+                async with async_redis_connection.pubsub() as pubsub:
+                    await pubsub.subscribe(self.PAGE_REQUEST_CHANNEL)
+                    self._page_requested = True  # Catch up on anything published while we weren't subscribed
+                    self._wake_up.set()
+                    async for message in pubsub.listen():
+                        if message['type'] == 'message':
+                            self._page_requested = True
+                            self._wake_up.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Timer page request subscription failed, resubscribing...')
+                await asyncio.sleep(DataProcessingOptOutIndex.RESUBSCRIBE_DELAY_SECONDS)
+
+    def _create_task(self, coroutine: Coroutine[Any, Any, Any]):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _push(self, timer: Timer, row: data.Base):
+        key = (timer.model, getattr(row, timer.primary_key_column.key))
+        if key in self._known_keys:
+            return
+        self._known_keys.add(key)
+        heapq.heappush(self._heap, (getattr(row, timer.due_column.key), next(self._sequence), timer.model, row))
+
+    async def _page_in(self, now: dt.datetime) -> dt.datetime:
+        """Push pending timers due within the horizon onto the heap, returning when the next page is needed."""
+        next_page_at = now + self.HORIZON / 2
+        async with self._database_lock, data.async_session() as session:
+            for timer in list(self._timers.values()):
+                if timer.handler is None:
+                    continue
+                query = (
+                    select(timer.model)
+                    .where(timer.done_column.is_(False), timer.due_column <= now + self.HORIZON)
+                    .order_by(timer.due_column, timer.primary_key_column)
+                    .limit(self.PAGE_SIZE)
+                )
+                if timer.model in self._page_cursors:
+                    query = query.where(
+                        tuple_(timer.due_column, timer.primary_key_column) > tuple_(*self._page_cursors[timer.model])
+                    )
+                rows = (await session.execute(query)).scalars().all()
+                for row in rows:
+                    self._push(timer, row)
+                if len(rows) == self.PAGE_SIZE:
+                    # Page is full, so continue after its end once that's reached - or soon if it's overdue already
+                    last_due = getattr(rows[-1], timer.due_column.key)
+                    self._page_cursors[timer.model] = (last_due, getattr(rows[-1], timer.primary_key_column.key))
+                    next_page_at = min(next_page_at, max(last_due, now + self.NEXT_PAGE_DELAY))
+                else:  # Start over next time, picking up retries and rows not yet marked done
+                    self._page_cursors.pop(timer.model, None)
+        return next_page_at
+
+    def mark_delivered(self):
+        """Called by a handler once its effect is visible to users (e.g. a message is sent), so that it isn't retried -
+        and that effect repeated - if the handler fails afterwards."""
+        self._delivered.set(True)
+
+    async def _fire(self, bot: Somsiad, timer: Timer, row: data.Base):
+        key = (timer.model, getattr(row, timer.primary_key_column.key))
+        self._delivered.set(False)  # Each firing is a task of its own, so this is local to it
+        try:
+            if timer.handler is None:  # Unregistered in the meantime
+                self._known_keys.discard(key)
+                return
+            await timer.handler(row)
+        except Exception as e:
+            bot.register_error(f'timer_{timer.model.__tablename__}', e)
+            self._attempts[key] += 1
+            if self._attempts[key] < self.MAX_ATTEMPTS and not self._delivered.get():
+                self._known_keys.discard(key)  # Let the next page pick it up again
+                return
+        finally:
+            self._semaphore.release()
+        self._attempts.pop(key, None)
+        self._done_keys[timer.model].append(key[1])
+
+    async def _mark_done_periodically(self, bot: Somsiad):
+        while True:
+            await asyncio.sleep(self.MARK_DONE_INTERVAL_SECONDS)
+            try:
+                await self._mark_done()
+            except Exception as e:
+                bot.register_error('timer_mark_done', e)
+
+    async def _mark_done(self):
+        async with self._database_lock:
+            done_keys, self._done_keys = self._done_keys, defaultdict(list)
+            done_keys = {model: primary_keys for model, primary_keys in done_keys.items() if primary_keys}
+            if not done_keys:
+                return
+            try:
+                async with data.async_session(commit=True) as session:
+                    for model, primary_keys in done_keys.items():
+                        timer = self._timers[model]
+                        await session.execute(
+                            update(model)
+                            .where(timer.primary_key_column.in_(primary_keys))
+                            .values({timer.done_column: True})
+                        )
+            except:
+                for model, primary_keys in done_keys.items():
+                    self._done_keys[model].extend(primary_keys)  # Try again with the next batch
+                raise
+            for model, primary_keys in done_keys.items():
+                self._known_keys.difference_update((model, primary_key) for primary_key in primary_keys)
+
+
+timer_scheduler = TimerScheduler()
+
+
+class CooldownBuckets:
+    """Cluster-wide command cooldown buckets in Redis, rate limited with GCRA (the generic cell rate algorithm).
+
+    A bucket allowing `rate` uses per `per` seconds is a single key holding its theoretical arrival time, updated
+    atomically by a Lua script. Checks made in the same event loop iteration are sent in one pipeline, so a check costs
+    at most one round trip. While Redis is unavailable, buckets fall back to process-local state.
+    """
+
+    KEY_PREFIX = 'somsiad/cooldown/'
+    GCRA_SCRIPT = """
+local now = redis.call('TIME')
+local now_ms = tonumber(now[1]) * 1000 + math.floor(tonumber(now[2]) / 1000)
+local emission_interval_ms = tonumber(ARGV[1])
+local period_ms = tonumber(ARGV[2])
+local arrival_ms = math.max(tonumber(redis.call('GET', KEYS[1]) or now_ms), now_ms)
+local new_arrival_ms = arrival_ms + emission_interval_ms
+local allowed_at_ms = new_arrival_ms - period_ms
+if allowed_at_ms > now_ms then
+    return allowed_at_ms - now_ms
+end
+redis.call('SET', KEYS[1], new_arrival_ms, 'PX', new_arrival_ms - now_ms)
+return 0
+"""
+    GCRA_SCRIPT_SHA = hashlib.sha1(GCRA_SCRIPT.encode()).hexdigest()
+    REDIS_TIMEOUT_SECONDS = 1.0
+    REDIS_RETRY_INTERVAL_SECONDS = 30
+    LOCAL_PRUNE_THRESHOLD = 10_000
+
+    _pending: List[Tuple[str, int, int, asyncio.Future]]
+    _flush_tasks: Set[asyncio.Task]
+    _local_arrivals: Dict[str, float]
+
+    def __init__(self):
+        self._pending = []
+        self._flush_tasks = set()
+        self._local_arrivals = {}
+        self._redis_unavailable_until = 0.0
+
+    async def retry_after(self, key: str, rate: int, per: float) -> float:
+        """Use the bucket, returning 0 if that was allowed, otherwise the number of seconds until it will be."""
+        emission_interval_ms = max(round(per * 1000 / rate), 1)
+        period_ms = emission_interval_ms * rate
+        if time.monotonic() < self._redis_unavailable_until:
+            return self._local_retry_after(key, emission_interval_ms, period_ms)
+        future = asyncio.get_running_loop().create_future()
+        if not self._pending:
+            asyncio.get_running_loop().call_soon(self._start_flush)
+        self._pending.append((self.KEY_PREFIX + key, emission_interval_ms, period_ms, future))
+        try:
+            return await asyncio.wait_for(future, self.REDIS_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError as e:
+            self._fall_back(e)
+            # The check may have used the bucket in Redis already, so only consult the local one without using it
+            return self._local_retry_after(key, emission_interval_ms, period_ms, use=False)
+        except RedisError as e:
+            self._fall_back(e)
+            return self._local_retry_after(key, emission_interval_ms, period_ms)
+
+    def _fall_back(self, error: Exception):
+        if time.monotonic() >= self._redis_unavailable_until:
+            logger.warning(f'Falling back to local cooldown buckets, as Redis is unavailable: {error!r}')
+            self._redis_unavailable_until = time.monotonic() + self.REDIS_RETRY_INTERVAL_SECONDS
+
+    def _start_flush(self):
+        flush_task = asyncio.get_running_loop().create_task(self._flush())
+        self._flush_tasks.add(flush_task)  # The loop only keeps weak references to tasks
+        flush_task.add_done_callback(self._flush_tasks.discard)
+
+    async def _flush(self):
+        pending, self._pending = self._pending, []
+        try:
+            results = await self._evaluate(pending, use_sha=True)
+            if any(isinstance(result, NoScriptError) for result in results):  # Only after Redis lost its script cache
+                results = await self._evaluate(pending, use_sha=False)
+        except RedisError as e:
+            results = [e] * len(pending)
+        for (*_, future), result in zip(pending, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(int(result) / 1000)
+
+    async def _evaluate(self, pending: Sequence[Tuple[str, int, int, asyncio.Future]], *, use_sha: bool) -> List[Any]:
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            for key, emission_interval_ms, period_ms, _ in pending:
+                if use_sha:
+                    pipeline.evalsha(self.GCRA_SCRIPT_SHA, 1, key, emission_interval_ms, period_ms)
+                else:
+                    pipeline.eval(self.GCRA_SCRIPT, 1, key, emission_interval_ms, period_ms)
+            return await pipeline.execute(raise_on_error=False)
+
+    def _local_retry_after(self, key: str, emission_interval_ms: int, period_ms: int, *, use: bool = True) -> float:
+        now_ms = time.monotonic() * 1000
+        if len(self._local_arrivals) > self.LOCAL_PRUNE_THRESHOLD:
+            self._local_arrivals = {
+                key: arrival_ms for key, arrival_ms in self._local_arrivals.items() if arrival_ms > now_ms
+            }
+        new_arrival_ms = max(self._local_arrivals.get(key, now_ms), now_ms) + emission_interval_ms
+        allowed_at_ms = new_arrival_ms - period_ms
+        if allowed_at_ms > now_ms:
+            return (allowed_at_ms - now_ms) / 1000
+        if use:
+            self._local_arrivals[key] = new_arrival_ms
+        return 0.0
+
+
+cooldown_buckets = CooldownBuckets()
 
 
 def cooldown(
@@ -57,12 +672,22 @@ def cooldown(
     per: float = configuration['command_cooldown_per_user_in_seconds'],
     type: commands.BucketType = commands.BucketType.user,
 ):
+    async def predicate(ctx: commands.Context) -> bool:
+        if getattr(ctx, "_is_ai_tool_call", False):
+            return True
+        bucket_id = type.get_key(ctx)
+        if isinstance(bucket_id, tuple):
+            bucket_id = ':'.join(map(str, bucket_id))
+        retry_after = await cooldown_buckets.retry_after(
+            f'{ctx.command.qualified_name}/{type.name}/{bucket_id}', rate, per
+        )
+        if retry_after:
+            raise commands.CommandOnCooldown(commands.Cooldown(rate, per), retry_after, type)
+        return True
+
     def decorator(func):
         if isinstance(func, commands.Command):
-            func._buckets = commands.DynamicCooldownMapping(
-                lambda context: commands.Cooldown(rate, per) if not getattr(context, "_is_ai_tool_call", False) else None,
-                type
-            )
+            func.checks.append(predicate)  # Runs last, like discord.py's own cooldowns, which come after checks
         else:
             raise ValueError("Decorator must be applied to command, not the function")
         return func
@@ -72,10 +697,9 @@ def cooldown(
 
 def did_not_opt_out_of_data_processing():
     async def predicate(ctx):
-        with data.session() as session:
-            if is_user_opted_out_of_data_processing(session, ctx.author.id):
-                await ctx.bot.send(ctx, embed=ctx.bot.generate_embed('👤', 'Ta komenda wymaga Twojej zgody na przetwarzanie Twoich danych', "Możesz wyrazić ją za pomocą komendy `przetwarzanie-danych zapisz`."))
-                raise OptedOutOfDataProcessing
+        if ctx.author.id in data_processing_opt_outs:
+            await ctx.bot.send(ctx, embed=ctx.bot.generate_embed('👤', 'Ta komenda wymaga Twojej zgody na przetwarzanie Twoich danych', "Możesz wyrazić ją za pomocą komendy `przetwarzanie-danych zapisz`."))
+            raise OptedOutOfDataProcessing
         return True
 
     return commands.check(predicate)
@@ -222,18 +846,57 @@ class Help:
 
 
 class Essentials(commands.Cog, SomsiadMixin):
+    LATENCY_REPORT_MAX_COMMANDS = 24  # Discord's embed field limit is 25
+    STATUS_LEASE = cluster.Lease('status', dt.timedelta(seconds=15))
+
     async def cog_load(self):
+        await data_processing_opt_outs.load()
+        self.opt_out_index_listener = self.bot.loop.create_task(data_processing_opt_outs.listen())
+        self.timer_scheduler_runner = self.bot.loop.create_task(
+            timer_scheduler.LEASE.run_while_held(timer_scheduler.run, self.bot)
+        )
         self.heartbeat.start()
+        self.export_command_latencies.start()
 
     def cog_unload(self):
         self.heartbeat.cancel()
+        self.export_command_latencies.cancel()
+        self.opt_out_index_listener.cancel()
+        self.timer_scheduler_runner.cancel()
 
     @tasks.loop(seconds=5)
     async def heartbeat(self):
-        redis_connection.set('somsiad/heartbeat', dt.datetime.now().isoformat(), ex=15)
-        redis_connection.set('somsiad/server_count', self.bot.server_count)
-        redis_connection.set('somsiad/user_count', self.bot.user_count)
-        redis_connection.set('somsiad/version', __version__)
+        if cluster.layout.worker_count > 1:
+            replace, user_ids = self.bot.population.take_user_id_changes()
+            try:
+                await write_worker_population(
+                    cluster.layout.worker_id, self.bot.server_count, user_ids, replace=replace
+                )
+            except Exception:
+                self.bot.population.mark_unsynced()  # The taken changes are lost, so rebuild next time
+                raise
+        if not await self.STATUS_LEASE.hold():
+            return  # Another worker of the cluster writes the status
+        server_count, user_count = await self.read_population()
+        await write_status(
+            {
+                'heartbeat': dt.datetime.now(dt.timezone.utc).isoformat(),
+                'server_count': server_count,
+                'user_count': user_count,
+                'worker_count': cluster.layout.worker_count,
+                'version': __version__,
+            }
+        )
+
+    async def read_population(self) -> Tuple[int, int]:
+        """Return server and user counts, exact for a single worker, with users estimated over a cluster."""
+        if cluster.layout.worker_count == 1:
+            return self.bot.server_count, self.bot.user_count
+        return await read_cluster_population(cluster.layout.worker_count)
+
+    @tasks.loop(seconds=30)
+    async def export_command_latencies(self):
+        await write_command_latencies(cluster.layout.worker_id, self.bot.command_metrics.summarize())
 
     @cooldown()
     @commands.command(aliases=['wersja', 'v'])
@@ -262,6 +925,8 @@ class Essentials(commands.Cog, SomsiadMixin):
             server_count = 193
             user_count = 7_802_385_004 + int((dt.datetime.now() - dt.datetime(2020, 1, 1)).total_seconds() * 2.5)
             mau_count = 1_323_519_222 + int((dt.datetime.now() - dt.datetime(2020, 1, 1)).total_seconds())
+            wau_count = mau_count // 4
+            dau_count = mau_count // 30
             sau_count = 194
             shard_count = 8
             runtime = human_amount_of_time(dt.datetime.now() - dt.datetime(1963, 11, 22))
@@ -271,15 +936,8 @@ class Essentials(commands.Cog, SomsiadMixin):
             emoji = 'ℹ️'
             notice = f'Somsiad {__version__}'
             footer = __copyright__
-            server_count = self.bot.server_count
-            user_count = self.bot.user_count
-            with data.session() as session:
-                thirty_days_ago = dt.datetime.now() - dt.timedelta(30)
-                mau_count = (
-                    session.query(functions.count(Invocation.user_id.distinct()))
-                    .filter(Invocation.created_at > thirty_days_ago)
-                    .scalar()
-                )
+            server_count, user_count = await self.read_population()
+            mau_count, wau_count, dau_count = await ActiveUserSketches(self.bot).count(30, 7, 1)
             shard_count = self.bot.shard_count or 1
             runtime = (
                 'nieznany'
@@ -293,6 +951,8 @@ class Essentials(commands.Cog, SomsiadMixin):
         embed.add_field(name='Liczba serwerów', value=f'{server_count:n}')
         embed.add_field(name='Liczba użytkowników', value=f'{user_count:n}')
         embed.add_field(name='Liczba aktywnych użytkowników miesięcznie', value=f'{mau_count:n}')
+        embed.add_field(name='Liczba aktywnych użytkowników tygodniowo', value=f'{wau_count:n}')
+        embed.add_field(name='Liczba aktywnych użytkowników dziennie', value=f'{dau_count:n}')
         embed.add_field(name='Liczba shardów', value=f'{shard_count:n}')
         embed.add_field(name='Czas pracy', value=runtime)
         embed.add_field(name='Właściciel instancji', value=instance_owner)
@@ -338,6 +998,32 @@ class Essentials(commands.Cog, SomsiadMixin):
             embed = self.bot.generate_embed('🚥', 'Diagnostyka wyłączona')
         await self.bot.send(ctx, embed=embed)
 
+    @commands.command(aliases=['latencje', 'opóźnienia', 'opoznienia'])
+    @commands.is_owner()
+    async def latencies(self, ctx, *, command_name: Optional[str] = None):
+        """Reports per-command latency percentiles since startup, slowest executions first."""
+        summary = self.bot.command_metrics.summarize()
+        if command_name is not None:
+            summary = {name: phases for name, phases in summary.items() if name == command_name}
+        rows = sorted(summary.items(), key=lambda item: item[1]['execution']['p95'] or 0, reverse=True)
+        embed = self.bot.generate_embed(
+            '⏱️', 'Opóźnienia komend (p50/p95/p99)', None if rows else 'Brak zarejestrowanych wywołań.'
+        )
+        for name, phases in rows[: self.LATENCY_REPORT_MAX_COMMANDS]:
+            embed.add_field(
+                name=f'{name} ({phases["queue"]["count"]:n})',
+                value='\n'.join(
+                    f'{phase_name}: '
+                    + '/'.join(
+                        '?' if phases[phase][quantile] is None else f'{round(phases[phase][quantile] * 1000):n}'
+                        for quantile in ('p50', 'p95', 'p99')
+                    )
+                    + ' ms'
+                    for phase, phase_name in (('queue', 'kolejka'), ('execution', 'wykonanie'), ('send', 'wysyłka'))
+                ),
+            )
+        await self.bot.send(ctx, embed=embed)
+
     @commands.command(aliases=['wyłącz', 'wylacz'])
     @commands.is_owner()
     async def shutdown(self, ctx):
@@ -454,7 +1140,7 @@ class Prefix(commands.Cog, SomsiadMixin):
         new_prefixes_processed = '|'.join(new_prefixes)
         if len(new_prefixes_processed) > data.Server.COMMAND_PREFIX_MAX_LENGTH:
             raise commands.BadArgument('too long')
-        self.bot.prefixes[ctx.guild.id] = new_prefixes
+        await self.bot.store_prefixes(ctx.guild.id, new_prefixes)
         with data.session(commit=True) as session:
             data_server = session.query(data.Server).get(ctx.guild.id)
             previous_prefixes = data_server.command_prefix.split('|') if data_server.command_prefix else ()
@@ -512,7 +1198,7 @@ class Prefix(commands.Cog, SomsiadMixin):
     @has_permissions(administrator=True)
     async def restore(self, ctx):
         """Reverts to the default command prefix."""
-        self.bot.prefixes[ctx.guild.id] = ()
+        await self.bot.store_prefixes(ctx.guild.id, ())
         with data.session(commit=True) as session:
             data_server = session.query(data.Server).get(ctx.guild.id)
             previous_prefixes = data_server.command_prefix.split('|') if data_server.command_prefix else ()
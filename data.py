@@ -11,8 +11,8 @@
 # You should have received a copy of the GNU General Public License along with Somsiad.
 # If not, see <https://www.gnu.org/licenses/>.
 
-from contextlib import contextmanager
-from typing import Any, Dict, Iterator, Optional, Sequence, Union, cast
+from contextlib import asynccontextmanager, contextmanager
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Sequence, Union, cast
 
 import discord
 from discord.ext import commands
@@ -30,17 +30,35 @@ from sqlalchemy import (
     func,
 )
 from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.ext.asyncio import AsyncSession as RawAsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
 from sqlalchemy.orm import Session as RawSession
 from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.sql.expression import Insert
 
 from configuration import configuration
 
+
+def _make_async_url(url: str) -> URL:
+    """Point the database URL at the asyncio driver of its dialect."""
+    parsed_url = make_url(url)
+    if parsed_url.get_backend_name() == 'postgresql':
+        return parsed_url.set(drivername='postgresql+asyncpg')
+    return parsed_url
+
+
 engine = create_engine(
     configuration["database_url"],
     pool_pre_ping=True,
 )
 Session = sessionmaker(bind=engine)
+async_engine = create_async_engine(
+    _make_async_url(configuration["database_url"]),
+    pool_pre_ping=True,
+)
+AsyncSession = sessionmaker(bind=async_engine, class_=RawAsyncSession, expire_on_commit=False)
 
 
 @contextmanager
@@ -57,6 +75,21 @@ def session(*, commit: bool = False) -> Iterator[RawSession]:
         _session.close()
 
 
+@asynccontextmanager
+async def async_session(*, commit: bool = False) -> AsyncIterator[RawAsyncSession]:
+    """Non-blocking counterpart of `session`, for use on hot paths of the event loop."""
+    _session = AsyncSession()
+    try:
+        yield _session
+        if commit:
+            await _session.commit()
+    except:
+        await _session.rollback()
+        raise
+    finally:
+        await _session.close()
+
+
 class _Base:
     @declared_attr
     def __tablename__(cls):
@@ -81,26 +114,47 @@ def create_all_tables():
     Base.metadata.create_all(engine)
 
 
-def insert_or_ignore(model, values: Union[Sequence[Dict[str, Any]], Dict[str, Any]], *, session: RawSession = None):
-    use_own_session = False
-    if session is None:
-        use_own_session = True
-        session = Session()
-    dialect_name = str(session.bind.dialect.name)
+def _build_insert_or_ignore(
+    model, values: Union[Sequence[Dict[str, Any]], Dict[str, Any]], *, dialect_name: str
+) -> Insert:
     if dialect_name == 'postgresql':
-        inserter = postgresql.insert(model.__table__).values(values).on_conflict_do_nothing()
+        return postgresql.insert(model.__table__).values(values).on_conflict_do_nothing()
     elif dialect_name == 'mysql':
-        inserter = model.__table__.insert().prefix_with('IGNORE').values(values)
+        return model.__table__.insert().prefix_with('IGNORE').values(values)
     elif dialect_name == 'sqlite':
-        inserter = model.__table__.insert().prefix_with('OR IGNORE').values(values)
+        return model.__table__.insert().prefix_with('OR IGNORE').values(values)
     else:
         raise Exception(f'database dialect {dialect_name} is not supported, only postgresql, mysql and sqlite')
+
+
+def insert_or_ignore(model, values: Union[Sequence[Dict[str, Any]], Dict[str, Any]], *, session: RawSession = None):
+    use_own_session = False
+    if session is None:
+        use_own_session = True
+        session = Session()
+    inserter = _build_insert_or_ignore(model, values, dialect_name=str(session.bind.dialect.name))
     session.execute(inserter)
     session.commit()
     if use_own_session:
         session.close()
 
 
+async def async_insert_or_ignore(
+    model, values: Union[Sequence[Dict[str, Any]], Dict[str, Any]], *, session: RawAsyncSession = None
+):
+    use_own_session = False
+    if session is None:
+        use_own_session = True
+        session = AsyncSession()
+    inserter = _build_insert_or_ignore(model, values, dialect_name=str(session.bind.dialect.name))
+    try:
+        await session.execute(inserter)
+        await session.commit()
+    finally:
+        if use_own_session:
+            await session.close()
+
+
 class Server(Base):
     COMMAND_PREFIX_MAX_LENGTH = 100
 
@@ -120,6 +174,19 @@ class Server(Base):
         ]
         insert_or_ignore(cls, values)
 
+    @classmethod
+    async def async_register(cls, server: discord.Guild):
+        values = {'id': server.id, 'joined_at': server.me.joined_at}
+        await async_insert_or_ignore(cls, values)
+
+    @classmethod
+    async def async_register_all(cls, servers: Sequence[discord.Guild]):
+        values = [
+            {'id': server.id, 'joined_at': server.me.joined_at if server.me is not None else None} for server in servers
+        ]
+        if values:
+            await async_insert_or_ignore(cls, values)
+
 
 class ServerRelated:
     @declared_attr
@@ -133,6 +200,10 @@ class ServerRelated:
     def discord_server(self, bot: commands.Bot) -> Optional[discord.Guild]:
         return bot.get_guild(self.server_id) if self.server_id is not None else None
 
+    async def async_server(self, session: RawAsyncSession) -> Optional[Server]:
+        """Relationship `server` can't be lazy-loaded in an async session, so it's fetched explicitly here."""
+        return await session.get(Server, self.server_id) if self.server_id is not None else None
+
 
 class ServerSpecific(ServerRelated):
     @declared_attr
@@ -160,6 +231,17 @@ class UserRelated:
     def discord_user(self, bot: commands.Bot) -> Optional[discord.User]:
         return bot.get_user(self.user_id) if self.user_id is not None else None
 
+    async def fetch_discord_user(self, bot: commands.Bot) -> Optional[discord.User]:
+        if self.user_id is None:
+            return None
+        user = bot.get_user(self.user_id)
+        if user is None:
+            try:
+                user = await bot.fetch_user(self.user_id)
+            except discord.NotFound:
+                pass
+        return user
+
     def __init_subclass__(cls):
         if issubclass(cls, Base):
             USER_RELATED_MODELS.append(cls)
@@ -11,40 +11,60 @@
 # You should have received a copy of the GNU General Public License along with Somsiad.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import array
 import asyncio
 import calendar
+import contextlib
 import dataclasses
 import datetime as dt
 import aiohttp
 import enum
-import functools
+import gzip
+import hashlib
 import io
-import data
+import logging
+import re
+import sys
+import uuid
+import zoneinfo
 from collections import defaultdict, deque
 from typing import (
+    AbstractSet,
     Any,
+    ClassVar,
     DefaultDict,
     Deque,
     Dict,
+    Iterable,
+    Iterator,
     List,
+    NamedTuple,
     Optional,
     Sequence,
+    Set,
     Tuple,
     Union,
     cast,
 )
 
 import discord
-import matplotlib.dates as mdates
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
+from aiochclient.exceptions import ChClientError
 from aiochclient.records import Record
-from discord.ext import commands
+from discord.ext import commands, tasks
+from redis.exceptions import ResponseError
 
+import cluster
+from cache import async_redis_connection
 from configuration import configuration
-from core import DataProcessingOptOut, Help, cooldown
+from core import Help, cooldown, cooldown_buckets, data_processing_opt_outs
 from somsiad import Somsiad, SomsiadMixin
-from utilities import human_datetime, md_link, rolling_average, utc_to_naive_local, word_number_form
+from utilities import LazyModule, human_datetime, md_link, rolling_average, utc_to_naive_local, word_number_form
+
+mdates = LazyModule('matplotlib.dates')
+plt = LazyModule('matplotlib.pyplot', on_load=lambda pyplot: pyplot.style.use('dark_background'))
+# Figures are created directly, but the style applied along with pyplot must be in place first
+mfigure = LazyModule('matplotlib.figure', on_load=lambda figure: plt.load())
+ticker = LazyModule('matplotlib.ticker')
 
 
 @dataclasses.dataclass
@@ -57,6 +77,30 @@ class MessageMetadata:
     character_count: int
     created_at: dt.datetime
 
+    @classmethod
+    def from_message(cls, message: discord.Message) -> 'MessageMetadata':
+        content_parts: List[Union[str, discord.embeds._EmptyEmbed]] = [message.clean_content]
+        for embed in message.embeds:
+            content_parts.append(embed.title)
+            content_parts.append(embed.description)
+            for field in embed.fields:
+                content_parts.append(field.name)
+                content_parts.append(field.value)
+            if embed.footer:
+                content_parts.append(embed.footer.text)
+            if embed.author:
+                content_parts.append(embed.author.name)
+        content = ' '.join(cast(List[str], filter(None, content_parts)))
+        return cls(
+            id=message.id,
+            server_id=message.guild.id,
+            channel_id=message.channel.id,
+            user_id=message.author.id,
+            word_count=len(tuple(filter(None, content.split()))),
+            character_count=len(content),
+            created_at=utc_to_naive_local(message.created_at),
+        )
+
 
 @dataclasses.dataclass
 class MaterializedMessageMetadata(MessageMetadata):
@@ -65,7 +109,228 @@ class MaterializedMessageMetadata(MessageMetadata):
     date: str
 
 
+class MetadataColumns:
+    """Message metadata buffered column by column in typed arrays, ready to be sent to ClickHouse as a Native block.
+
+    A row takes `ROW_SIZE` bytes instead of a dataclass instance's few hundred, and encoding a column is a single copy.
+    `created_at` is stored as milliseconds since the epoch, read from naive datetimes in the given timezone - the
+    ClickHouse server's, which is how it interprets naive datetimes in text inserts.
+    """
+
+    COLUMNS = (
+        ('id', 'UInt64', 'Q'),
+        ('server_id', 'UInt64', 'Q'),
+        ('channel_id', 'UInt64', 'Q'),
+        ('user_id', 'UInt64', 'Q'),
+        ('word_count', 'UInt16', 'H'),
+        ('character_count', 'UInt16', 'H'),
+        ('created_at', 'DateTime64(3)', 'q'),
+    )
+    ROW_SIZE = sum(array.array(typecode).itemsize for _, _, typecode in COLUMNS)
+    MAX_BYTES = 1024 * 1024  # Memory cap of a batch, after which it should be inserted
+    EPOCH = dt.datetime(1970, 1, 1, tzinfo=dt.timezone.utc)
+    MILLISECOND = dt.timedelta(milliseconds=1)
+
+    timezone: dt.tzinfo
+    arrays: Tuple[array.array, ...]
+
+    def __init__(self, timezone: dt.tzinfo = dt.timezone.utc):
+        self.timezone = timezone
+        self.arrays = tuple(array.array(typecode) for _, _, typecode in self.COLUMNS)
+
+    def __len__(self) -> int:
+        return len(self.arrays[0])
+
+    @property
+    def nbytes(self) -> int:
+        return len(self) * self.ROW_SIZE
+
+    @property
+    def is_full(self) -> bool:
+        return self.nbytes >= self.MAX_BYTES
+
+    def append(self, metadata: MessageMetadata):
+        ids, server_ids, channel_ids, user_ids, word_counts, character_counts, created_ats = self.arrays
+        ids.append(metadata.id)
+        server_ids.append(metadata.server_id)
+        channel_ids.append(metadata.channel_id)
+        user_ids.append(metadata.user_id)
+        word_counts.append(min(metadata.word_count, 0xFFFF))
+        character_counts.append(min(metadata.character_count, 0xFFFF))
+        created_ats.append((metadata.created_at.replace(tzinfo=self.timezone) - self.EPOCH) // self.MILLISECOND)
+
+    def extend(self, metadata_batch: Iterable[MessageMetadata]):
+        for metadata in metadata_batch:
+            self.append(metadata)
+
+    def without(self, message_ids: AbstractSet[int]) -> 'MetadataColumns':
+        if not message_ids:
+            return self
+        kept_indices = [index for index, message_id in enumerate(self.arrays[0]) if message_id not in message_ids]
+        kept = MetadataColumns(self.timezone)
+        kept.arrays = tuple(
+            array.array(column.typecode, map(column.__getitem__, kept_indices)) for column in self.arrays
+        )
+        return kept
+
+    def split(self, max_rows: int) -> Iterator['MetadataColumns']:
+        if len(self) <= max_rows:
+            yield self
+            return
+        for start in range(0, len(self), max_rows):
+            part = MetadataColumns(self.timezone)
+            part.arrays = tuple(column[start : start + max_rows] for column in self.arrays)
+            yield part
+
+    def latest_message_ids(self) -> DefaultDict[int, Dict[int, int]]:
+        """Latest message ID of each channel, by server."""
+        latest_message_ids: DefaultDict[int, Dict[int, int]] = defaultdict(dict)
+        ids, server_ids, channel_ids = self.arrays[:3]
+        for message_id, server_id, channel_id in zip(ids, server_ids, channel_ids):
+            server_latest_message_ids = latest_message_ids[server_id]
+            if message_id > server_latest_message_ids.get(channel_id, 0):
+                server_latest_message_ids[channel_id] = message_id
+        return latest_message_ids
+
+    def encode_native(self) -> bytes:
+        """The columns as a block in ClickHouse's Native format, as read over HTTP (without block info)."""
+        parts = [self._encode_varint(len(self.COLUMNS)), self._encode_varint(len(self))]
+        for (name, type_name, _), column in zip(self.COLUMNS, self.arrays):
+            parts.append(self._encode_string(name))
+            parts.append(self._encode_string(type_name))
+            if sys.byteorder == 'little':
+                parts.append(column.tobytes())
+            else:
+                column = array.array(column.typecode, column)
+                column.byteswap()
+                parts.append(column.tobytes())
+        return b''.join(parts)
+
+    @staticmethod
+    def _encode_varint(value: int) -> bytes:
+        encoded = bytearray()
+        while value >= 0x80:
+            encoded.append(value & 0x7F | 0x80)
+            value >>= 7
+        encoded.append(value)
+        return bytes(encoded)
+
+    @classmethod
+    def _encode_string(cls, value: str) -> bytes:
+        encoded = value.encode()
+        return cls._encode_varint(len(encoded)) + encoded
+
+
+class Cursor(NamedTuple):
+    """Where crawling of a channel resumes: its latest cached message (and when that was cached)."""
+
+    message_id: int
+    cached_at: dt.datetime
+
+    @classmethod
+    def parse(cls, raw: bytes) -> 'Cursor':
+        message_id, cached_at = raw.split(b':')
+        return cls(int(message_id), dt.datetime.fromtimestamp(int(cached_at)))
+
+
+class Gap(NamedTuple):
+    """Part of a channel's history missing from the cache - messages after `start_id` and before `end_id`."""
+
+    start_id: int  # The latest message cached when the gap was opened, or 0 if there wasn't any
+    end_id: int
+
+    def __str__(self) -> str:
+        return f'{self.start_id}:{self.end_id}'
+
+    @classmethod
+    def parse(cls, raw: bytes) -> 'Gap':
+        start_id, end_id = raw.split(b':')
+        return cls(int(start_id), int(end_id))
+
+    @classmethod
+    def after_cursor(cls, cursor: Optional[Cursor], end_id: int) -> 'Gap':
+        return cls(cursor.message_id if cursor is not None else 0, end_id)
+
+
 class MetadataCache(SomsiadMixin):
+    """Message metadata in ClickHouse, plus bookkeeping of which parts of channel histories it's missing.
+
+    Messages are cached live from the moment a channel is seen by this process, so the history before a channel's first
+    live message is a gap that crawling has to fill in. Gaps are stored in Redis until crawled, so that they outlive
+    restarts. Each channel also has a cursor in Redis - its latest cached message - which is where crawling resumes.
+    Cursors are advanced with every insert, and only ever forward.
+    """
+
+    GAPS_KEY = 'somsiad/metadata_cache/gaps'  # Suffixed with /<channel ID>
+    CURSORS_KEY = 'somsiad/metadata_cache/cursors'  # Suffixed with /<server ID>, channel ID -> cursor
+    CURSORS_SEEDED_FIELD = 'seeded'
+    # Activity per server, channel, user, date and hour, rolled up from message_metadata_cache by a materialized view
+    # (`source` is the table, optionally with FINAL)
+    ROLLUP_SELECT = '''
+        SELECT
+            server_id,
+            channel_id,
+            user_id,
+            toDate(created_at) AS date,
+            toHour(created_at) AS hour,
+            toInt64(count()) AS messages,
+            toInt64(sum(word_count)) AS words,
+            toInt64(sum(character_count)) AS characters,
+            min(id) AS first_message_id,
+            max(id) AS last_message_id
+        FROM {source}
+    '''
+    ROLLUP_NO_MESSAGE_ID = 0xFFFF_FFFF_FFFF_FFFF  # Neutral for the minimum of first_message_id
+    ROLLUP_MIGRATED_KEY = 'somsiad/metadata_cache/rollup_migrated'
+    ROLLUP_LOCK_NAME = 'somsiad/lock/rollup_migration'
+    ROLLUP_LOCK_TIMEOUT_SECONDS = 3 * 60 * 60
+    # While set, inserts wait, so that none slips in between listing parts to migrate and creating the view
+    ROLLUP_GATE_KEY = 'somsiad/metadata_cache/rollup_gate'
+    ROLLUP_GATE_TIMEOUT_SECONDS = 10 * 60
+    ROLLUP_GATE_POLL_INTERVAL_SECONDS = 1.0
+    ROLLUP_INSERTS_KEY = 'somsiad/metadata_cache/rollup_inserts'  # Inserts in progress by start timestamp
+    ROLLUP_INSERT_TIMEOUT_SECONDS = 5 * 60  # aiohttp's default total timeout, after which an insert can't be in flight
+    ROLLUP_MIGRATION_RETRY_INTERVAL = dt.timedelta(minutes=5)
+    # Snowflakes don't fit into Lua numbers (doubles) exactly, so they're compared as strings, first by length
+    ADVANCE_CURSORS_SCRIPT = """
+for i = 1, #ARGV, 3 do
+    local current = redis.call('HGET', KEYS[1], ARGV[i])
+    local current_id = current and string.match(current, '^%d+') or ''
+    if #current_id < #ARGV[i + 1] or (#current_id == #ARGV[i + 1] and current_id < ARGV[i + 1]) then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1] .. ':' .. ARGV[i + 2])
+    end
+end
+"""
+    INTEREST_KEY = 'somsiad/metadata_cache/interest'  # Servers by latest report, suffixed with /<server ID> - channels
+    INTEREST_TTL = dt.timedelta(days=30)
+    INSERT_QUERY = 'INSERT INTO message_metadata_cache ({}) FORMAT Native'.format(
+        ', '.join(name for name, _, _ in MetadataColumns.COLUMNS)
+    )
+    INSERT_MAX_ROWS = MetadataColumns.MAX_BYTES // MetadataColumns.ROW_SIZE
+    DEDUPLICATION_WINDOW = 1000  # Recent inserts remembered by their tokens, so that retried ones aren't applied twice
+
+    live_channel_ids: Set[int]
+    first_live_message_ids: Dict[int, int]
+    recrawled_channel_ids: Set[int]
+    pending_gap_ends: Dict[int, int]
+    crawl_locks: DefaultDict[int, asyncio.Lock]
+    timezone: dt.tzinfo
+    rollup_migrated: bool
+
+    def __init__(self, bot: Somsiad):
+        super().__init__(bot)
+        self.live_channel_ids = set()  # Channels whose new messages are cached live by this process
+        self.first_live_message_ids = {}
+        # Channels whose crawl failed part way, so messages crawled again may be cached already without the crawl state
+        # saying so - until crawled successfully
+        self.recrawled_channel_ids = set()
+        self.pending_gap_ends = {}  # Gaps of live channels whose first messages haven't been inserted yet
+        self.crawl_locks = defaultdict(asyncio.Lock)  # So that reports and backfill don't crawl a channel together
+        self.timezone = dt.timezone.utc  # The ClickHouse server's, set when preparing
+        self.rollup_migrated = False
+        # Checking which messages are cached and inserting the rest must not interleave with another such insert
+        self._insert_lock = asyncio.Lock()
+
     async def prepare(self):
         await self.bot.ch_client.execute(
             '''
@@ -87,197 +352,528 @@ class MetadataCache(SomsiadMixin):
             PARTITION BY (server_id,)
         '''
         )
-
-    async def insert(self, metadata_batch: Sequence[MessageMetadata]):
-        try:
-            await self.bot.ch_client.execute(
-                "INSERT INTO message_metadata_cache VALUES",
-                *map(dataclasses.astuple, metadata_batch),
-            )
-        except (aiohttp.ClientOSError, aiohttp.ServerDisconnectedError):
-            # Retry once
-            await self.bot.ch_client.execute(
-                "INSERT INTO message_metadata_cache VALUES",
-                *map(dataclasses.astuple, metadata_batch),
-            )
-
-    async def fetch_edge_message(
-        self,
-        *,
-        server_id: int,
-        channel_id: Optional[int] = None,
-        user_id: Optional[int] = None,
-        after: Optional[dt.datetime] = None,
-        latest: bool,
-    ) -> Optional[MessageMetadata]:
-        constraints, params = self._build_constraints_and_params(
-            server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
+        await self.bot.ch_client.execute(
+            f'''
+            ALTER TABLE message_metadata_cache
+            MODIFY SETTING non_replicated_deduplication_window = {self.DEDUPLICATION_WINDOW}
+        '''
         )
-        order_part = f'id {"DESC" if latest else "ASC"}'
-        where_part = self._build_where(constraints, params)
-        row = await self.bot.ch_client.fetchrow(
+        self.timezone = zoneinfo.ZoneInfo(await self.bot.ch_client.fetchval('SELECT timezone()'))
+        await self.bot.ch_client.execute(
+            '''
+            CREATE TABLE IF NOT EXISTS message_activity_rollup (
+                server_id UInt64,
+                channel_id UInt64,
+                user_id UInt64,
+                date Date,
+                hour UInt8,
+                messages SimpleAggregateFunction(sum, Int64),
+                words SimpleAggregateFunction(sum, Int64),
+                characters SimpleAggregateFunction(sum, Int64),
+                first_message_id SimpleAggregateFunction(min, UInt64),
+                last_message_id SimpleAggregateFunction(max, UInt64)
+            ) ENGINE = AggregatingMergeTree
+            ORDER BY (server_id, channel_id, user_id, date, hour)
+            PARTITION BY toYear(date)
+        '''
+        )
+        await self.bot.ch_client.execute(
             f'''
-            SELECT * FROM message_metadata_cache
-            WHERE {where_part}
-            ORDER BY {order_part}
-            LIMIT 1
-        ''',
-            params=params,
+            ALTER TABLE message_activity_rollup
+            MODIFY SETTING non_replicated_deduplication_window = {self.DEDUPLICATION_WINDOW}
+        '''
         )
-        return None if row is None else MessageMetadata(**row)
 
-    async def fetch_activity_by_hour(
-        self,
-        *,
-        server_id: int,
-        channel_id: Optional[int] = None,
-        user_id: Optional[int] = None,
-        after: Optional[dt.datetime] = None,
-    ) -> List[Record]:
-        constraints, params = self._build_constraints_and_params(
-            server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
-        )
-        where_part = self._build_where(constraints, params)
-        rows = await self.bot.ch_client.fetch(
+    async def is_rollup_migrated(self) -> bool:
+        if not self.rollup_migrated:
+            self.rollup_migrated = bool(await async_redis_connection.exists(self.ROLLUP_MIGRATED_KEY))
+        return self.rollup_migrated
+
+    async def run_rollup_migration(self):
+        """Migrate the rollup, retrying until this or another worker of the cluster has done so."""
+        while not await self.is_rollup_migrated():
+            try:
+                await self.migrate_rollup()
+            except Exception as e:
+                self.bot.register_error('metadata_cache_rollup_migration', e)
+            if not self.rollup_migrated:
+                await asyncio.sleep(self.ROLLUP_MIGRATION_RETRY_INTERVAL.total_seconds())
+
+    async def migrate_rollup(self):
+        """Create the materialized view feeding the rollup, and backfill the rollup with messages cached until then.
+
+        Inserts are held off (see `_rollup_gate`) from listing parts until the view exists, so that each message is
+        either in a listed part or goes through the view. Merges are stopped for the duration, so that listed parts
+        stay as they are. Until the rollup is migrated, reports are computed from message_metadata_cache directly.
+        """
+        if await self.is_rollup_migrated():
+            return
+        lock = async_redis_connection.lock(self.ROLLUP_LOCK_NAME, timeout=self.ROLLUP_LOCK_TIMEOUT_SECONDS)
+        if not await lock.acquire(blocking=False):
+            return  # Another worker of the cluster is migrating
+        try:
+            if await self.is_rollup_migrated():
+                return
+            # Start over if a previous attempt was interrupted
+            await self.bot.ch_client.execute('DROP VIEW IF EXISTS message_activity_rollup_view')
+            await self.bot.ch_client.execute('TRUNCATE TABLE message_activity_rollup')
+            await self.bot.ch_client.execute('SYSTEM STOP MERGES message_metadata_cache')
+            try:
+                await async_redis_connection.set(self.ROLLUP_GATE_KEY, 1, ex=self.ROLLUP_GATE_TIMEOUT_SECONDS)
+                try:
+                    await self._wait_for_rollup_inserts()
+                    parts = [
+                        row['name']
+                        for row in await self.bot.ch_client.fetch(
+                            '''
+                            SELECT name FROM system.parts
+                            WHERE database = currentDatabase() AND table = 'message_metadata_cache' AND active
+                        '''
+                        )
+                    ]
+                    await self.bot.ch_client.execute(
+                        f'''
+                        CREATE MATERIALIZED VIEW message_activity_rollup_view TO message_activity_rollup AS
+                        {self.ROLLUP_SELECT.format(source='message_metadata_cache')}
+                        GROUP BY server_id, channel_id, user_id, date, hour
+                    '''
+                    )
+                finally:
+                    await async_redis_connection.delete(self.ROLLUP_GATE_KEY)
+                if parts:
+                    # FINAL, as a message may be in several parts until they're merged
+                    await self.bot.ch_client.execute(
+                        f'''
+                        INSERT INTO message_activity_rollup
+                        {self.ROLLUP_SELECT.format(source='message_metadata_cache FINAL')}
+                        WHERE _part IN {{parts}}
+                        GROUP BY server_id, channel_id, user_id, date, hour
+                    ''',
+                        params={'parts': parts},
+                    )
+            finally:
+                await self.bot.ch_client.execute('SYSTEM START MERGES message_metadata_cache')
+            await async_redis_connection.set(self.ROLLUP_MIGRATED_KEY, dt.datetime.now().isoformat())
+            self.rollup_migrated = True
+        finally:
+            await lock.release()
+
+    async def _wait_for_rollup_inserts(self):
+        while True:
+            stale_before = dt.datetime.now().timestamp() - self.ROLLUP_INSERT_TIMEOUT_SECONDS
+            await async_redis_connection.zremrangebyscore(self.ROLLUP_INSERTS_KEY, '-inf', stale_before)
+            if not await async_redis_connection.zcard(self.ROLLUP_INSERTS_KEY):
+                return
+            await asyncio.sleep(self.ROLLUP_GATE_POLL_INTERVAL_SECONDS)
+
+    @contextlib.asynccontextmanager
+    async def _rollup_gate(self):
+        """Until the rollup is migrated, writes register themselves in Redis and wait while the migration's gate is set.
+
+        A write registers before checking the gate, and the migration sets the gate before checking registrations, so
+        either the write waits for the gate or the migration waits for the write.
+        """
+        if await self.is_rollup_migrated():
+            yield
+            return
+        insert_id = uuid.uuid4().hex
+        while True:
+            await async_redis_connection.zadd(self.ROLLUP_INSERTS_KEY, {insert_id: dt.datetime.now().timestamp()})
+            if not await async_redis_connection.exists(self.ROLLUP_GATE_KEY):
+                break
+            await async_redis_connection.zrem(self.ROLLUP_INSERTS_KEY, insert_id)
+            await asyncio.sleep(self.ROLLUP_GATE_POLL_INTERVAL_SECONDS)
+        try:
+            yield
+        finally:
+            await async_redis_connection.zrem(self.ROLLUP_INSERTS_KEY, insert_id)
+
+    async def retract_from_rollup(self, message_ids: Sequence[int], *, deduplication_token: str):
+        """Subtract cached messages from the rollup, before they're replaced (edits) or removed (deletions).
+
+        `deduplication_token` must identify the retracted versions of the messages, so that a retraction retried after
+        a failure further along isn't applied twice.
+        """
+        async with self._rollup_gate():
+            await self._retract_from_rollup(message_ids, deduplication_token)
+
+    async def _retract_from_rollup(self, message_ids: Sequence[int], deduplication_token: str):
+        await self.bot.ch_client.execute(
             f'''
-            SELECT COUNT(*) AS message_count, hour
-            FROM message_metadata_cache
-            WHERE {where_part}
-            GROUP BY hour
-            ORDER BY hour
+            INSERT INTO message_activity_rollup
+            SELECT
+                server_id,
+                channel_id,
+                user_id,
+                toDate(created_at) AS date,
+                toHour(created_at) AS hour,
+                -toInt64(count()),
+                -toInt64(sum(word_count)),
+                -toInt64(sum(character_count)),
+                toUInt64({self.ROLLUP_NO_MESSAGE_ID}),
+                toUInt64(0)
+            FROM message_metadata_cache FINAL
+            WHERE id IN {{ids}}
+            GROUP BY server_id, channel_id, user_id, date, hour
+            SETTINGS insert_deduplication_token = {{deduplication_token}}
         ''',
-            params=params,
+            params={'ids': list(message_ids), 'deduplication_token': deduplication_token},
         )
-        return rows
 
-    async def fetch_activity_by_weekday(
-        self,
-        *,
-        server_id: int,
-        channel_id: Optional[int] = None,
-        user_id: Optional[int] = None,
-        after: Optional[dt.datetime] = None,
-    ) -> List[Record]:
-        constraints, params = self._build_constraints_and_params(
-            server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
-        )
-        where_part = self._build_where(constraints, params)
+    def new_columns(self) -> MetadataColumns:
+        return MetadataColumns(self.timezone)
+
+    async def insert(self, columns: MetadataColumns, *, possibly_cached_ids: AbstractSet[int] = frozenset()):
+        """Insert metadata in Native format, compressed, at most `INSERT_MAX_ROWS` rows at a time.
+
+        message_metadata_cache is a ReplacingMergeTree, but the rollup's view sees every inserted row, so messages which
+        may be cached already - `possibly_cached_ids` (edits, retried flushes) and messages of `recrawled_channel_ids` -
+        are reconciled first: unchanged ones are skipped, while changed ones are retracted from the rollup before being
+        inserted anew. Other messages are assumed not to be cached, which saves a read on every insert. Each part is
+        sent with a deduplication token, so that retrying it after a lost response can't insert it twice.
+        """
+        ids, channel_ids = columns.arrays[0], columns.arrays[2]
+        reconciled_ids = {
+            message_id
+            for message_id, channel_id in zip(ids, channel_ids)
+            if message_id in possibly_cached_ids or channel_id in self.recrawled_channel_ids
+        }
+        if reconciled_ids:
+            async with self._insert_lock, self._rollup_gate():
+                await self._insert_parts(columns.without(await self._reconcile(columns, reconciled_ids)))
+        else:
+            async with self._rollup_gate():
+                await self._insert_parts(columns)
+        for server_id, server_latest_message_ids in columns.latest_message_ids().items():
+            await self._advance_cursors(server_id, server_latest_message_ids)
+
+    async def _reconcile(self, columns: MetadataColumns, reconciled_ids: AbstractSet[int]) -> Set[int]:
+        """Retract changed versions of the messages from the rollup, returning IDs of unchanged ones, to be skipped."""
+        cached_versions = await self._fetch_cached_versions(columns, reconciled_ids)
+        unchanged_ids = set()
+        changed_versions = []
+        ids, word_counts, character_counts = columns.arrays[0], columns.arrays[4], columns.arrays[5]
+        for message_id, word_count, character_count in zip(ids, word_counts, character_counts):
+            cached_version = cached_versions.get(message_id)
+            if cached_version == (word_count, character_count):
+                unchanged_ids.add(message_id)
+            elif cached_version is not None:
+                changed_versions.append((message_id, *cached_version))
+        if changed_versions:
+            changed_versions.sort()
+            await self._retract_from_rollup(
+                [message_id for message_id, _, _ in changed_versions],
+                f'retract-{hashlib.blake2b(repr(changed_versions).encode()).hexdigest()}',
+            )
+        return unchanged_ids
+
+    async def _insert_parts(self, columns: MetadataColumns):
+        for part in columns.split(self.INSERT_MAX_ROWS):
+            if not part:
+                continue
+            data = gzip.compress(part.encode_native(), compresslevel=1)
+            deduplication_token = uuid.uuid4().hex
+            try:
+                await self._post_insert(data, deduplication_token)
+            except (aiohttp.ClientOSError, aiohttp.ServerDisconnectedError):
+                # Retry once
+                await self._post_insert(data, deduplication_token)
+
+    async def _fetch_cached_versions(
+        self, columns: MetadataColumns, message_ids: AbstractSet[int]
+    ) -> Dict[int, Tuple[int, int]]:
+        """Word and character counts of those of the messages which are already cached."""
+        ids, server_ids = columns.arrays[:2]
+        reconciled_server_ids = {
+            server_id for message_id, server_id in zip(ids, server_ids) if message_id in message_ids
+        }
         rows = await self.bot.ch_client.fetch(
-            f'''
-            SELECT COUNT(*) AS message_count, weekday
-            FROM message_metadata_cache
-            WHERE {where_part}
-            GROUP BY weekday
-            ORDER BY weekday
+            '''
+            SELECT id, word_count, character_count FROM message_metadata_cache FINAL
+            WHERE server_id IN {server_ids} AND id IN {ids}
         ''',
-            params=params,
+            params={'server_ids': sorted(reconciled_server_ids), 'ids': sorted(message_ids)},
+        )
+        return {row['id']: (row['word_count'], row['character_count']) for row in rows}
+
+    async def _post_insert(self, data: bytes, deduplication_token: str):
+        ch_client = self.bot.ch_client
+        async with self.bot.session.post(
+            ch_client.url,
+            params={**ch_client.params, 'query': self.INSERT_QUERY, 'insert_deduplication_token': deduplication_token},
+            headers={**ch_client.headers, 'Content-Encoding': 'gzip'},
+            data=data,
+        ) as response:
+            if response.status != 200:
+                raise ChClientError((await response.read()).decode(errors='replace'))
+
+    async def delete(self, message_ids: Sequence[int]):
+        await self.bot.ch_client.execute(
+            'ALTER TABLE message_metadata_cache DELETE WHERE id IN {ids}', params={'ids': list(message_ids)}
         )
-        return rows
 
-    async def fetch_activity_by_date(
-        self,
-        *,
-        server_id: int,
-        channel_id: Optional[int] = None,
-        user_id: Optional[int] = None,
-        after: Optional[dt.datetime] = None,
-    ) -> List[Record]:
-        constraints, params = self._build_constraints_and_params(
-            server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
+    def mark_live(self, channel_id: int, first_message_id: int):
+        """Note that messages of the channel are cached live from now on, opening a gap before the first one."""
+        self.live_channel_ids.add(channel_id)
+        self.first_live_message_ids[channel_id] = first_message_id
+        self.pending_gap_ends[channel_id] = first_message_id
+
+    async def open_pending_gaps(self, server_id_by_channel_id: Dict[int, int]):
+        """Persist gaps of the channels, which must happen before their first live messages are inserted."""
+        gap_ends = {
+            channel_id: self.pending_gap_ends[channel_id]
+            for channel_id in server_id_by_channel_id
+            if channel_id in self.pending_gap_ends
+        }
+        if not gap_ends:
+            return
+        cursors: Dict[int, Cursor] = {}
+        for server_id in {server_id_by_channel_id[channel_id] for channel_id in gap_ends}:
+            cursors.update(await self.fetch_cursors(server_id))
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            for channel_id, gap_end in gap_ends.items():
+                pipeline.sadd(f'{self.GAPS_KEY}/{channel_id}', str(Gap.after_cursor(cursors.get(channel_id), gap_end)))
+            await pipeline.execute()
+        for channel_id, gap_end in gap_ends.items():
+            if self.pending_gap_ends.get(channel_id) == gap_end:
+                del self.pending_gap_ends[channel_id]
+
+    async def open_gap(self, channel_id: int, gap: Gap):
+        await async_redis_connection.sadd(f'{self.GAPS_KEY}/{channel_id}', str(gap))
+
+    async def fetch_gaps_by_channel(
+        self, channel_ids: Sequence[int], cursors: Dict[int, Cursor]
+    ) -> Dict[int, List[Gap]]:
+        """Gaps of the channels, oldest first. `cursors` are needed for gaps that haven't been persisted yet."""
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            for channel_id in channel_ids:
+                pipeline.smembers(f'{self.GAPS_KEY}/{channel_id}')
+            results = await pipeline.execute()
+        gaps_by_channel = {}
+        for channel_id, persisted_gaps in zip(channel_ids, results):
+            gaps = {Gap.parse(gap) for gap in persisted_gaps}
+            if channel_id in self.pending_gap_ends:
+                gaps.add(Gap.after_cursor(cursors.get(channel_id), self.pending_gap_ends[channel_id]))
+            gaps_by_channel[channel_id] = sorted(gaps, key=lambda gap: gap.end_id)
+        return gaps_by_channel
+
+    async def has_gap(self, channel_id: int, gap: Gap) -> bool:
+        return self.pending_gap_ends.get(channel_id) == gap.end_id or await async_redis_connection.sismember(
+            f'{self.GAPS_KEY}/{channel_id}', str(gap)
         )
-        where_part = self._build_where(constraints, params)
+
+    async def close_gap(self, channel_id: int, gap: Gap):
+        await async_redis_connection.srem(f'{self.GAPS_KEY}/{channel_id}', str(gap))
+        if self.pending_gap_ends.get(channel_id) == gap.end_id:
+            # The gap's been crawled before it got persisted, so it needn't be anymore
+            del self.pending_gap_ends[channel_id]
+
+    async def move_gap_end(self, channel_id: int, gap: Gap, new_end_id: int) -> Gap:
+        """Shrink a gap whose newest part has been crawled."""
+        new_gap = Gap(gap.start_id, new_end_id)
+        async with async_redis_connection.pipeline(transaction=True) as pipeline:
+            pipeline.srem(f'{self.GAPS_KEY}/{channel_id}', str(gap))
+            pipeline.sadd(f'{self.GAPS_KEY}/{channel_id}', str(new_gap))
+            await pipeline.execute()
+        if self.pending_gap_ends.get(channel_id) == gap.end_id:
+            del self.pending_gap_ends[channel_id]
+        return new_gap
+
+    async def fetch_cursors(self, server_id: int) -> Dict[int, Cursor]:
+        """Cursors of all channels of the server, in one query.
+
+        Servers cached before cursors were introduced get theirs seeded from ClickHouse once.
+        """
+        cursors_key = f'{self.CURSORS_KEY}/{server_id}'
+        raw_cursors = await async_redis_connection.hgetall(cursors_key)
+        if self.CURSORS_SEEDED_FIELD.encode() not in raw_cursors:
+            latest_message_ids = await self.fetch_latest_message_ids(server_id)
+            await self._advance_cursors(server_id, latest_message_ids, seeded=True)
+            raw_cursors = await async_redis_connection.hgetall(cursors_key)
+        return {
+            int(channel_id): Cursor.parse(raw_cursor)
+            for channel_id, raw_cursor in raw_cursors.items()
+            if channel_id != self.CURSORS_SEEDED_FIELD.encode()
+        }
+
+    async def fetch_crawl_state(self, server_id: int, channel_id: int) -> Tuple[Optional[Cursor], List[Gap]]:
+        """The channel's cursor and gaps, which are enough to crawl everything it's missing."""
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            pipeline.hget(f'{self.CURSORS_KEY}/{server_id}', channel_id)
+            pipeline.hexists(f'{self.CURSORS_KEY}/{server_id}', self.CURSORS_SEEDED_FIELD)
+            raw_cursor, seeded = await pipeline.execute()
+        if seeded:
+            cursor = Cursor.parse(raw_cursor) if raw_cursor is not None else None
+        else:
+            cursor = (await self.fetch_cursors(server_id)).get(channel_id)
+        gaps = (await self.fetch_gaps_by_channel([channel_id], {channel_id: cursor} if cursor else {}))[channel_id]
+        return cursor, gaps
+
+    async def _advance_cursors(self, server_id: int, latest_message_ids: Dict[int, int], *, seeded: bool = False):
+        arguments: List[Union[int, str]] = []
+        crawled_at = int(dt.datetime.now().timestamp())
+        for channel_id, message_id in latest_message_ids.items():
+            arguments.extend((channel_id, message_id, crawled_at))
+        if not arguments and not seeded:
+            return
+        async with async_redis_connection.pipeline(transaction=True) as pipeline:
+            if arguments:
+                pipeline.eval(self.ADVANCE_CURSORS_SCRIPT, 1, f'{self.CURSORS_KEY}/{server_id}', *arguments)
+            if seeded:
+                pipeline.hset(f'{self.CURSORS_KEY}/{server_id}', self.CURSORS_SEEDED_FIELD, crawled_at)
+            await pipeline.execute()
+
+    async def record_interest(self, server_id: int, channel_ids: Sequence[int]):
+        now = dt.datetime.now().timestamp()
+        server_interest_key = f'{self.INTEREST_KEY}/{server_id}'
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            pipeline.zadd(self.INTEREST_KEY, {str(server_id): now})
+            pipeline.expire(self.INTEREST_KEY, self.INTEREST_TTL)
+            if channel_ids:
+                pipeline.zadd(server_interest_key, {str(channel_id): now for channel_id in channel_ids})
+                pipeline.expire(server_interest_key, self.INTEREST_TTL)
+            await pipeline.execute()
+
+    async def fetch_interest(self, server_ids: Sequence[int]) -> Tuple[Dict[int, float], Dict[int, float]]:
+        """Timestamps of the latest reports involving the servers and their channels."""
+        async with async_redis_connection.pipeline(transaction=False) as pipeline:
+            pipeline.zrange(self.INTEREST_KEY, 0, -1, withscores=True)
+            for server_id in server_ids:
+                pipeline.zrange(f'{self.INTEREST_KEY}/{server_id}', 0, -1, withscores=True)
+            results = await pipeline.execute()
+        server_interest = {int(server_id): score for server_id, score in results[0]}
+        channel_interest = {
+            int(channel_id): score for server_channels in results[1:] for channel_id, score in server_channels
+        }
+        return server_interest, channel_interest
+
+    async def fetch_latest_message_ids(self, server_id: int) -> Dict[int, int]:
         rows = await self.bot.ch_client.fetch(
-            f'''
-            SELECT COUNT(*) AS message_count, date
+            '''
+            SELECT channel_id, max(id) AS latest_id
             FROM message_metadata_cache
-            WHERE {where_part}
-            GROUP BY date
-            ORDER BY date
+            WHERE server_id = {server_id}
+            GROUP BY channel_id
         ''',
-            params=params,
+            params={'server_id': server_id},
         )
-        return rows
+        return {row['channel_id']: row['latest_id'] for row in rows}
 
-    async def fetch_total_counts(
+    async def fetch_edge_message(
         self,
         *,
         server_id: int,
         channel_id: Optional[int] = None,
         user_id: Optional[int] = None,
         after: Optional[dt.datetime] = None,
-    ) -> Record:
-        constraints, params = self._build_constraints_and_params(
-            server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
-        )
-        where_part = self._build_where(constraints, params)
+        latest: bool,
+        edge_message_id: Optional[int] = None,
+    ) -> Optional[MessageMetadata]:
+        """The first or last message matching the constraints, with its ID looked up in the rollup unless known."""
+        if edge_message_id is None and not await self.is_rollup_migrated():
+            return await self._fetch_edge_message_by_scan(
+                server_id=server_id, channel_id=channel_id, user_id=user_id, after=after, latest=latest
+            )
+        if edge_message_id is None:
+            where_part, params = self._build_rollup_where(
+                server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
+            )
+            edge_message_id = await self.bot.ch_client.fetchval(
+                f'''
+                SELECT {"max(last_message_id)" if latest else "min(first_message_id)"}
+                FROM message_activity_rollup
+                WHERE {where_part}
+            ''',
+                params=params,
+            )
+        if not edge_message_id or edge_message_id == self.ROLLUP_NO_MESSAGE_ID:
+            return None
         row = await self.bot.ch_client.fetchrow(
-            f'''
-            SELECT
-                COUNT(*) AS total_message_count,
-                SUM(word_count) AS total_word_count,
-                SUM(character_count) AS total_character_count
-            FROM message_metadata_cache
-            WHERE {where_part}
+            '''
+            SELECT * FROM message_metadata_cache
+            WHERE server_id = {server_id} AND id = {id}
+            LIMIT 1
         ''',
-            params=params,
+            params={'server_id': server_id, 'id': edge_message_id},
         )
-        return row
+        if row is None:  # Edge message deleted, which the rollup's minimum and maximum can't reflect
+            return await self._fetch_edge_message_by_scan(
+                server_id=server_id, channel_id=channel_id, user_id=user_id, after=after, latest=latest
+            )
+        return MessageMetadata(**row)
 
-    async def fetch_users_ranking(
+    async def _fetch_edge_message_by_scan(
         self,
         *,
         server_id: int,
         channel_id: Optional[int] = None,
         user_id: Optional[int] = None,
         after: Optional[dt.datetime] = None,
-    ) -> List[Record]:
+        latest: bool,
+    ) -> Optional[MessageMetadata]:
         constraints, params = self._build_constraints_and_params(
             server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
         )
+        order_part = f'id {"DESC" if latest else "ASC"}'
         where_part = self._build_where(constraints, params)
-        rows = await self.bot.ch_client.fetch(
+        row = await self.bot.ch_client.fetchrow(
             f'''
-            SELECT
-                COUNT(*) AS message_count,
-                SUM(word_count) AS word_count,
-                SUM(character_count) AS character_count,
-                user_id
-            FROM message_metadata_cache
+            SELECT * FROM message_metadata_cache
             WHERE {where_part}
-            GROUP BY user_id
-            ORDER BY message_count DESC
+            ORDER BY {order_part}
+            LIMIT 1
         ''',
             params=params,
         )
-        return rows
+        return None if row is None else MessageMetadata(**row)
 
-    async def fetch_channels_ranking(
+    async def fetch_activity_summary(
         self,
         *,
         server_id: int,
-        channel_id: Optional[int] = None,
-        user_id: Optional[int] = None,
+        channel_id: Optional[Union[int, Sequence[int]]] = None,
+        user_id: Optional[Union[int, Sequence[int]]] = None,
         after: Optional[dt.datetime] = None,
-    ) -> List[Record]:
-        constraints, params = self._build_constraints_and_params(
-            server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
-        )
-        where_part = self._build_where(constraints, params)
-        rows = await self.bot.ch_client.fetch(
+    ) -> Record:
+        """Totals, hour/weekday/date histograms, user and channel rankings, and edge message IDs - in a single pass.
+
+        Histograms and rankings are `sumMap` aggregations, i.e. tuples of a key array and value arrays. Until the rollup
+        is migrated, it's computed on the fly from message_metadata_cache.
+        """
+        if await self.is_rollup_migrated():
+            source = 'message_activity_rollup'
+            where_part, params = self._build_rollup_where(
+                server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
+            )
+        else:
+            constraints, params = self._build_constraints_and_params(
+                server_id=server_id, channel_id=channel_id, user_id=user_id, after=after
+            )
+            source = f'''(
+                {self.ROLLUP_SELECT.format(source='message_metadata_cache FINAL')}
+                WHERE {self._build_where(constraints, params)}
+                GROUP BY server_id, channel_id, user_id, date, hour
+            )'''
+            where_part = '1'
+        row = await self.bot.ch_client.fetchrow(
             f'''
             SELECT
-                COUNT(*) AS message_count,
-                SUM(word_count) AS word_count,
-                SUM(character_count) AS character_count,
-                channel_id
-            FROM message_metadata_cache
+                sum(messages) AS total_message_count,
+                sum(words) AS total_word_count,
+                sum(characters) AS total_character_count,
+                min(first_message_id) AS first_message_id,
+                max(last_message_id) AS last_message_id,
+                sumMap([hour], [messages]) AS activity_by_hour,
+                sumMap([toUInt8(toDayOfWeek(date) - 1)], [messages]) AS activity_by_weekday,
+                sumMap([date], [messages]) AS activity_by_date,
+                sumMap([user_id], [messages], [words], [characters]) AS users_ranking,
+                sumMap([channel_id], [messages], [words], [characters]) AS channels_ranking
+            FROM {source}
             WHERE {where_part}
-            GROUP BY channel_id
-            ORDER BY message_count DESC
         ''',
             params=params,
         )
-        return rows
+        return row
 
     @staticmethod
     def _build_constraints_and_params(
@@ -304,6 +900,370 @@ class MetadataCache(SomsiadMixin):
     def _build_where(constraints: Dict[str, str], params: Dict[str, Any]) -> str:
         return ' AND '.join((f'{column} {operator} {{{column}}}' for column, operator in constraints.items()))
 
+    @classmethod
+    def _build_rollup_where(
+        cls,
+        *,
+        server_id: int,
+        channel_id: Optional[Union[int, Sequence[int]]] = None,
+        user_id: Optional[Union[int, Sequence[int]]] = None,
+        after: Optional[dt.datetime] = None,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """The rollup is hourly, so `after` is rounded down to the hour (reports only ever pass midnight anyway)."""
+        constraints, params = cls._build_constraints_and_params(
+            server_id=server_id, channel_id=channel_id, user_id=user_id
+        )
+        where_part = cls._build_where(constraints, params)
+        if after is not None:
+            where_part += ' AND (date, hour) >= ({after_date}, {after_hour})'
+            params['after_date'] = after.date()
+            params['after_hour'] = after.hour
+        return where_part, params
+
+
+class MetadataIngestion(SomsiadMixin):
+    """Write-behind buffer caching metadata of messages as they are sent, edited and deleted.
+
+    Metadata is inserted in bulk every `FLUSH_INTERVAL_SECONDS` or as soon as `FLUSH_MAX_ROWS` messages accumulate.
+    Deletions are ClickHouse mutations, which rewrite whole parts, so they are batched for much longer. Edits are only
+    applied to messages cached live by this process, as older ones may be in a gap that is yet to be crawled. Edited
+    messages and ones of failed flushes are reconciled with the rollup by `MetadataCache.insert`, while deleted ones are
+    retracted from it before being deleted, as its materialized view only sees inserts.
+    """
+
+    FLUSH_INTERVAL_SECONDS = 5.0
+    FLUSH_MAX_ROWS = 1000
+    DELETION_FLUSH_INTERVAL = dt.timedelta(minutes=10)
+
+    metadata_by_id: Dict[int, MessageMetadata]
+    possibly_cached_ids: Set[int]
+    deleted_ids: Set[int]
+    failed_deletion_batches: List[List[int]]
+    live_since: Dict[int, int]
+
+    def __init__(self, bot: Somsiad, metadata_cache: MetadataCache):
+        super().__init__(bot)
+        self.metadata_cache = metadata_cache
+        self.metadata_by_id = {}  # Keyed by message ID, so that edits before a flush replace the original
+        self.possibly_cached_ids = set()  # Edited messages and ones of failed flushes
+        self.deleted_ids = set()
+        self.failed_deletion_batches = []
+        self.live_since = {}  # ID of the first message cached live in each channel
+        self._deletions_flushed_at = dt.datetime.now()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def add(self, message: discord.Message):
+        if not isinstance(message.channel, discord.TextChannel) or message.type != discord.MessageType.default:
+            return
+        if message.author.id in data_processing_opt_outs:
+            return  # User opted out of data processing
+        channel_id = message.channel.id
+        if channel_id not in self.live_since:
+            self.live_since[channel_id] = message.id
+            self.metadata_cache.mark_live(channel_id, message.id)
+        elif message.id < self.live_since[channel_id]:
+            return  # Edit of a message from before live caching started
+        self.metadata_by_id[message.id] = MessageMetadata.from_message(message)
+        if len(self.metadata_by_id) >= self.FLUSH_MAX_ROWS and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = self.bot.loop.create_task(self.flush())
+
+    def add_edit(self, payload: discord.RawMessageUpdateEvent):
+        if payload.channel_id not in self.live_since or payload.message_id < self.live_since[payload.channel_id]:
+            return
+        if 'author' not in payload.data or 'content' not in payload.data:
+            return  # Partial update, such as embeds being resolved, which comes with a full update anyway
+        channel = self.bot.get_channel(payload.channel_id)
+        if isinstance(channel, discord.TextChannel):
+            self.possibly_cached_ids.add(payload.message_id)
+            self.add(discord.Message(state=channel._state, channel=channel, data=payload.data))
+
+    def remove(self, message_ids: Set[int]):
+        for message_id in message_ids:
+            self.metadata_by_id.pop(message_id, None)
+            self.possibly_cached_ids.discard(message_id)
+        self.deleted_ids.update(message_ids)
+
+    async def flush(self, *, include_deletions: bool = False):
+        metadata_batch = [
+            metadata for metadata in self.metadata_by_id.values() if metadata.user_id not in data_processing_opt_outs
+        ]
+        self.metadata_by_id = {}
+        possibly_cached_ids, self.possibly_cached_ids = self.possibly_cached_ids, set()
+        try:
+            if metadata_batch:
+                await self.metadata_cache.open_pending_gaps(
+                    {metadata.channel_id: metadata.server_id for metadata in metadata_batch}
+                )
+                columns = self.metadata_cache.new_columns()
+                columns.extend(metadata_batch)
+                await self.metadata_cache.insert(columns, possibly_cached_ids=possibly_cached_ids)
+        except Exception as e:
+            if len(self.metadata_by_id) < self.FLUSH_MAX_ROWS:
+                for metadata in metadata_batch:  # Try again with the next flush
+                    self.metadata_by_id.setdefault(metadata.id, metadata)
+                    self.possibly_cached_ids.add(metadata.id)  # Some parts may have been inserted before the failure
+            self.bot.register_error('metadata_ingestion_flush', e)
+        now = dt.datetime.now()
+        if (self.deleted_ids or self.failed_deletion_batches) and (
+            include_deletions or now - self._deletions_flushed_at >= self.DELETION_FLUSH_INTERVAL
+        ):
+            deletion_batches = self.failed_deletion_batches
+            if self.deleted_ids:
+                deletion_batches.append(sorted(self.deleted_ids))
+            self.deleted_ids, self.failed_deletion_batches = set(), []
+            self._deletions_flushed_at = now
+            for deleted_ids in deletion_batches:
+                try:
+                    # A message is only deleted once, so the batch's IDs identify its retraction
+                    await self.metadata_cache.retract_from_rollup(
+                        deleted_ids,
+                        deduplication_token=f'delete-{hashlib.blake2b(repr(deleted_ids).encode()).hexdigest()}',
+                    )
+                    await self.metadata_cache.delete(deleted_ids)
+                except Exception as e:
+                    # Try again with the next flush, as the same batch so that it's not retracted twice
+                    self.failed_deletion_batches.append(deleted_ids)
+                    self.bot.register_error('metadata_ingestion_flush', e)
+
+    async def flush_all(self):
+        await self.flush(include_deletions=True)
+
+
+class MetadataBackfill(SomsiadMixin):
+    """Background crawler filling in gaps of the metadata cache during off-peak hours, so that reports rarely have to.
+
+    Gaps are crawled from newest to oldest a page at a time, and the gap's end is moved after each page, so crawling
+    resumes where it stopped, even after a restart, and recent history (which matters most to reports) is cached first.
+    Channels that aren't cached live have everything after their latest cached message turned into a gap first.
+    Servers, and channels within them, are crawled starting with the ones most recently reported on. Requests are
+    limited by a cluster-wide and a per-server budget, so that backfill doesn't eat into the rate limits of commands.
+    """
+
+    PAGE_SIZE = 100  # Messages per history request, the most Discord allows
+    ROUND_INTERVAL = dt.timedelta(minutes=1)  # Per-server budgets are per minute, so they're all renewed by next round
+    IDLE_INTERVAL = dt.timedelta(minutes=10)
+
+    off_peak_hours: Set[int]
+    _tail_gap_ends: Dict[int, int]
+
+    def __init__(self, bot: Somsiad, metadata_cache: MetadataCache):
+        super().__init__(bot)
+        self.metadata_cache = metadata_cache
+        self.off_peak_hours = self.parse_hours(configuration['backfill_hours'])
+        self.requests_per_minute = configuration['backfill_requests_per_minute']
+        self.requests_per_minute_per_server = configuration['backfill_requests_per_minute_per_server']
+        self._tail_gap_ends = {}  # Gaps opened for channel tails, so that each tail is only opened once
+
+    @staticmethod
+    def parse_hours(hours: str) -> Set[int]:
+        """Parse a range of hours such as "1-7" (from 1:00 until 7:00) or "22-6" (overnight) into a set of hours."""
+        start, end = (int(hour) % 24 for hour in hours.split('-'))
+        return {hour % 24 for hour in range(start, end if end > start else end + 24)}
+
+    def is_off_peak(self) -> bool:
+        return dt.datetime.now().hour in self.off_peak_hours
+
+    async def run(self):
+        while True:
+            crawled_any = False
+            if self.is_off_peak():
+                try:
+                    crawled_any = await self.backfill_round()
+                except Exception as e:
+                    self.bot.register_error('metadata_backfill', e)
+            await asyncio.sleep((self.ROUND_INTERVAL if crawled_any else self.IDLE_INTERVAL).total_seconds())
+
+    async def backfill_round(self) -> bool:
+        """Crawl as much as budgets allow, server by server. Returns whether anything was crawled."""
+        servers = list(self.bot.guilds)
+        server_interest, channel_interest = await self.metadata_cache.fetch_interest([server.id for server in servers])
+        servers.sort(key=lambda server: (server_interest.get(server.id, 0), server.member_count or 0), reverse=True)
+        crawled_any = False
+        for server in servers:
+            if not self.is_off_peak():
+                break
+            if await self._backfill_server(server, channel_interest):
+                crawled_any = True
+        return crawled_any
+
+    async def _backfill_server(self, server: discord.Guild, channel_interest: Dict[int, float]) -> bool:
+        channels = [
+            channel
+            for channel in server.text_channels
+            if (permissions := channel.permissions_for(server.me)).read_messages and permissions.read_message_history
+        ]
+        if not channels:
+            return False
+        cursors = await self.metadata_cache.fetch_cursors(server.id)
+        for channel in channels:
+            if channel.id in self.metadata_cache.live_channel_ids or channel.last_message_id is None:
+                continue
+            tail_gap = Gap.after_cursor(cursors.get(channel.id), channel.last_message_id + 1)
+            if tail_gap.start_id < channel.last_message_id and self._tail_gap_ends.get(channel.id) != tail_gap.end_id:
+                await self.metadata_cache.open_gap(channel.id, tail_gap)
+                self._tail_gap_ends[channel.id] = tail_gap.end_id
+        channels.sort(
+            key=lambda channel: (channel_interest.get(channel.id, 0), channel.last_message_id or 0), reverse=True
+        )
+        gaps_by_channel = await self.metadata_cache.fetch_gaps_by_channel([channel.id for channel in channels], cursors)
+        crawled_any = False
+        for channel in channels:
+            for gap in reversed(gaps_by_channel[channel.id]):
+                gap_left: Optional[Gap] = gap
+                while gap_left is not None:
+                    if await cooldown_buckets.retry_after(
+                        f'backfill/{server.id}', self.requests_per_minute_per_server, 60
+                    ):
+                        return crawled_any  # Server's budget is spent until next round
+                    while True:
+                        retry_after = await cooldown_buckets.retry_after('backfill', self.requests_per_minute, 60)
+                        if not retry_after:
+                            break
+                        await asyncio.sleep(retry_after)
+                    gap_left = await self._crawl_page(channel, gap_left)
+                    crawled_any = True
+                    if not self.is_off_peak():
+                        return crawled_any
+        return crawled_any
+
+    async def _crawl_page(self, channel: discord.TextChannel, gap: Gap) -> Optional[Gap]:
+        """Cache the newest page of messages of the gap, returning what's left of it (if anything)."""
+        async with self.metadata_cache.crawl_locks[channel.id]:
+            if not await self.metadata_cache.has_gap(channel.id, gap):
+                return None  # Crawled by a report in the meantime
+            try:
+                messages = [
+                    message
+                    async for message in channel.history(
+                        limit=self.PAGE_SIZE,
+                        before=discord.Object(gap.end_id),
+                        after=discord.Object(gap.start_id) if gap.start_id else None,
+                        oldest_first=False,
+                    )
+                ]
+            except discord.Forbidden:
+                return None
+            columns = self.metadata_cache.new_columns()
+            columns.extend(
+                MessageMetadata.from_message(message)
+                for message in messages
+                if message.author.id not in data_processing_opt_outs and message.type == discord.MessageType.default
+            )
+            try:
+                if columns:
+                    await self.metadata_cache.insert(columns)
+                if len(messages) < self.PAGE_SIZE:
+                    await self.metadata_cache.close_gap(channel.id, gap)
+                    gap_left = None
+                else:
+                    gap_left = await self.metadata_cache.move_gap_end(channel.id, gap, messages[-1].id)
+            except BaseException:
+                self.metadata_cache.recrawled_channel_ids.add(channel.id)  # The page may be inserted already
+                raise
+            self.metadata_cache.recrawled_channel_ids.discard(channel.id)
+            return gap_left
+
+
+class CrawlThrottle:
+    """Limit of channels crawled at once by a report, cut in half on every rate limit and raised by a bit on every
+    page fetched without one (AIMD). Rate limits also pause all crawling for an exponentially growing time.
+
+    discord.py retries 429s itself, so rate limits are learned of from its warnings (see `RateLimitLogHandler`) about
+    channels being watched.
+    """
+
+    PAGE_SIZE = 100  # Messages per history request made by discord.py
+    MAX_BACKOFF_SECONDS = 60
+
+    watchers: ClassVar[DefaultDict[int, Set['CrawlThrottle']]] = defaultdict(set)  # By channel ID
+
+    limit: float
+    active: int
+
+    def __init__(self, max_limit: int):
+        self.max_limit = max_limit
+        self.limit = float(max_limit)
+        self.active = 0
+        self._consecutive_rate_limits = 0
+        self._rate_limited_since_page = False
+        self._resume_at = 0.0
+        self._condition = asyncio.Condition()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self._wait_for_resume()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.active < int(self.limit))
+            self.active += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self.active -= 1
+                self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def watching(self, channel_id: int):
+        self.watchers[channel_id].add(self)
+        try:
+            yield
+        finally:
+            self.watchers[channel_id].discard(self)
+            if not self.watchers[channel_id]:
+                del self.watchers[channel_id]
+
+    async def page_fetched(self):
+        if self._rate_limited_since_page:
+            self._rate_limited_since_page = False
+        else:
+            self._consecutive_rate_limits = 0
+            if self.limit < self.max_limit:
+                async with self._condition:
+                    self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+                    self._condition.notify_all()
+        await self._wait_for_resume()
+
+    def rate_limited(self):
+        """Called from discord.py's request, which sleeps for the retry time - the backoff applies on top of it."""
+        self._consecutive_rate_limits += 1
+        self._rate_limited_since_page = True
+        self.limit = max(self.limit / 2, 1.0)
+        backoff = min(2 ** (self._consecutive_rate_limits - 1), self.MAX_BACKOFF_SECONDS)
+        self._resume_at = max(self._resume_at, asyncio.get_running_loop().time() + backoff)
+
+    async def _wait_for_resume(self):
+        delay = self._resume_at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class RateLimitLogHandler(logging.Handler):
+    """Passes 429s, as warned about by discord.py's HTTP client, to the throttles of crawls of the channel concerned.
+
+    Global rate limits concern all crawls.
+    """
+
+    LOGGER_NAME = 'discord.http'
+    RATE_LIMITED_PREFIX = 'We are being rate limited.'
+    GLOBAL_RATE_LIMIT_PREFIX = 'Global rate limit has been hit.'
+    CHANNEL_URL_REGEX = re.compile(r'/channels/(\d+)/')
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+
+    def emit(self, record: logging.LogRecord):
+        if not isinstance(record.msg, str):
+            return
+        if record.msg.startswith(self.GLOBAL_RATE_LIMIT_PREFIX):
+            throttles = set().union(*CrawlThrottle.watchers.values())
+        elif record.msg.startswith(self.RATE_LIMITED_PREFIX) and isinstance(record.args, tuple) and record.args[1:]:
+            match = self.CHANNEL_URL_REGEX.search(str(record.args[1]))
+            throttles = set(CrawlThrottle.watchers.get(int(match[1]), ())) if match else set()
+        else:
+            return
+        for throttle in throttles:
+            throttle.rate_limited()
+
 
 class Report:
     """A statistics report. Can generate server, channel, category or member statistics."""
@@ -312,9 +1272,8 @@ class Report:
     BACKGROUND_COLOR = '#2b2d31'
     FOREGROUND_COLOR = '#ffffff'
     ROLL = 7
-    CACHE_INSERT_BATCH_SIZE = 1000
+    CRAWL_CONCURRENCY = 4
 
-    queues: DefaultDict[int, Deque["Report"]] = defaultdict(deque)
 
     metadata_cache: MetadataCache
     ctx: commands.Context
@@ -350,8 +1309,6 @@ class Report:
     timeframe_start_date: Optional[dt.date]
     timeframe_end_date: dt.date
 
-    plt.style.use('dark_background')
-
     class Type(enum.Enum):
         SERVER = enum.auto()
         CHANNEL = enum.auto()
@@ -402,6 +1359,10 @@ class Report:
         self.subject_relevancy_length = None
         self.average_daily_message_count = None
         self.caching_progress_message = None
+        self._caching_progress_lock = asyncio.Lock()
+        self._metadata_cache_update = metadata_cache.new_columns()
+        self._metadata_cache_update_lock = asyncio.Lock()
+        self._metadata_cache_update_error: Optional[Exception] = None
         self.last_days = last_days
         if last_days:
             if last_days < 1:
@@ -417,39 +1378,12 @@ class Report:
         self.timeframe_start_date = None
         self.timeframe_end_date = self.init_datetime.date()
 
-    async def process_next_in_queue(self, server_id: int):
-        report = self.queues[server_id][0]
-        report.out_of_queue_datetime = dt.datetime.now()
-        try:
-            await report.analyze_subject()
-        except:
-            raise
-        finally:
-            self.queues[server_id].popleft()
-            if self.queues[server_id]:
-                self.bot.loop.create_task(self.process_next_in_queue(server_id))
-        if report.total_message_count:
-            await report.render_activity_chart()
-        await report.send()
-
-    async def enqueue(self):
-        server_queue = self.queues[self.ctx.guild.id]
-        self.initiated_queue_processing = not server_queue
-        server_queue.append(self)
-        if self.initiated_queue_processing:
-            await self.process_next_in_queue(self.ctx.guild.id)
-        else:
-            embed = self.bot.generate_embed(
-                '⏳', 'Zakolejkowano raport…', f'{len(server_queue)}. w serwerowej kolejce analizy.'
-            )
-            await self.bot.send(self.ctx, embed=embed)
-
     async def send(self):
         await self.bot.send(self.ctx, embed=self.embed, file=self.activity_chart_file)
 
     async def analyze_subject(self) -> discord.Embed:
         """Selects the right type of analysis depending on the subject."""
-        await self._fill_in_details()
+        await self.fill_in_details()
         existent_channels = [
             channel
             for channel in cast(discord.Guild, self.ctx.guild).text_channels
@@ -477,43 +1411,45 @@ class Report:
             constraints["user_id"] = [member.id for member in cast(discord.Role, self.subject).members]
         else:
             raise Exception(f'invalid analysis type {self.type}!')
-        for channel in existent_channels:
-            await self._update_metadata_cache(channel)
+        await self.metadata_cache.record_interest(self.ctx.guild.id, [channel.id for channel in existent_channels])
+        await self._update_metadata_cache_of_channels(existent_channels)
         if self.last_days:
             constraints["after"] = dt.datetime(
                 self.init_datetime.year, self.init_datetime.month, self.init_datetime.day
             ) - dt.timedelta(self.last_days - 1)
         await self._finalize_progress()
-        (
-            self.earliest_relevant_message,
-            self.latest_relevant_message,
-            total_counts,
-            activity_by_date,
-            activity_by_weekday,
-            activity_by_hour,
-            users_ranking,
-            channels_ranking,
-        ) = await asyncio.gather(
-            self.metadata_cache.fetch_edge_message(**constraints, latest=False),
-            self.metadata_cache.fetch_edge_message(**constraints, latest=True),
-            self.metadata_cache.fetch_total_counts(**constraints),
-            self.metadata_cache.fetch_activity_by_date(**constraints),
-            self.metadata_cache.fetch_activity_by_weekday(**constraints),
-            self.metadata_cache.fetch_activity_by_hour(**constraints),
-            self.metadata_cache.fetch_users_ranking(**constraints),
-            self.metadata_cache.fetch_channels_ranking(**constraints),
-        )
-        self.total_message_count, self.total_word_count, self.total_character_count = total_counts.values()
-        for row in activity_by_date:
-            self.messages_over_date[row["date"]] = row["message_count"]
-        for row in activity_by_weekday:
-            self.messages_over_weekday[row["weekday"]] = row["message_count"]
-        for row in activity_by_hour:
-            self.messages_over_hour[row["hour"]] = row["message_count"]
-        for row in users_ranking:
-            self.active_user_stats[row["user_id"]] = row
-        for row in channels_ranking:
-            self.relevant_channel_stats[row["channel_id"]] = row
+        summary = await self.metadata_cache.fetch_activity_summary(**constraints)
+        self.total_message_count = summary["total_message_count"]
+        self.total_word_count = summary["total_word_count"]
+        self.total_character_count = summary["total_character_count"]
+        for date, message_count in zip(*summary["activity_by_date"]):
+            self.messages_over_date[date.isoformat()] = message_count
+        for weekday, message_count in zip(*summary["activity_by_weekday"]):
+            self.messages_over_weekday[weekday] = message_count
+        for hour, message_count in zip(*summary["activity_by_hour"]):
+            self.messages_over_hour[hour] = message_count
+        for stats, ranking in (
+            (self.active_user_stats, summary["users_ranking"]),
+            (self.relevant_channel_stats, summary["channels_ranking"]),
+        ):
+            for stats_id, message_count, word_count, character_count in sorted(
+                zip(*ranking), key=lambda entry: entry[1], reverse=True
+            ):
+                if message_count > 0:  # Everything may have been retracted
+                    stats[stats_id] = {
+                        'message_count': message_count,
+                        'word_count': word_count,
+                        'character_count': character_count,
+                    }
+        if self.total_message_count > 0:
+            self.earliest_relevant_message, self.latest_relevant_message = await asyncio.gather(
+                self.metadata_cache.fetch_edge_message(
+                    **constraints, latest=False, edge_message_id=summary["first_message_id"]
+                ),
+                self.metadata_cache.fetch_edge_message(
+                    **constraints, latest=True, edge_message_id=summary["last_message_id"]
+                ),
+            )
         was_user_found = True
         if self.total_message_count > 0:
             if constraints.get("after") is not None:
@@ -536,7 +1472,26 @@ class Report:
         return cast(discord.Embed, self.embed)
 
     async def render_activity_chart(self, *, set_embed_image: bool = True) -> discord.File:
-        """Renders a graph presenting activity of or in the subject over time."""
+        """Renders a graph presenting activity of or in the subject over time.
+
+        Rendering runs in a thread, on a figure of its own (not pyplot's global state), so charts of multiple reports
+        can render at once.
+        """
+        chart_bytes, subject_identification = await asyncio.to_thread(self._render_activity_chart)
+
+        # create a Discord file and embed it
+        filename = f'activity-{subject_identification}-{self.init_datetime.strftime("%Y.%m.%dT%H.%M.%S")}.png'
+        self.activity_chart_file = discord.File(fp=chart_bytes, filename=filename)
+        if set_embed_image:
+            if self.embed is None:
+                raise Exception(
+                    'There is no report embed to save the chart to! First generate an embed with method analyze_subject() or pass set_embed_image=False to this method.'
+                )
+            self.embed.set_image(url=f'attachment://{filename}')
+
+        return self.activity_chart_file
+
+    def _render_activity_chart(self) -> Tuple[io.BytesIO, str]:
         show_by_weekday_and_date = self.subject_relevancy_length is not None and self.subject_relevancy_length > 1
         show_by_channels = True
         title = 'Aktywność'
@@ -565,7 +1520,8 @@ class Report:
 
         # initialize the chart
         subplots = 1 + 2 * show_by_weekday_and_date + show_by_channels
-        fig, ax_or_axes = plt.subplots(subplots, figsize=(12, subplots * 3))
+        fig = mfigure.Figure(figsize=(12, subplots * 3))
+        ax_or_axes = fig.subplots(subplots)
 
         # plot
         ax_by_hour = self._plot_activity_by_hour(ax_or_axes[0] if subplots > 1 else ax_or_axes)
@@ -581,27 +1537,9 @@ class Report:
 
         # save as bytes
         chart_bytes = io.BytesIO()
-        await self.bot.loop.run_in_executor(
-            None,
-            functools.partial(
-                fig.savefig, chart_bytes, facecolor=self.BACKGROUND_COLOR, edgecolor=self.FOREGROUND_COLOR
-            ),
-        )
-
-        plt.close(fig)
+        fig.savefig(chart_bytes, facecolor=self.BACKGROUND_COLOR, edgecolor=self.FOREGROUND_COLOR)
         chart_bytes.seek(0)
-
-        # create a Discord file and embed it
-        filename = f'activity-{subject_identification}-{self.init_datetime.strftime("%Y.%m.%dT%H.%M.%S")}.png'
-        self.activity_chart_file = discord.File(fp=chart_bytes, filename=filename)
-        if set_embed_image:
-            if self.embed is None:
-                raise Exception(
-                    'There is no report embed to save the chart to! First generate an embed with method analyze_subject() or pass set_embed_image=False to this method.'
-                )
-            self.embed.set_image(url=f'attachment://{filename}')
-
-        return self.activity_chart_file
+        return chart_bytes, subject_identification
 
     def _generate_relevant_embed(self, *args, **kwargs):
         if self.type == self.Type.DELETED_USER:
@@ -620,7 +1558,8 @@ class Report:
             self._generate_role_embed(*args, **kwargs)
         self._embed_analysis_metastats()
 
-    async def _fill_in_details(self):
+    async def fill_in_details(self):
+        """Determine the type and timeframe of the subject, raising BadArgument if the requester can't access it."""
         timeframe_start_date_utc = None
         if self.user_by_id:
             try:
@@ -654,62 +1593,113 @@ class Report:
         if timeframe_start_date_utc is not None:
             self.timeframe_start_date = utc_to_naive_local(timeframe_start_date_utc).date()
 
-    async def _update_metadata_cache(self, channel: discord.TextChannel):
+    async def _update_metadata_cache_of_channels(self, channels: Sequence[discord.TextChannel]):
+        """Crawl up to `CRAWL_CONCURRENCY` channels at once, as Discord rate limits history requests per channel."""
+        channels_left = deque(channels)
+        throttle = CrawlThrottle(self.CRAWL_CONCURRENCY)
+
+        async def crawl_channels_left():
+            while channels_left:
+                async with throttle.slot():
+                    if channels_left:  # Might have been taken while waiting for the slot
+                        await self._update_metadata_cache(channels_left.popleft(), throttle)
+
+        crawls = [
+            asyncio.create_task(crawl_channels_left()) for _ in range(min(self.CRAWL_CONCURRENCY, len(channels)))
+        ]
+        try:
+            await asyncio.gather(*crawls)
+        finally:
+            # On failure, stop the other crawls, as their gaps mustn't be closed after buffered messages have been lost
+            for crawl in crawls:
+                crawl.cancel()
+            await asyncio.gather(*crawls, return_exceptions=True)
+
+    async def _update_metadata_cache(self, channel: discord.TextChannel, throttle: CrawlThrottle):
         try:
             self.relevant_channel_stats[channel.id] = self.relevant_channel_stats.default_factory()  # type: ignore
-            metadata_cache_update = []
-            latest_cached_message = await self.metadata_cache.fetch_edge_message(
-                server_id=channel.guild.id, channel_id=channel.id, latest=True
-            )
-            after: Optional[dt.datetime] = (
-                latest_cached_message.created_at if latest_cached_message is not None else None
-            )
-            with data.session() as session:
-                users_opted_out_of_data_processing_ids: List[int] = [r.user_id for r in session.query(DataProcessingOptOut).all()]
+            async with self.metadata_cache.crawl_locks[channel.id]:
+                cursor, gaps = await self.metadata_cache.fetch_crawl_state(channel.guild.id, channel.id)
+                for gap in gaps:
+                    await self._crawl_channel_history(channel, throttle, after_id=gap.start_id, before_id=gap.end_id)
+                    await self._flush_metadata_cache_update()  # The gap may only be closed once its messages are in
+                    await self.metadata_cache.close_gap(channel.id, gap)
+                if channel.id not in self.metadata_cache.live_channel_ids:
+                    # New messages aren't cached live, so everything after the latest cached one has to be crawled
+                    # (the cursor may be behind gaps crawled from newest to oldest in the background though)
+                    after_id = max((gap.end_id - 1 for gap in gaps), default=0)
+                    if cursor is not None:
+                        after_id = max(after_id, cursor.message_id)
+                    await self._crawl_channel_history(channel, throttle, after_id=after_id)
+                    await self._flush_metadata_cache_update()  # Before the next crawl picks up from the cursor
+        except discord.Forbidden:
+            pass
+        except BaseException:
+            # Messages may have been inserted without their gap being closed
+            self.metadata_cache.recrawled_channel_ids.add(channel.id)
+            raise
+        else:
+            self.metadata_cache.recrawled_channel_ids.discard(channel.id)
+
+    async def _crawl_channel_history(
+        self, channel: discord.TextChannel, throttle: CrawlThrottle, *, after_id: int, before_id: Optional[int] = None
+    ):
+        """Cache messages after `after_id` (0 meaning from the beginning) and before `before_id` (or the present).
+
+        Without `before_id`, crawling stops at the channel's first live message if it starts being cached live in the
+        meantime.
+        """
+        after: Optional[discord.abc.Snowflake] = discord.Object(after_id) if after_id else None
+        before = discord.Object(before_id) if before_id is not None else None
+        messages_fetched = 0
+        with throttle.watching(channel.id):
             while True:
                 try:
-                    async for message in channel.history(limit=None, after=after):
-                        if message.author.id in users_opted_out_of_data_processing_ids:
+                    async for message in channel.history(limit=None, after=after, before=before, oldest_first=True):
+                        if before_id is None and message.id >= self.metadata_cache.first_live_message_ids.get(
+                            channel.id, message.id + 1
+                        ):
+                            return
+                        messages_fetched += 1
+                        after = message  # Resume point in case of an error
+                        if messages_fetched % CrawlThrottle.PAGE_SIZE == 0:
+                            await throttle.page_fetched()
+                        if message.author.id in data_processing_opt_outs:
                             continue  # User opted out of data processing
                         if message.type != discord.MessageType.default:
                             continue
-                        message_datetime = utc_to_naive_local(message.created_at)
-                        content_parts: List[Union[str, discord.embeds._EmptyEmbed]] = [message.clean_content]
-                        for embed in message.embeds:
-                            content_parts.append(embed.title)
-                            content_parts.append(embed.description)
-                            for field in embed.fields:
-                                content_parts.append(field.name)
-                                content_parts.append(field.value)
-                            if embed.footer:
-                                content_parts.append(embed.footer.text)
-                            if embed.author:
-                                content_parts.append(embed.author.name)
-                        content = ' '.join(cast(List[str], filter(None, content_parts)))
-                        message_metadata = MessageMetadata(
-                            id=message.id,
-                            server_id=message.guild.id,
-                            channel_id=channel.id,
-                            user_id=message.author.id,
-                            word_count=len(tuple(filter(None, content.split()))),
-                            character_count=len(content),
-                            created_at=message_datetime,
-                        )
-                        metadata_cache_update.append(message_metadata)
-                        after = message_metadata.created_at
+                        self._metadata_cache_update.append(MessageMetadata.from_message(message))
                         self.messages_cached += 1
                         if self.messages_cached % 10_000 == 0:
                             await self._send_or_update_progress()
-                        if len(metadata_cache_update) >= self.CACHE_INSERT_BATCH_SIZE:
-                            await self.metadata_cache.insert(metadata_cache_update)
-                            metadata_cache_update = []
-                except discord.HTTPException:
+                        if self._metadata_cache_update.is_full:
+                            await self._flush_metadata_cache_update()
+                except discord.HTTPException as e:
+                    if isinstance(e, discord.Forbidden):
+                        raise
                     continue
                 else:
                     break
-            await self.metadata_cache.insert(metadata_cache_update)
-        except discord.Forbidden:
-            pass
+
+    async def _flush_metadata_cache_update(self):
+        """Insert messages buffered so far, including ones being inserted by another channel's flush at the moment.
+
+        The buffer is shared by all channels being crawled, so that inserts are as big as possible. Once a flush fails,
+        messages of any of the channels may have been lost, so every later flush fails too - no gap may be closed.
+        """
+        async with self._metadata_cache_update_lock:
+            if self._metadata_cache_update_error is not None:
+                raise self._metadata_cache_update_error
+            metadata_cache_update, self._metadata_cache_update = (
+                self._metadata_cache_update,
+                self.metadata_cache.new_columns(),
+            )
+            if metadata_cache_update:
+                try:
+                    await self.metadata_cache.insert(metadata_cache_update)
+                except Exception as e:
+                    self._metadata_cache_update_error = e
+                    raise
 
     async def _send_or_update_progress(self):
         embed = self.bot.generate_embed(
@@ -717,10 +1707,12 @@ class Report:
             f'Buforowanie metadanych nowych wiadomości, do tej pory {self.messages_cached:n}…',
             'Proces ten może trochę zająć z powodu limitów Discorda.',
         )
-        if self.caching_progress_message is None:
-            self.caching_progress_message = await self.bot.send(self.ctx, embed=embed)
-        else:
-            self.caching_progress_message = await self.caching_progress_message.edit(embed=embed)
+        async with self._caching_progress_lock:  # Channels are crawled concurrently, but there's one progress message
+            if self.caching_progress_message is None:
+                self.caching_progress_message = await self.bot.send(self.ctx, embed=embed)
+                return
+        # Don't hold up caching - if the channel's budget is spent, only the latest progress goes out anyway
+        self.bot.outbound.edit_in_background(self.caching_progress_message, embed=embed)
 
     async def _finalize_progress(self):
         if self.caching_progress_message is not None:
@@ -728,7 +1720,9 @@ class Report:
                 self.messages_cached, 'nową wiadomość', 'nowe wiadomości', 'nowych wiadomości'
             )
             caching_progress_embed = self.bot.generate_embed('✅', f'Zbuforowano {new_messages_form}')
-            self.caching_progress_message = await self.caching_progress_message.edit(embed=caching_progress_embed)
+            self.caching_progress_message = await self.bot.outbound.edit(
+                self.caching_progress_message, embed=caching_progress_embed, priority=self.bot.outbound.INTERACTIVE
+            )
 
     def _generate_server_embed(self):
         """Analyzes the subject as a server."""
@@ -1103,6 +2097,221 @@ class Report:
         return ax
 
 
+class ReportJobs(SomsiadMixin):
+    """Durable queue of report jobs in Redis streams (one per shard), consumed by a pool of `configuration
+    ['report_worker_count']` tasks on the worker connected to the shard.
+
+    Crawling (caching new messages and querying) is serialized per server, while rendering and sending run concurrently
+    across servers. A job is only acknowledged once its report is sent or has failed, so jobs which were queued or in
+    progress when the bot went down are picked up again on startup.
+    """
+
+    STREAM_KEY = 'somsiad/report_jobs'  # Suffixed with /<shard ID>
+    CONSUMER_GROUP = 'reports'
+    SERVER_QUEUE_KEY = 'somsiad/report_queue'  # Suffixed with /<server ID>, holds tokens of reports waiting to crawl
+    SERVER_QUEUE_TTL = dt.timedelta(hours=1)
+    READ_BLOCK_MILLISECONDS = 5000
+    RENDER_CONCURRENCY = 4
+    SUBJECT_KINDS: Dict[type, str] = {
+        discord.Guild: 'server',
+        discord.TextChannel: 'channel',
+        discord.CategoryChannel: 'category',
+        discord.Member: 'member',
+        discord.User: 'user',
+        discord.Role: 'role',
+    }
+
+    _reports: Dict[str, Report]
+    _crawling: Set[int]
+    _waiting: DefaultDict[int, Deque[Tuple[str, bytes, str, Report]]]
+    _render_tasks: Set[asyncio.Task]
+
+    def __init__(self, bot: Somsiad, metadata_cache: MetadataCache):
+        super().__init__(bot)
+        self.metadata_cache = metadata_cache
+        self._reports = {}  # Reports submitted in this process, by token, so that they don't have to be restored
+        self._crawling = set()
+        self._waiting = defaultdict(deque)
+        self._render_semaphore = asyncio.Semaphore(self.RENDER_CONCURRENCY)
+        self._render_tasks = set()  # The loop only keeps weak references to tasks
+
+    async def submit(self, report: Report):
+        """Queue the report, letting the requester know about its position in the server's queue if it has to wait."""
+        await report.fill_in_details()  # Fail right away, e.g. if the requester has no access to the channel
+        token = uuid.uuid4().hex
+        self._reports[token] = report
+        server_queue_key = f'{self.SERVER_QUEUE_KEY}/{report.ctx.guild.id}'
+        async with async_redis_connection.pipeline(transaction=True) as pipeline:
+            pipeline.rpush(server_queue_key, token)
+            pipeline.expire(server_queue_key, self.SERVER_QUEUE_TTL)
+            position, _ = await pipeline.execute()
+        report.initiated_queue_processing = position == 1
+        subject_kind = 'user_id' if report.user_by_id else self.SUBJECT_KINDS[type(report.subject)]
+        await async_redis_connection.xadd(
+            f'{self.STREAM_KEY}/{report.ctx.guild.shard_id}',
+            {
+                'token': token,
+                'channel_id': report.ctx.channel.id,
+                'message_id': report.ctx.message.id,
+                'subject_kind': subject_kind,
+                'subject_id': report.subject_id,
+                'last_days': report.last_days or 0,
+                'submitted_at': report.init_datetime.isoformat(),
+            },
+        )
+        if not report.initiated_queue_processing:
+            embed = self.bot.generate_embed(
+                '⏳', 'Zakolejkowano raport…', f'{position}. w serwerowej kolejce analizy.'
+            )
+            await self.bot.send(report.ctx, embed=embed)
+
+    async def run(self, worker_count: int):
+        """Consume jobs from the streams of this worker's shards until cancelled."""
+        await self.bot.wait_until_ready()
+        stream_keys = [f'{self.STREAM_KEY}/{shard_id}' for shard_id in sorted(self.bot.shards)]
+        for stream_key in stream_keys:
+            try:
+                await async_redis_connection.xgroup_create(stream_key, self.CONSUMER_GROUP, id='0', mkstream=True)
+            except ResponseError as e:
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        # Jobs left unacknowledged by a previous run all go to the first consumer, which handles them before new ones
+        consumer_names = [f'{cluster.layout.worker_id}-{i}' for i in range(worker_count)]
+        for stream_key in stream_keys:
+            next_id = '0-0'
+            while True:
+                next_id, *_ = await async_redis_connection.xautoclaim(
+                    stream_key, self.CONSUMER_GROUP, consumer_names[0], 0, next_id
+                )
+                if next_id in ('0-0', b'0-0'):
+                    break
+        await asyncio.gather(
+            *(
+                self._consume(stream_keys, consumer_name, recover=i == 0)
+                for i, consumer_name in enumerate(consumer_names)
+            )
+        )
+
+    async def _consume(self, stream_keys: Sequence[str], consumer_name: str, *, recover: bool):
+        last_ids = dict.fromkeys(stream_keys, '0' if recover else '>')
+        while True:
+            try:
+                response = await async_redis_connection.xreadgroup(
+                    self.CONSUMER_GROUP,
+                    consumer_name,
+                    last_ids,
+                    count=1,
+                    block=None if recover else self.READ_BLOCK_MILLISECONDS,
+                )
+                if recover and not any(entries for _, entries in response):
+                    recover = False  # Done with the backlog
+                    last_ids = dict.fromkeys(stream_keys, '>')
+                    continue
+                for stream_key, entries in response:
+                    for job_id, fields in entries:
+                        if recover:
+                            last_ids[stream_key.decode()] = job_id
+                        await self._dispatch(stream_key.decode(), job_id, fields)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.bot.register_error('report_jobs', e)
+                await asyncio.sleep(self.READ_BLOCK_MILLISECONDS / 1000)
+
+    async def _dispatch(self, stream_key: str, job_id: bytes, fields: Dict[bytes, bytes]):
+        token = fields[b'token'].decode()
+        report = self._reports.pop(token, None) or await self._restore(fields)
+        if report is None:  # The request is gone
+            await self._acknowledge(stream_key, job_id)
+            return
+        server_id = report.ctx.guild.id
+        if server_id in self._crawling:
+            self._waiting[server_id].append((stream_key, job_id, token, report))
+            return
+        self._crawling.add(server_id)
+        try:
+            while True:
+                await self._crawl(stream_key, job_id, token, report)
+                if not self._waiting[server_id]:
+                    break
+                stream_key, job_id, token, report = self._waiting[server_id].popleft()
+        finally:
+            self._crawling.discard(server_id)
+            del self._waiting[server_id]
+
+    async def _crawl(self, stream_key: str, job_id: bytes, token: str, report: Report):
+        report.out_of_queue_datetime = dt.datetime.now()
+        try:
+            await report.analyze_subject()
+        except Exception as e:
+            await self._fail(report, e)
+            await self._acknowledge(stream_key, job_id)
+        else:
+            render_task = self.bot.loop.create_task(self._render_and_send(stream_key, job_id, report))
+            self._render_tasks.add(render_task)
+            render_task.add_done_callback(self._render_tasks.discard)
+        finally:
+            await async_redis_connection.lrem(f'{self.SERVER_QUEUE_KEY}/{report.ctx.guild.id}', 0, token)
+
+    async def _render_and_send(self, stream_key: str, job_id: bytes, report: Report):
+        try:
+            async with self._render_semaphore:
+                if report.total_message_count:
+                    await report.render_activity_chart()
+            await report.send()
+        except Exception as e:
+            await self._fail(report, e)
+        finally:
+            await self._acknowledge(stream_key, job_id)
+
+    async def _fail(self, report: Report, error: Exception):
+        self.bot.register_error('report_jobs', error, report.ctx)
+        try:
+            await self.bot.send(
+                report.ctx, embed=self.bot.generate_embed('⚠️', 'Nie udało się wygenerować raportu')
+            )
+        except discord.HTTPException:
+            pass
+
+    async def _acknowledge(self, stream_key: str, job_id: bytes):
+        async with async_redis_connection.pipeline(transaction=True) as pipeline:
+            pipeline.xack(stream_key, self.CONSUMER_GROUP, job_id)
+            pipeline.xdel(stream_key, job_id)
+            await pipeline.execute()
+
+    async def _restore(self, fields: Dict[bytes, bytes]) -> Optional[Report]:
+        """Recreate a report submitted before a restart from its request message."""
+        channel = self.bot.get_channel(int(fields[b'channel_id']))
+        if not isinstance(channel, discord.TextChannel):
+            return None
+        try:
+            message = await channel.fetch_message(int(fields[b'message_id']))
+        except discord.HTTPException:
+            return None
+        ctx = await self.bot.get_context(message)
+        subject_kind = fields[b'subject_kind'].decode()
+        subject_id = int(fields[b'subject_id'])
+        subject: Union[discord.Guild, discord.abc.GuildChannel, discord.Member, discord.Role, int, None]
+        if subject_kind == 'server':
+            subject = ctx.guild
+        elif subject_kind in ('channel', 'category'):
+            subject = ctx.guild.get_channel(subject_id)
+        elif subject_kind == 'member':
+            subject = ctx.guild.get_member(subject_id) or subject_id
+        elif subject_kind == 'role':
+            subject = ctx.guild.get_role(subject_id)
+        else:
+            subject = subject_id
+        if subject is None:
+            return None
+        report = Report(
+            ctx, subject, metadata_cache=self.metadata_cache, last_days=int(fields[b'last_days']) or None
+        )
+        report.init_datetime = dt.datetime.fromisoformat(fields[b'submitted_at'].decode())
+        report.timeframe_end_date = report.init_datetime.date()
+        return report
+
+
 class Activity(commands.Cog):
     GROUP = Help.Command(
         'stat',
@@ -1134,9 +2343,50 @@ class Activity(commands.Cog):
     def __init__(self, bot: Somsiad):
         self.bot = bot
         self.metadata_cache = MetadataCache(bot)
+        self.metadata_ingestion = MetadataIngestion(bot, self.metadata_cache)
+        self.metadata_backfill = MetadataBackfill(bot, self.metadata_cache)
+        self.report_jobs = ReportJobs(bot, self.metadata_cache)
+        self.rate_limit_log_handler = RateLimitLogHandler()
 
     async def cog_load(self):
         await self.metadata_cache.prepare()
+        logging.getLogger(RateLimitLogHandler.LOGGER_NAME).addHandler(self.rate_limit_log_handler)
+        self.rollup_migration_runner = self.bot.loop.create_task(self.metadata_cache.run_rollup_migration())
+        self.bot.shutdown_hooks.append(self.metadata_ingestion.flush_all)
+        self.flush_metadata.start()
+        self.report_jobs_runner = self.bot.loop.create_task(
+            self.report_jobs.run(configuration['report_worker_count'])
+        )
+        self.metadata_backfill_runner = self.bot.loop.create_task(self.metadata_backfill.run())
+
+    async def cog_unload(self):
+        self.rollup_migration_runner.cancel()
+        self.report_jobs_runner.cancel()
+        self.metadata_backfill_runner.cancel()
+        self.flush_metadata.cancel()
+        self.bot.shutdown_hooks.remove(self.metadata_ingestion.flush_all)
+        logging.getLogger(RateLimitLogHandler.LOGGER_NAME).removeHandler(self.rate_limit_log_handler)
+        await self.metadata_ingestion.flush_all()
+
+    @tasks.loop(seconds=MetadataIngestion.FLUSH_INTERVAL_SECONDS)
+    async def flush_metadata(self):
+        await self.metadata_ingestion.flush()
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        self.metadata_ingestion.add(message)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        self.metadata_ingestion.add_edit(payload)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.metadata_ingestion.remove({payload.message_id})
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        self.metadata_ingestion.remove(payload.message_ids)
 
     @cooldown()
     @commands.group(
@@ -1157,7 +2407,7 @@ class Activity(commands.Cog):
         else:
             async with ctx.typing():
                 report = Report(ctx, subject, metadata_cache=self.metadata_cache, last_days=last_days)
-                await report.enqueue()
+                await self.report_jobs.submit(report)
 
     @stat.error
     async def stat_error(self, ctx, error):
@@ -1175,7 +2425,7 @@ class Activity(commands.Cog):
     async def stat_server(self, ctx, last_days: int = None):
         async with ctx.typing():
             report = Report(ctx, ctx.guild, metadata_cache=self.metadata_cache, last_days=last_days)
-            await report.enqueue()
+            await self.report_jobs.submit(report)
 
     @cooldown()
     @stat.command(aliases=['channel', 'kanał', 'kanal'])
@@ -1184,7 +2434,7 @@ class Activity(commands.Cog):
         channel = channel or ctx.channel
         async with ctx.typing():
             report = Report(ctx, channel, metadata_cache=self.metadata_cache, last_days=last_days)
-            await report.enqueue()
+            await self.report_jobs.submit(report)
 
     @stat_channel.error
     async def stat_channel_error(self, ctx, error):
@@ -1203,7 +2453,7 @@ class Activity(commands.Cog):
             category = cast(discord.CategoryChannel, self.bot.get_channel(ctx.channel.category_id))
         async with ctx.typing():
             report = Report(ctx, category, metadata_cache=self.metadata_cache, last_days=last_days)
-            await report.enqueue()
+            await self.report_jobs.submit(report)
 
     @stat_category.error
     async def stat_category_error(self, ctx, error):
@@ -1219,7 +2469,7 @@ class Activity(commands.Cog):
         member = member or ctx.author
         async with ctx.typing():
             report = Report(ctx, member, metadata_cache=self.metadata_cache, last_days=last_days)
-            await report.enqueue()
+            await self.report_jobs.submit(report)
 
     @stat_member.error
     async def stat_member_error(self, ctx, error):
@@ -1234,7 +2484,7 @@ class Activity(commands.Cog):
     async def stat_role(self, ctx, role: discord.Role, last_days: int = None):
         async with ctx.typing():
             report = Report(ctx, role, metadata_cache=self.metadata_cache, last_days=last_days)
-            await report.enqueue()
+            await self.report_jobs.submit(report)
 
     @stat_role.error
     async def stat_role_error(self, ctx, error):
@@ -14,13 +14,14 @@
 import datetime as dt
 import itertools
 import random
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 from typing import List, Optional, Sequence
 
 import discord
 from discord.ext import commands, tasks
 
 import data
+from cache import async_redis_connection
 from core import Help, cooldown, did_not_opt_out_of_data_processing, has_permissions
 from somsiad import Somsiad
 from utilities import calculate_age, word_number_form
@@ -80,6 +81,8 @@ class Birthday(commands.Cog):
     DATE_WITHOUT_YEAR_FORMATS = ('%d %m', '%d %B', '%d %b')
     MONTH_FORMATS = ('%m', '%B', '%b')
     NOTIFICATIONS_TIME = (8, 0)
+    ALREADY_NOTIFIED_KEY = 'somsiad/birthday_notified'  # Suffixed with /<server ID>-<date>
+    ALREADY_NOTIFIED_TTL = dt.timedelta(days=2)
 
     GROUP = Help.Command(
         'urodziny',
@@ -147,7 +150,6 @@ class Birthday(commands.Cog):
 
     def __init__(self, bot: Somsiad):
         self.bot = bot
-        self.already_notified = defaultdict(set)
 
     async def cog_load(self):
         self.notification_cycle.start()
@@ -184,19 +186,18 @@ class Birthday(commands.Cog):
             channel = birthday_notifier.discord_channel(self.bot)
             if channel is None:
                 return
-            key = f'{channel.guild.id}-{dt.date.today()}'
-            if (
-                channel.guild.get_member(birthday_today.user_id) is None
-                or birthday_today.user_id in self.already_notified[key]
+            if channel.guild.get_member(birthday_today.user_id) is None or not await self.mark_notified(
+                channel.guild.id, birthday_today.user_id
             ):
                 continue
-            self.already_notified[key].add(birthday_today.user_id)
             if birthday_today.age:
                 notice = f'{wish} z okazji {birthday_today.age}. urodzin!'
             else:
                 notice = f'{wish} z okazji urodzin!'
             try:
-                await channel.send(f'<@{birthday_today.user_id}>', embed=self.bot.generate_embed('🎂', notice))
+                await self.bot.outbound.send(
+                    channel, f'<@{birthday_today.user_id}>', embed=self.bot.generate_embed('🎂', notice)
+                )
             except discord.Forbidden:
                 try:
                     user = self.bot.get_user(birthday_today.user_id)
@@ -212,6 +213,15 @@ class Birthday(commands.Cog):
                 except discord.Forbidden:
                     pass
 
+    async def mark_notified(self, server_id: int, user_id: int) -> bool:
+        """Mark the user as notified about today on the server, returning whether they hadn't been already."""
+        key = f'{self.ALREADY_NOTIFIED_KEY}/{server_id}-{dt.date.today()}'
+        async with async_redis_connection.pipeline(transaction=True) as pipeline:
+            pipeline.sadd(key, user_id)
+            pipeline.expire(key, self.ALREADY_NOTIFIED_TTL)
+            added_count, _ = await pipeline.execute()
+        return bool(added_count)
+
     async def send_all_birthday_today_notifications(self):
         with data.session(commit=True) as session:
             birthday_notifiers = session.query(BirthdayNotifier).all()
@@ -290,8 +300,8 @@ class Birthday(commands.Cog):
             embed = self.bot.generate_embed('⚠️', 'Nie znaleziono na serwerze pasującego użytkownika')
             await self.bot.send(ctx, embed=embed)
 
-    @did_not_opt_out_of_data_processing()
     @cooldown()
+    @did_not_opt_out_of_data_processing()
     @birthday.command(aliases=['zapamiętaj', 'zapamietaj', 'ustaw'])
     async def birthday_remember(self, ctx, *, raw_date_string):
         try:
@@ -365,8 +375,8 @@ class Birthday(commands.Cog):
             embed = self.bot.generate_embed('ℹ️', 'Brak daty urodzin do zapomnienia')
         await self.bot.send(ctx, embed=embed)
 
-    @did_not_opt_out_of_data_processing()
     @cooldown()
+    @did_not_opt_out_of_data_processing()
     @birthday.command(aliases=['upublicznij'])
     @commands.guild_only()
     async def birthday_make_public(self, ctx):
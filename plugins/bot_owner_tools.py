@@ -11,6 +11,7 @@
 # You should have received a copy of the GNU General Public License along with Somsiad.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 from somsiad import Somsiad, SomsiadMixin
 from typing import Optional, cast
 import discord
@@ -91,16 +92,24 @@ class BotOwnerTools(commands.Cog, SomsiadMixin):
         embed = self.bot.generate_embed('📢', 'Ogłoszenie somsiedzkie', description)
         for n in range(0, len(announcement) - 1, 2):
             embed.add_field(name=announcement[n].strip(), value=announcement[n + 1].strip(), inline=False)
-        for server in ctx.bot.guilds:
-            if not server.name or 'bot' not in server.name.lower():
-                for channel in server.text_channels:
-                    if not channel.is_news():
-                        try:
-                            await channel.send(embed=embed)
-                        except:
-                            continue
-                        else:
-                            break
+        # Each server's announcement only waits for its own channel's rate limit
+        await asyncio.gather(
+            *(
+                self._announce_on_server(server, embed)
+                for server in ctx.bot.guilds
+                if not server.name or 'bot' not in server.name.lower()
+            )
+        )
+
+    async def _announce_on_server(self, server: discord.Guild, embed: discord.Embed):
+        for channel in server.text_channels:
+            if not channel.is_news():
+                try:
+                    await self.bot.outbound.send(channel, embed=embed)
+                except:
+                    continue
+                else:
+                    break
 
     @announce.command(aliases=['lokalnie'])
     @commands.guild_only()
@@ -11,14 +11,11 @@
 # You should have received a copy of the GNU General Public License along with Somsiad.
 # If not, see <https://www.gnu.org/licenses/>.
 
-import datetime as dt
-
 import discord
 from discord.ext import commands
-from sentry_sdk import capture_exception
 
 import data
-from core import cooldown
+from core import cooldown, timer_scheduler
 from somsiad import Somsiad
 from utilities import human_datetime, interpret_str_as_datetime, md_link, utc_to_naive_local
 
@@ -34,32 +31,20 @@ class Burning(data.Base, data.ChannelRelated, data.UserRelated):
 class Burn(commands.Cog):
     def __init__(self, bot: Somsiad):
         self.bot = bot
-        self.burnings_set_off = set()
-
-    async def set_off_burning(
-        self,
-        confirmation_message_id: int,
-        target_message_id: int,
-        channel_id: int,
-        user_id: int,
-        requested_at: dt.datetime,
-        execute_at: dt.datetime,
-    ):
-        if confirmation_message_id in self.burnings_set_off:
-            return
-        self.burnings_set_off.add(confirmation_message_id)
-        try:
-            await discord.utils.sleep_until(execute_at.astimezone())
-        except ValueError:
-            capture_exception()
-            return
-        if confirmation_message_id not in self.burnings_set_off:
-            return
-        self.burnings_set_off.remove(confirmation_message_id)
-        channel = await self.bot.fetch_channel(channel_id)
+
+    async def cog_load(self):
+        timer_scheduler.register(
+            Burning, self.set_off_burning, due_column=Burning.execute_at, done_column=Burning.has_been_executed
+        )
+
+    async def cog_unload(self):
+        timer_scheduler.unregister(Burning)
+
+    async def set_off_burning(self, burning: Burning):
+        channel = await self.bot.fetch_channel(burning.channel_id)
         try:
-            target_message = await channel.fetch_message(target_message_id)
-            confirmation_message = await channel.fetch_message(confirmation_message_id)
+            target_message = await channel.fetch_message(burning.target_message_id)
+            confirmation_message = await channel.fetch_message(burning.confirmation_message_id)
         except (AttributeError, discord.NotFound):
             pass
         else:
@@ -69,33 +54,21 @@ class Burn(commands.Cog):
                 pass
             else:
                 burning_description = md_link(
-                    f'Usunięto twoją wiadomość wysłaną {human_datetime(requested_at)}.', confirmation_message.jump_url
+                    f'Usunięto twoją wiadomość wysłaną {human_datetime(burning.requested_at)}.',
+                    confirmation_message.jump_url,
                 )
-                burning_embed = self.bot.generate_embed('✅', 'Spalono wiadomość', burning_description, timestamp=execute_at)
-                burning_message = await channel.send(f'<@{user_id}>', embed=burning_embed)
+                burning_embed = self.bot.generate_embed(
+                    '✅', 'Spalono wiadomość', burning_description, timestamp=burning.execute_at
+                )
+                burning_message = await channel.send(f'<@{burning.user_id}>', embed=burning_embed)
+                timer_scheduler.mark_delivered()
                 confirmation_description = md_link(
                     f'Usunięto twoją wiadomość {human_datetime()}.', burning_message.jump_url
                 )
-                confirmation_embed = self.bot.generate_embed('✅', 'Spalono wiadomość', confirmation_description, timestamp=execute_at)
-                await confirmation_message.edit(embed=confirmation_embed)
-        with data.session(commit=True) as session:
-            reminder = session.query(Burning).get(confirmation_message_id)
-            reminder.has_been_executed = True
-
-    @commands.Cog.listener()
-    async def on_ready(self):
-        with data.session() as session:
-            for reminder in session.query(Burning).filter(Burning.has_been_executed == False):
-                self.bot.loop.create_task(
-                    self.set_off_burning(
-                        reminder.confirmation_message_id,
-                        reminder.target_message_id,
-                        reminder.channel_id,
-                        reminder.user_id,
-                        reminder.requested_at,
-                        reminder.execute_at,
-                    )
+                confirmation_embed = self.bot.generate_embed(
+                    '✅', 'Spalono wiadomość', confirmation_description, timestamp=burning.execute_at
                 )
+                await confirmation_message.edit(embed=confirmation_embed)
 
     @cooldown()
     @commands.command(aliases=['spal'])
@@ -120,9 +93,8 @@ class Burn(commands.Cog):
                 'execute_at': execute_at,
             }
             with data.session(commit=True) as session:
-                reminder = Burning(**details)
-                session.add(reminder)
-                self.bot.loop.create_task(self.set_off_burning(**details))
+                session.add(Burning(**details))
+            timer_scheduler.schedule(Burning(**details))
         except:
             await confirmation_message.delete()
             raise
@@ -13,6 +13,7 @@
 
 import asyncio
 from dataclasses import dataclass
+import functools
 import json
 from typing import List, Mapping, Optional, Sequence
 import arithmetic_eval
@@ -28,13 +29,23 @@ from configuration import configuration
 from core import Help, cooldown
 from plugins.help_message import Help as HelpCog
 from somsiad import Somsiad
-import tiktoken
-from utilities import AI_ALLOWED_SERVER_IDS, human_amount_of_time, md_link
+from utilities import AI_ALLOWED_SERVER_IDS, LazyModule, human_amount_of_time, md_link, warm_up
 from unidecode import unidecode
 
 
-encoding = tiktoken.encoding_for_model("gpt-4o")  # GPT-4's is the same one
-aclient = AsyncOpenAI()
+tiktoken = LazyModule('tiktoken')
+
+
+@warm_up
+@functools.cache
+def get_encoding() -> 'tiktoken.Encoding':
+    return tiktoken.encoding_for_model("gpt-4o")  # GPT-4's is the same one
+
+
+@warm_up
+@functools.cache
+def get_aclient() -> AsyncOpenAI:
+    return AsyncOpenAI()
 
 
 @dataclass
@@ -271,7 +282,7 @@ Sformułuj odpowiedź bezpośrednio do użytkownika, nie pisz nicku."""
                 except IndexError:
                     break
                 # Append
-                prompt_token_count_so_far += len(encoding.encode(clean_content))
+                prompt_token_count_so_far += len(get_encoding().encode(clean_content))
                 history.append(
                     HistoricalMessage(
                         author_display_name_with_id=author_display_name_with_id,
@@ -339,7 +350,7 @@ Sformułuj odpowiedź bezpośrednio do użytkownika, nie pisz nicku."""
         final_resulted_in_command_message = False
         for iterations_left in range(self.ITERATION_LIMIT - 1, -1, -1):
             async with ctx.typing():
-                iteration_result = await aclient.chat.completions.create(
+                iteration_result = await get_aclient().chat.completions.create(
                     model="gpt-4o",
                     messages=prompt_messages,
                     user=str(ctx.author.id),
@@ -11,56 +11,199 @@
 # You should have received a copy of the GNU General Public License along with Somsiad.
 # If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
+import itertools
+import math
 import discord
-from core import Invocation, is_user_opted_out_of_data_processing
+from core import ActiveUserSketches, Invocation, InvocationAnalytics, data_processing_opt_outs
 import datetime as dt
+from collections import defaultdict
+from typing import Any, DefaultDict, Dict, List, Optional, Set
 from somsiad import Somsiad, SomsiadMixin
 
-from discord.ext import commands
+from discord.ext import commands, tasks
 
-import data
-from utilities import text_snippet, utc_to_naive_local
+from utilities import human_datetime, interpret_str_as_datetime, text_snippet, utc_to_naive_local
+
+
+class InvocationBuffer(SomsiadMixin):
+    """Write-behind buffer of command invocations.
+
+    Each invocation's start and exit are merged in memory into a single row, and finished rows are inserted in bulk
+    into ClickHouse every `FLUSH_INTERVAL_SECONDS` or as soon as `FLUSH_MAX_ROWS` of them accumulate. Rows of users who
+    opted out of data processing are filtered out at flush time. Rows of a failed flush are tried again with the next
+    one, unless `FLUSH_MAX_ROWS` new ones have accumulated in the meantime.
+    """
+
+    FLUSH_INTERVAL_SECONDS = 2.0
+    FLUSH_MAX_ROWS = 500
+    PENDING_TIMEOUT = dt.timedelta(minutes=15)  # Invocations that never exited get written without exited_at
+    SHUTDOWN_FLUSH_ATTEMPTS = 3
+    SHUTDOWN_FLUSH_RETRY_DELAY_SECONDS = 1.0
+
+    pending_rows: Dict[int, Dict[str, Any]]
+    finished_rows: List[Dict[str, Any]]
+    unsketched_user_ids: DefaultDict[dt.date, Set[int]]
+
+    def __init__(self, bot: Somsiad):
+        super().__init__(bot)
+        self.analytics = InvocationAnalytics(bot)
+        self.active_user_sketches = ActiveUserSketches(bot)
+        self.pending_rows = {}
+        self.finished_rows = []
+        self.unsketched_user_ids = defaultdict(set)  # Of rows inserted, but not added to the sketches yet
+        self._snowflake_increment = itertools.count()
+        self._flush_task: Optional[asyncio.Task] = None
+
+    def start(self, ctx: commands.Context):
+        invocation_id = self._generate_id()
+        ctx._invocation_id = invocation_id
+        self.pending_rows[invocation_id] = {
+            'id': invocation_id,
+            'message_id': ctx.message.id,
+            'server_id': ctx.guild.id if ctx.guild is not None else None,
+            'channel_id': ctx.channel.id,
+            'user_id': ctx.author.id,
+            'prefix': ctx.prefix,
+            'full_command': ctx.command.qualified_name,
+            'root_command': str(ctx.command.root_parent or ctx.command.qualified_name),
+            'created_at': utc_to_naive_local(ctx.message.created_at),
+            'exited_at': None,
+            'error': None,
+        }
+
+    def finish(self, ctx: commands.Context, error: Optional[commands.CommandError] = None):
+        row = self.pending_rows.pop(getattr(ctx, '_invocation_id', None), None)
+        if row is None:
+            return  # Invocation wasn't recorded, e.g. because it was for an unknown command
+        row['exited_at'] = dt.datetime.now()
+        if error is not None:
+            row['error'] = text_snippet(
+                str(error).replace('Command raised an exception: ', ''), Invocation.MAX_ERROR_LENGTH
+            )
+        self.finished_rows.append(row)
+        if len(self.finished_rows) >= self.FLUSH_MAX_ROWS and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = self.bot.loop.create_task(self.flush())
+
+    async def flush(self, *, include_pending: bool = False) -> bool:
+        """Write finished rows (and pending ones, if `include_pending`), returning whether that succeeded."""
+        rows, self.finished_rows = self.finished_rows, []
+        stale_before = None if include_pending else dt.datetime.now() - self.PENDING_TIMEOUT
+        for invocation_id, row in list(self.pending_rows.items()):
+            if stale_before is None or row['created_at'] < stale_before:
+                rows.append(self.pending_rows.pop(invocation_id))
+        rows = [row for row in rows if row['user_id'] not in data_processing_opt_outs]
+        succeeded = True
+        if rows:
+            try:
+                await self.analytics.insert(rows)
+            except Exception as e:
+                if len(self.finished_rows) < self.FLUSH_MAX_ROWS:
+                    self.finished_rows[:0] = rows  # Try again with the next flush
+                self.bot.register_error('invocation_buffer_flush', e)
+                return False
+            for row in rows:
+                self.unsketched_user_ids[row['created_at'].date()].add(row['user_id'])
+        if self.unsketched_user_ids:
+            unsketched_user_ids, self.unsketched_user_ids = self.unsketched_user_ids, defaultdict(set)
+            try:
+                await self.active_user_sketches.add(unsketched_user_ids)
+            except Exception as e:
+                for date, user_ids in unsketched_user_ids.items():  # Try again with the next flush
+                    self.unsketched_user_ids[date].update(user_ids)
+                self.bot.register_error('invocation_buffer_flush', e)
+                succeeded = False
+        return succeeded
+
+    async def flush_all(self):
+        """Write everything, trying a few times, as whatever is still buffered at shutdown is lost."""
+        for attempt in range(self.SHUTDOWN_FLUSH_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(self.SHUTDOWN_FLUSH_RETRY_DELAY_SECONDS)
+            if await self.flush(include_pending=True):
+                return
+        raise RuntimeError(f'Could not write {len(self.finished_rows)} invocations or active users at shutdown')
+
+    def _generate_id(self) -> int:
+        # The low 22 bits of a snowflake are free for a per-process increment, which keeps same-millisecond IDs unique
+        return discord.utils.time_snowflake(dt.datetime.now()) | (next(self._snowflake_increment) & 0x3FFFFF)
 
 
 class Commands(commands.Cog, SomsiadMixin):
+    USAGE_REPORT_MAX_COMMANDS = 24  # Discord's embed field limit is 25
+
+    def __init__(self, bot: Somsiad):
+        super().__init__(bot)
+        self.invocation_buffer = InvocationBuffer(bot)
+
+    async def cog_load(self):
+        await self.invocation_buffer.analytics.prepare()
+        self.bot.loop.create_task(self._prepare_historical_data())
+        self.bot.shutdown_hooks.append(self.invocation_buffer.flush_all)
+        self.flush_invocations.start()
+
+    async def cog_unload(self):
+        self.flush_invocations.cancel()
+        self.bot.shutdown_hooks.remove(self.invocation_buffer.flush_all)
+        await self.invocation_buffer.flush_all()
+
+    async def _prepare_historical_data(self):
+        await self.invocation_buffer.analytics.import_from_postgres()
+        await self.invocation_buffer.active_user_sketches.backfill()
+
+    @tasks.loop(seconds=InvocationBuffer.FLUSH_INTERVAL_SECONDS)
+    async def flush_invocations(self):
+        await self.invocation_buffer.flush()
+
     @commands.Cog.listener()
     async def on_command(self, ctx: commands.Context):
-        with data.session(commit=True) as session:
-            if not ctx.command or is_user_opted_out_of_data_processing(session, ctx.author.id):
-                return
-            invocation = Invocation(
-                id=discord.utils.time_snowflake(dt.datetime.now()),
-                message_id=ctx.message.id,
-                server_id=ctx.guild.id if ctx.guild is not None else None,
-                channel_id=ctx.channel.id,
-                user_id=ctx.author.id,
-                prefix=ctx.prefix,
-                full_command=ctx.command.qualified_name,
-                root_command=str(ctx.command.root_parent or ctx.command.qualified_name),
-                created_at=utc_to_naive_local(ctx.message.created_at),
-            )
-            session.add(invocation)
+        if ctx.command:
+            self.invocation_buffer.start(ctx)
 
     @commands.Cog.listener()
     async def on_command_completion(self, ctx: commands.Context):
-        with data.session(commit=True) as session:
-            if is_user_opted_out_of_data_processing(session, ctx.author.id):
-                return
-            invocation = session.query(Invocation).get(ctx.message.id)
-            if invocation is not None:
-                invocation.exited_at = dt.datetime.now()
+        self.invocation_buffer.finish(ctx)
 
     @commands.Cog.listener()
     async def on_command_error(self, ctx: commands.Context, error: commands.CommandError):
-        with data.session(commit=True) as session:
-            if is_user_opted_out_of_data_processing(session, ctx.author.id):
-                return
-            invocation = session.query(Invocation).get(ctx.message.id)
-            if invocation is not None:
-                invocation.exited_at = dt.datetime.now()
-                invocation.error = text_snippet(
-                    str(error).replace('Command raised an exception: ', ''), Invocation.MAX_ERROR_LENGTH
-                )
+        self.invocation_buffer.finish(ctx, error)
+
+    @commands.command(aliases=['użycie', 'uzycie'])
+    @commands.is_owner()
+    async def usage(self, ctx: commands.Context, since: str = '7d'):
+        """Reports per-command usage since the provided moment or over the provided period (7 days by default)."""
+        now = dt.datetime.now()
+        try:
+            since_datetime = interpret_str_as_datetime(since, roll_over=False, now_override=now)
+        except ValueError:
+            raise commands.BadArgument('since')
+        if since_datetime > now:
+            since_datetime = now - (since_datetime - now)  # A period such as "7d" means the last 7 days
+        rows = await self.invocation_buffer.analytics.fetch_usage_report(after=since_datetime, before=now)
+        embed = self.bot.generate_embed(
+            '📊', f'Użycie komend od {human_datetime(since_datetime)}', None if rows else 'Brak wywołań.'
+        )
+        for row in rows[: self.USAGE_REPORT_MAX_COMMANDS]:
+            p50_ms, p95_ms = (
+                '?' if quantile is None or math.isnan(quantile) else f'{round(quantile):n}'
+                for quantile in row['duration_quantiles_ms']
+            )
+            embed.add_field(
+                name=row['full_command'],
+                value=(
+                    f'{row["call_count"]:n} wywołań, {round(row["error_rate"] * 100, 1):n}% błędów\n'
+                    f'p50 {p50_ms} ms, p95 {p95_ms} ms'
+                ),
+            )
+        await self.bot.send(ctx, embed=embed)
+
+    @usage.error
+    async def usage_error(self, ctx: commands.Context, error: commands.CommandError):
+        if isinstance(error, commands.BadArgument):
+            await self.bot.send(
+                ctx,
+                embed=self.bot.generate_embed('⚠️', 'Nie rozpoznano poprawnej daty i godziny/długości okresu'),
+            )
 
 
 async def setup(bot: Somsiad):
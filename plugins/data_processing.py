@@ -13,7 +13,7 @@
 
 from core import Help, cooldown
 from somsiad import Somsiad, SomsiadMixin
-from core import DataProcessingOptOut
+from core import DataProcessingOptOut, InvocationAnalytics, data_processing_opt_outs
 from discord.ext import commands
 import data
 from psycopg2.errors import UniqueViolation
@@ -59,6 +59,8 @@ class DataProcessing(commands.Cog, SomsiadMixin):
                 session.query(BirthdayPublicnessLink).filter_by(born_person_user_id=ctx.author.id).delete()
                 for model in data.USER_RELATED_MODELS:
                     session.query(model).filter_by(user_id=ctx.author.id).delete()
+            await data_processing_opt_outs.opt_out(ctx.author.id)
+            await InvocationAnalytics(self.bot).delete_user_data(ctx.author.id)
         except IntegrityError as e:
             if isinstance(e.orig, UniqueViolation):
                 embed = self.bot.generate_embed('👤', 'Już jesteś wypisany z przetwarzania Twoich danych przez Somsiada')
@@ -77,6 +79,7 @@ class DataProcessing(commands.Cog, SomsiadMixin):
     async def data_processing_opt_in(self, ctx):
         with data.session(commit=True) as session:
             deleted_count = session.query(DataProcessingOptOut).filter_by(user_id=ctx.author.id).delete()
+        await data_processing_opt_outs.opt_in(ctx.author.id)
         await self.bot.send(
             ctx,
             embed=self.bot.generate_embed(
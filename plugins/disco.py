@@ -12,25 +12,26 @@
 # If not, see <https://www.gnu.org/licenses/>.
 
 import asyncio
+import datetime as dt
 import functools
 import locale
 import os
-from collections import defaultdict
 from numbers import Number
 
 from sentry_sdk import capture_exception
 from somsiad import Somsiad
-from typing import Optional, Union
+from typing import Dict, Optional, Tuple, Union
 from urllib.error import HTTPError
 
 import discord
-import pytube
-from pytube.exceptions import AgeRestrictedError
 from discord.ext import commands
 
+from cache import async_redis_connection
 from configuration import configuration
 from core import Help, cooldown
-from utilities import human_amount_of_time
+from utilities import LazyModule, human_amount_of_time
+
+pytube = LazyModule('pytube')
 
 
 class Disco(commands.Cog):
@@ -53,14 +54,32 @@ class Disco(commands.Cog):
         Help.Command(('rozłącz', 'rozlacz', 'stop'), (), 'Rozłącza z kanału głosowego.'),
     )
     HELP = Help(COMMANDS, '🔈', group=GROUP)
+    SERVER_STATE_KEY = 'somsiad/disco'  # Suffixed with /<server ID>
+    SERVER_STATE_TTL = dt.timedelta(days=30)
+
+    song_audios: Dict[int, discord.PCMVolumeTransformer]
 
     def __init__(self, bot: Somsiad):
         self.cache_dir_path = os.path.join(bot.cache_dir_path, 'disco')
         self.bot = bot
-        self.servers = defaultdict(lambda: {'volume': 1.0, 'song_url': None, 'song_audio': None})
+        self.song_audios = {}  # Audio is playing in this very process, so it can't be shared across the cluster
         if not os.path.exists(self.cache_dir_path):
             os.makedirs(self.cache_dir_path)
 
+    async def get_server_state(self, server_id: int) -> Tuple[float, Optional[str]]:
+        """Return the server's volume and the URL of the song played last."""
+        volume, song_url = await async_redis_connection.hmget(
+            f'{self.SERVER_STATE_KEY}/{server_id}', ('volume', 'song_url')
+        )
+        return float(volume) if volume is not None else 1.0, song_url.decode() if song_url is not None else None
+
+    async def set_server_state(self, server_id: int, **fields: Union[float, str]):
+        key = f'{self.SERVER_STATE_KEY}/{server_id}'
+        async with async_redis_connection.pipeline(transaction=True) as pipeline:
+            pipeline.hset(key, mapping=fields)
+            pipeline.expire(key, self.SERVER_STATE_TTL)
+            await pipeline.execute()
+
     @staticmethod
     async def channel_connect(channel: discord.VoiceChannel):
         for _ in range(3):
@@ -104,6 +123,7 @@ class Disco(commands.Cog):
             video_url = query
         if video_url is not None:
             video_id = pytube.extract.video_id(video_url)
+            volume, _ = await self.get_server_state(channel.guild.id)
             try:
                 video = await self.bot.loop.run_in_executor(None, pytube.YouTube, video_url)
             except:
@@ -111,12 +131,14 @@ class Disco(commands.Cog):
                 embed = self.bot.generate_embed('⚠️', 'Nie można zagrać tego utworu')
                 await self.bot.send(ctx, embed=embed)
             else:
-                embed = self.generate_embed(channel, video, 'Pobieranie', '⏳')
+                embed = self.generate_embed(channel, video, 'Pobieranie', '⏳', volume=volume)
                 message = await self.bot.send(ctx, embed=embed)
                 try:
                     streams = video.streams.filter(only_audio=True).order_by('abr').desc()
-                except AgeRestrictedError:
-                    embed = self.generate_embed(channel, video, 'Znalezione wideo ma ograniczenie wiekowe', '⚠️')
+                except pytube.exceptions.AgeRestrictedError:
+                    embed = self.generate_embed(
+                        channel, video, 'Znalezione wideo ma ograniczenie wiekowe', '⚠️', volume=volume
+                    )
                 else:
                     stream = streams[0]
                     i = 0
@@ -125,7 +147,7 @@ class Disco(commands.Cog):
                         try:
                             stream = streams[i]
                         except IndexError:
-                            embed = self.generate_embed(channel, video, 'Plik zbyt duży', '⚠️')
+                            embed = self.generate_embed(channel, video, 'Plik zbyt duży', '⚠️', volume=volume)
                             break
                     else:
                         path = os.path.join(self.cache_dir_path, f'{video_id} - {stream.default_filename}')
@@ -138,11 +160,9 @@ class Disco(commands.Cog):
                             )
                         if channel.guild.voice_client is not None:
                             channel.guild.voice_client.stop()
-                        song_audio = discord.PCMVolumeTransformer(
-                            discord.FFmpegPCMAudio(path), self.servers[channel.guild.id]['volume']
-                        )
-                        self.servers[channel.guild.id]['song_audio'] = song_audio
-                        self.servers[channel.guild.id]['song_url'] = video_url
+                        song_audio = discord.PCMVolumeTransformer(discord.FFmpegPCMAudio(path), volume)
+                        self.song_audios[channel.guild.id] = song_audio
+                        await self.set_server_state(channel.guild.id, song_url=video_url)
 
                         async def try_edit(embed: discord.Embed):
                             try:
@@ -152,25 +172,33 @@ class Disco(commands.Cog):
 
                         def after(error):
                             song_audio.cleanup()
-                            embed = self.generate_embed(channel, video, 'Zakończono', '⏹')
+                            embed = self.generate_embed(channel, video, 'Zakończono', '⏹', volume=song_audio.volume)
                             self.bot.loop.create_task(try_edit(embed))
 
-                        embed = self.generate_embed(channel, video, 'Odtwarzanie', '▶️')
+                        embed = self.generate_embed(channel, video, 'Odtwarzanie', '▶️', volume=volume)
                         await self.channel_connect(channel)
-                        channel.guild.voice_client.play(self.servers[channel.guild.id]['song_audio'], after=after)
+                        channel.guild.voice_client.play(song_audio, after=after)
                 await message.edit(embed=embed)
         else:
             embed = self.bot.generate_embed('🙁', f'Brak wyników dla zapytania "{query}"')
             await self.bot.send(ctx, embed=embed)
 
-    def server_change_volume(self, server: discord.Guild, volume_percentage: Number):
+    async def server_change_volume(self, server: discord.Guild, volume_percentage: Number) -> float:
         volume_float = abs(float(volume_percentage)) / 100
-        self.servers[server.id]['volume'] = volume_float
-        if self.servers[server.id]['song_audio']:
-            self.servers[server.id]['song_audio'].volume = volume_float
+        await self.set_server_state(server.id, volume=volume_float)
+        if server.id in self.song_audios:
+            self.song_audios[server.id].volume = volume_float
+        return volume_float
 
     def generate_embed(
-        self, channel: discord.VoiceChannel, video: pytube.YouTube, status: str, emoji: str, notice: str = None
+        self,
+        channel: discord.VoiceChannel,
+        video: 'pytube.YouTube',
+        status: str,
+        emoji: str,
+        notice: str = None,
+        *,
+        volume: float,
     ) -> discord.Embed:
         try:
             title = video.title
@@ -184,7 +212,7 @@ class Disco(commands.Cog):
             embed.set_thumbnail(url=video.thumbnail_url)
             embed.add_field(name='Długość', value=human_amount_of_time(int(video.length)))
             embed.add_field(name='Kanał', value=channel.name)
-            embed.add_field(name='Głośność', value=f'{int(self.servers[channel.guild.id]["volume"] * 100)}%')
+            embed.add_field(name='Głośność', value=f'{int(volume * 100)}%')
             embed.add_field(name='Status', value=status)
             embed.set_footer(icon_url=self.bot.youtube_client.FOOTER_ICON_URL, text=self.bot.youtube_client.FOOTER_TEXT)
         return embed
@@ -227,14 +255,16 @@ class Disco(commands.Cog):
                 color=self.bot.COLOR,
             )
             await self.bot.send(ctx, embed=embed)
-        elif self.servers[ctx.guild.id]['song_url'] is None:
+            return
+        _, song_url = await self.get_server_state(ctx.guild.id)
+        if song_url is None:
             embed = discord.Embed(
                 title=':red_circle: Nie powtórzono utworu, bo nie ma żadnego do powtórzenia', color=self.bot.COLOR
             )
             await self.bot.send(ctx, embed=embed)
         else:
             async with ctx.typing():
-                await self.channel_play_song(ctx, self.servers[ctx.guild.id]['song_url'])
+                await self.channel_play_song(ctx, song_url)
 
     @cooldown()
     @disco.command(aliases=['pauza', 'spauzuj', 'pauzuj', 'pause'])
@@ -340,9 +370,9 @@ class Disco(commands.Cog):
     async def disco_volume(self, ctx, volume_percentage: Union[int, locale.atoi] = None):
         """Sets the volume."""
         if volume_percentage is None:
+            volume, _ = await self.get_server_state(ctx.guild.id)
             embed = discord.Embed(
-                title=':level_slider: Głośność ustawiona jest na '
-                f'{int(self.servers[ctx.guild.id]["volume"] * 100)}%',
+                title=f':level_slider: Głośność ustawiona jest na {int(volume * 100)}%',
                 color=self.bot.COLOR,
             )
         else:
@@ -354,9 +384,9 @@ class Disco(commands.Cog):
                     color=self.bot.COLOR,
                 )
             else:
-                self.server_change_volume(ctx.guild, volume_percentage)
+                volume = await self.server_change_volume(ctx.guild, volume_percentage)
                 embed = discord.Embed(
-                    title=':level_slider: Ustawiono głośność na ' f'{int(self.servers[ctx.guild.id]["volume"] * 100)}%',
+                    title=f':level_slider: Ustawiono głośność na {int(volume * 100)}%',
                     color=self.bot.COLOR,
                 )
         await self.bot.send(ctx, embed=embed)
@@ -20,6 +20,7 @@ from core import Help as _Help
 from core import cooldown
 import discord
 import hashlib
+import cluster
 from somsiad import Somsiad
 
 COTD_TIME = (12, 00)
@@ -750,7 +751,9 @@ class Help(commands.Cog):
 
     @tasks.loop(hours=24)
     async def auto_command_of_the_day(self):
-        if self.bot.public_channel:
+        if self.bot.public_channel and await cluster.claim_once(
+            f'command_of_the_day/{dt.date.today()}', dt.timedelta(days=2)
+        ):  # Only one worker of the cluster posts it
             await self.bot.public_channel.send(embed=self.compose_command_of_the_day_embed())
 
     @auto_command_of_the_day.before_loop
@@ -26,14 +26,15 @@ from typing import BinaryIO, DefaultDict, Dict, Optional, Tuple, TypedDict
 import aiopytesseract
 from aiopytesseract.exceptions import TesseractError
 import discord
-import imagehash
-import PIL.Image
-import PIL.ImageEnhance
-import psycopg2.errors
 from discord.ext import commands
+from sqlalchemy.exc import IntegrityError
 import data
-from core import cooldown, is_user_opted_out_of_data_processing
-from utilities import md_link, utc_to_naive_local, word_number_form
+from core import cooldown, data_processing_opt_outs
+from utilities import LazyModule, md_link, utc_to_naive_local, word_number_form
+
+imagehash = LazyModule('imagehash')
+Image = LazyModule('PIL.Image')
+ImageEnhance = LazyModule('PIL.ImageEnhance')
 
 
 class Similarity(TypedDict, total=False):
@@ -59,12 +60,7 @@ class Image9000(data.Base, data.MemberRelated, data.ChannelRelated):
         parts = [self.sent_at.strftime("%-d %B %Y o %-H:%M")]
         discord_channel = self.discord_channel(bot)
         parts.append("na usuniętym kanale" if discord_channel is None else f"na #{discord_channel}")
-        discord_user = self.discord_user(bot)
-        if discord_user is None:
-            try:
-                discord_user = await bot.fetch_user(self.user_id)
-            except discord.NotFound:
-                pass
+        discord_user = await self.fetch_discord_user(bot)
         parts.append(f'przez {"przez usuniętego użytkownika" if discord_user is None else discord_user.display_name}')
         return " ".join(parts)
 
@@ -82,47 +78,47 @@ class Imaging(commands.Cog, SomsiadMixin):
 
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message):
-        if message.guild is None:
-            return # Ignore DMs
+        if message.guild is None or not message.attachments:
+            return  # Ignore DMs and messages without images
+        if message.author.id in data_processing_opt_outs:
+            return  # User opted out of data processing
+        images9000 = []
+        for attachment in message.attachments:
+            if attachment.height and attachment.width:
+                image_bytes = io.BytesIO()
+                try:
+                    await attachment.save(image_bytes)
+                except (discord.HTTPException, discord.NotFound):
+                    continue
+                else:
+                    try:
+                        perceptualization = await self._perceptualize(image_bytes)
+                    except:
+                        capture_exception()
+                        continue
+                    images9000.append(
+                        Image9000(
+                            attachment_id=attachment.id,
+                            message_id=message.id,
+                            user_id=message.author.id,
+                            channel_id=message.channel.id,
+                            server_id=message.guild.id,
+                            hash=perceptualization["visual_hash"],
+                            text=perceptualization["text"],
+                            sent_at=utc_to_naive_local(message.created_at),
+                        )
+                    )
+        if not images9000:
+            return
         try:
-            with data.session(commit=True) as session:
-                if is_user_opted_out_of_data_processing(session, message.author.id):
-                    return  # User opted out of data processing
-                if not message.attachments or message.guild is None:
-                    return
-                images9000 = []
-                for attachment in message.attachments:
-                    if attachment.height and attachment.width:
-                        image_bytes = io.BytesIO()
-                        try:
-                            await attachment.save(image_bytes)
-                        except (discord.HTTPException, discord.NotFound):
-                            continue
-                        else:
-                            try:
-                                perceptualization = await self._perceptualize(image_bytes)
-                            except:
-                                capture_exception()
-                                continue
-                            images9000.append(
-                                Image9000(
-                                    attachment_id=attachment.id,
-                                    message_id=message.id,
-                                    user_id=message.author.id,
-                                    channel_id=message.channel.id,
-                                    server_id=message.guild.id,
-                                    hash=perceptualization["visual_hash"],
-                                    text=perceptualization["text"],
-                                    sent_at=utc_to_naive_local(message.created_at),
-                                )
-                            )
-                session.bulk_save_objects(images9000)
-        except (psycopg2.errors.ForeignKeyViolation, psycopg2.errors.UniqueViolation):
+            async with data.async_session(commit=True) as session:
+                session.add_all(images9000)
+        except IntegrityError:
             pass
 
     @staticmethod
     def _rotate(image_bytes: BinaryIO, times: int):
-        image = PIL.Image.open(image_bytes)
+        image = Image.open(image_bytes)
         image_format = image.format
         image = image.rotate(-90 * times, expand=True)
         image_bytes = io.BytesIO()
@@ -138,15 +134,15 @@ class Imaging(commands.Cog, SomsiadMixin):
         elif number_of_passes > 3:
             number_of_passes = 3
         for _ in range(number_of_passes):
-            image = PIL.Image.open(image_bytes).convert("RGB")
+            image = Image.open(image_bytes).convert("RGB")
             aspect_ratio = image.width / image.height
             if image.width > MAX_SIZE and image.width > image.height:
                 image = image.resize((MAX_SIZE, int(MAX_SIZE / aspect_ratio)))
             elif image.height > MAX_SIZE:
                 image = image.resize((int(MAX_SIZE * aspect_ratio), MAX_SIZE))
-            image = PIL.ImageEnhance.Color(image).enhance(1.25)
-            image = PIL.ImageEnhance.Contrast(image).enhance(2)
-            image = PIL.ImageEnhance.Sharpness(image).enhance(2)
+            image = ImageEnhance.Color(image).enhance(1.25)
+            image = ImageEnhance.Contrast(image).enhance(2)
+            image = ImageEnhance.Sharpness(image).enhance(2)
             image_bytes = io.BytesIO()
             image.save(image_bytes, "JPEG", quality=1)
             image_bytes.seek(0)
@@ -164,7 +160,7 @@ class Imaging(commands.Cog, SomsiadMixin):
         except TesseractError:
             capture_exception()
             image_text = None
-        image = PIL.Image.open(image_bytes)
+        image = Image.open(image_bytes)
         image_hash = imagehash.phash(image, Image9000.HASH_SIZE)
         return {"text": image_text, "visual_hash": str(image_hash)}
 
@@ -216,7 +212,7 @@ class Imaging(commands.Cog, SomsiadMixin):
         if input_image_bytes:
             try:
                 output_image_bytes = await self.bot.loop.run_in_executor(None, self._rotate, input_image_bytes, times)
-            except PIL.Image.UnidentifiedImageError:
+            except Image.UnidentifiedImageError:
                 await self.bot.send(ctx, embed=self.bot.generate_embed("⚠️", "Nie znaleziono obrazka do obrócenia"))
             else:
                 await self.bot.send(
@@ -239,7 +235,7 @@ class Imaging(commands.Cog, SomsiadMixin):
                 output_image_bytes = await self.bot.loop.run_in_executor(
                     None, self._deepfry, input_image_bytes, doneness
                 )
-            except PIL.Image.UnidentifiedImageError:
+            except Image.UnidentifiedImageError:
                 await self.bot.send(ctx, embed=self.bot.generate_embed("⚠️", "Nie znaleziono obrazka do usmażenia"))
             else:
                 await self.bot.send(
@@ -29,7 +29,7 @@ class PinArchive(data.ServerSpecific, data.ChannelRelated, data.Base):
     class ChannelNotFound(Exception):
         pass
 
-    async def archive(self, bot: commands.Bot, channel: discord.TextChannel) -> Dict[str, int]:
+    async def archive(self, bot: Somsiad, channel: discord.TextChannel) -> Dict[str, int]:
         """Archives the provided message."""
         archive_channel = self.discord_channel(bot)
         if archive_channel is None:
@@ -65,14 +65,14 @@ class PinArchive(data.ServerSpecific, data.ChannelRelated, data.Base):
         if len(files) == 1:
             if message.attachments[0].height is not None:
                 pin_embed.set_image(url=f'attachment://{message.attachments[0].filename}')
-            await archive_channel.send(embed=pin_embed, file=files[0])
+            await bot.outbound.send(archive_channel, embed=pin_embed, file=files[0])
         elif len(files) > 1:
-            await archive_channel.send(embed=pin_embed, files=files)
+            await bot.outbound.send(archive_channel, embed=pin_embed, files=files)
         else:
             url_from_content = cast(str, first_url(message.content))
             if url_from_content is not None:
                 pin_embed.set_image(url=url_from_content)
-            await archive_channel.send(embed=pin_embed)
+            await bot.outbound.send(archive_channel, embed=pin_embed)
 
 
 class Pins(commands.Cog, SomsiadMixin):
@@ -11,19 +11,16 @@
 # You should have received a copy of the GNU General Public License along with Somsiad.
 # If not, see <https://www.gnu.org/licenses/>.
 
-import datetime as dt
 import re
-from typing import List, Optional
 from sqlalchemy.dialects import postgresql
 
-from sentry_sdk import capture_exception
 from somsiad import Somsiad
 
 import discord
 from discord.ext import commands
 
 import data
-from core import cooldown
+from core import cooldown, timer_scheduler
 from utilities import human_datetime, interpret_str_as_datetime, md_link, utc_to_naive_local
 
 
@@ -41,71 +38,43 @@ class Reminder(data.Base, data.ChannelRelated, data.UserRelated):
 class Remind(commands.Cog):
     def __init__(self, bot: Somsiad):
         self.bot = bot
-        self.reminders_set_off = set()
-
-    async def set_off_reminder(
-        self,
-        confirmation_message_id: int,
-        channel_id: int,
-        user_id: int,
-        content: str,
-        extra_mentions: Optional[List[str]],
-        requested_at: dt.datetime,
-        execute_at: dt.datetime,
-    ):
-        if confirmation_message_id in self.reminders_set_off:
-            return
-        self.reminders_set_off.add(confirmation_message_id)
-        try:
-            await discord.utils.sleep_until(execute_at.astimezone())
-        except ValueError:
-            capture_exception()
-            return
-        if confirmation_message_id not in self.reminders_set_off:
-            return
-        self.reminders_set_off.remove(confirmation_message_id)
-        channel = await self.bot.fetch_channel(channel_id)
+
+    async def cog_load(self):
+        timer_scheduler.register(
+            Reminder, self.set_off_reminder, due_column=Reminder.execute_at, done_column=Reminder.has_been_executed
+        )
+
+    async def cog_unload(self):
+        timer_scheduler.unregister(Reminder)
+
+    async def set_off_reminder(self, reminder: Reminder):
+        channel = await self.bot.fetch_channel(reminder.channel_id)
         try:
-            confirmation_message = await channel.fetch_message(confirmation_message_id)
+            confirmation_message = await channel.fetch_message(reminder.confirmation_message_id)
         except (AttributeError, discord.NotFound):
             pass
         else:
-            confirmation_message.mentions
             reminder_description = md_link(
-                f'Przypomnienie z {human_datetime(requested_at)}.', confirmation_message.jump_url
+                f'Przypomnienie z {human_datetime(reminder.requested_at)}.', confirmation_message.jump_url
             )
-            reminder_embed = self.bot.generate_embed('🍅', content, reminder_description, timestamp=execute_at)
-            mentions = [str(user_id)]
-            if extra_mentions:
-                for id in extra_mentions:
+            reminder_embed = self.bot.generate_embed(
+                '🍅', reminder.content, reminder_description, timestamp=reminder.execute_at
+            )
+            mentions = [str(reminder.user_id)]
+            if reminder.extra_mentions:
+                for id in reminder.extra_mentions:
                     if id not in mentions:
                         mentions.append(id)
             mentions_joined = ', '.join([f'<@{mention}>' for mention in mentions])
             reminder_message = await channel.send(mentions_joined, embed=reminder_embed)
+            timer_scheduler.mark_delivered()
             confirmation_description = md_link(
-                f'Przypomniano ci tutaj "{content}" {human_datetime()}.', reminder_message.jump_url
+                f'Przypomniano ci tutaj "{reminder.content}" {human_datetime()}.', reminder_message.jump_url
+            )
+            confirmation_embed = self.bot.generate_embed(
+                '🍅', 'Zrealizowano przypomnienie', confirmation_description, timestamp=reminder.execute_at
             )
-            confirmation_embed = self.bot.generate_embed('🍅', 'Zrealizowano przypomnienie', confirmation_description, timestamp=execute_at)
             await confirmation_message.edit(embed=confirmation_embed)
-        with data.session(commit=True) as session:
-            reminder = session.query(Reminder).get(confirmation_message_id)
-            reminder.has_been_executed = True
-
-    @commands.Cog.listener()
-    async def on_ready(self):
-        with data.session() as session:
-            for reminder in session.query(Reminder).filter(Reminder.has_been_executed == False):
-                self.bot.loop.create_task(
-                    self.set_off_reminder(
-                        reminder.confirmation_message_id,
-                        reminder.channel_id,
-                        reminder.user_id,
-                        reminder.content,
-                        reminder.extra_mentions,
-                        reminder.requested_at,
-                        reminder.execute_at,
-                    )
-                )
 
     @cooldown()
     @commands.command(aliases=['przypomnij', 'przypomnienie', 'pomidor'])
@@ -134,9 +103,8 @@ class Remind(commands.Cog):
                 'execute_at': execute_at,
             }
             with data.session(commit=True) as session:
-                reminder = Reminder(**details)
-                session.add(reminder)
-                self.bot.loop.create_task(self.set_off_reminder(**details))
+                session.add(Reminder(**details))
+            timer_scheduler.schedule(Reminder(**details))
         except:
             await confirmation_message.delete()
             raise
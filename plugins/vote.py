@@ -13,15 +13,14 @@
 
 import asyncio
 from collections import defaultdict
-import datetime as dt
 import re
-from typing import Any, DefaultDict, List, Optional, Set
+from typing import Any, DefaultDict, List, Optional
 
 import discord
 from discord.ext import commands
 
 import data
-from core import cooldown
+from core import cooldown, timer_scheduler
 from somsiad import Somsiad
 from utilities import human_datetime, interpret_str_as_datetime, md_link, utc_to_naive_local, word_number_form
 
@@ -90,38 +89,28 @@ class Vote(commands.Cog):
     }
     MAX_MATTER_LENGTH = 256 # Discord's embed title limit
 
-    ballots_set_off: Set[int]
     ballot_reaction_cleanup_tasks: DefaultDict[int, List[asyncio.Task]]
 
     def __init__(self, bot: Somsiad):
         self.bot = bot
-        self.ballots_set_off = set()
         self.ballot_reaction_cleanup_tasks = defaultdict(list)
 
-    async def set_off_ballot(
-        self,
-        urn_message_id: int,
-        channel_id: int,
-        user_id: int,
-        matter: str,
-        letters: Optional[str],
-        numeric_scale_max: Optional[int],
-        commenced_at: dt.datetime,
-        conclude_at: dt.datetime,
-    ):
-        if urn_message_id in self.ballots_set_off:
-            return
-        self.ballots_set_off.add(urn_message_id)
-        await discord.utils.sleep_until(conclude_at.astimezone())  # Waiting till conclusion
-        if urn_message_id not in self.ballots_set_off:
-            return
-        self.ballots_set_off.remove(urn_message_id)
-        channel = await self.bot.fetch_channel(channel_id)
+    async def cog_load(self):
+        timer_scheduler.register(
+            Ballot, self.set_off_ballot, due_column=Ballot.conclude_at, done_column=Ballot.has_been_concluded
+        )
+
+    async def cog_unload(self):
+        timer_scheduler.unregister(Ballot)
+
+    async def set_off_ballot(self, ballot: Ballot):
+        channel = await self.bot.fetch_channel(ballot.channel_id)
         try:
-            urn_message = await channel.fetch_message(urn_message_id)
+            urn_message = await channel.fetch_message(ballot.urn_message_id)
         except (AttributeError, discord.NotFound):
             pass
         else:
+            letters, numeric_scale_max = ballot.letters, ballot.numeric_scale_max
             emojis = self._list_answers(letters=letters, numeric_scale_max=numeric_scale_max)
             reactions_with_users = await asyncio.gather(
                 *(self._resolve_reaction_with_user_count(reaction) for reaction in urn_message.reactions)
@@ -154,10 +143,10 @@ class Vote(commands.Cog):
                     winning_emoji = '❓'
 
             results_description = md_link(
-                f'Wyniki głosowania ogłoszonego {human_datetime(commenced_at)}.', urn_message.jump_url
+                f'Wyniki głosowania ogłoszonego {human_datetime(ballot.commenced_at)}.', urn_message.jump_url
             )
-            urn_embed = self.bot.generate_embed(winning_emoji, matter)
-            results_embed = self.bot.generate_embed(winning_emoji, matter, results_description)
+            urn_embed = self.bot.generate_embed(winning_emoji, ballot.matter)
+            results_embed = self.bot.generate_embed(winning_emoji, ballot.matter, results_description)
             if letters:
                 positions = (f'Opcja {letter}' for letter in letters)
             elif numeric_scale_max:
@@ -179,14 +168,12 @@ class Vote(commands.Cog):
                 numeric_result_presentation = f'{numeric_result:.2f}'
                 urn_embed.add_field(name='Średnia', value=numeric_result_presentation, inline=False)
                 results_embed.add_field(name='Średnia', value=numeric_result_presentation, inline=False)
-            results_message = await channel.send(f'<@{user_id}>', embed=results_embed)
+            results_message = await channel.send(f'<@{ballot.user_id}>', embed=results_embed)
+            timer_scheduler.mark_delivered()
             urn_embed.description = md_link(
                 f'Głosowanie zostało zakończone {human_datetime()}.', results_message.jump_url
             )
             await urn_message.edit(embed=urn_embed)
-        with data.session(commit=True) as session:
-            reminder = session.query(Ballot).get(urn_message_id)
-            reminder.has_been_concluded = True
 
     @staticmethod
     async def _resolve_reaction_with_user_count(reaction: discord.Reaction) -> tuple[Any, int]:
@@ -197,23 +184,6 @@ class Vote(commands.Cog):
             count += 1
         return (reaction.emoji, count)
 
-    @commands.Cog.listener()
-    async def on_ready(self):
-        with data.session() as session:
-            for reminder in session.query(Ballot).filter(Ballot.has_been_concluded == False):
-                self.bot.loop.create_task(
-                    self.set_off_ballot(
-                        reminder.urn_message_id,
-                        reminder.channel_id,
-                        reminder.user_id,
-                        reminder.matter,
-                        reminder.letters,
-                        reminder.numeric_scale_max,
-                        reminder.commenced_at,
-                        reminder.conclude_at,
-                    )
-                )
-
     @cooldown()
     @commands.command(aliases=['głosowanie', 'glosowanie', 'poll', 'ankieta'])
     async def vote(
@@ -260,9 +230,8 @@ class Vote(commands.Cog):
             }
             if conclude_at is not None:
                 with data.session(commit=True) as session:
-                    reminder = Ballot(**details)
-                    session.add(reminder)
-                    self.bot.loop.create_task(self.set_off_ballot(**details))
+                    session.add(Ballot(**details))
+                timer_scheduler.schedule(Ballot(**details))
         except discord.Forbidden:
             await urn_message.delete()
             embed = self.bot.generate_embed('⚠️', 'Bot nie ma uprawnień do dodawania reakcji')
@@ -16,13 +16,14 @@ if env_ptvsd:
 
 import signal
 import asyncio
+import sys
 import sentry_sdk
 from sentry_sdk.integrations.aiohttp import AioHttpIntegration
 from sentry_sdk.integrations.sqlalchemy import SqlalchemyIntegration
 from discord.utils import setup_logging
 
+import cluster
 from configuration import configuration
-from core import Essentials, Prefix, somsiad
 from version import __version__
 
 logger = logging.getLogger(__name__)
@@ -30,6 +31,11 @@ logger = logging.getLogger(__name__)
 
 if __name__ == '__main__':
     setup_logging()
+    if configuration['cluster_worker_count'] > 1 and cluster.WORKER_ID_VARIABLE not in os.environ:
+        # This is the supervisor, which runs this very script once per worker
+        sys.exit(cluster.launch(configuration['cluster_worker_count'], sys.argv))
+    from core import Essentials, Prefix, somsiad  # Only workers need the bot itself
+
     signal.signal(signal.SIGTERM, somsiad.signal_handler)
     signal.signal(signal.SIGINT, somsiad.signal_handler)
     if configuration['sentry_dsn']:
@@ -13,23 +13,33 @@
 
 import asyncio
 import datetime as dt
+import functools
+import heapq
 import itertools
 import logging
+import math
 import os
 import random
+import re
 import sys
+import threading
+import time
 import traceback
-from collections import defaultdict
+from collections import Counter, defaultdict
 from types import FrameType
 from typing import (
     Any,
     Callable,
+    Collection,
     Coroutine,
     DefaultDict,
     Dict,
+    Iterable,
     List,
     Optional,
+    Pattern,
     Sequence,
+    Set,
     Tuple,
     Type,
     Union,
@@ -44,10 +54,30 @@ import aiochclient
 from discord.ext import commands
 from discord.utils import utcnow
 from multidict import CIMultiDict
+from sqlalchemy import select
 
+import cluster
 import data
+from cache import (
+    async_redis_connection,
+    change_commands_being_processed,
+    clear_commands_being_processed,
+    read_commands_being_processed,
+    read_prefixes,
+    write_prefixes,
+)
 from configuration import configuration
-from utilities import AI_ALLOWED_SERVER_IDS, GoogleClient, YouTubeClient, localize, text_snippet, utc_to_naive_local
+from utilities import (
+    AI_ALLOWED_SERVER_IDS,
+    GoogleClient,
+    LazyModule,
+    YouTubeClient,
+    localize,
+    pack_greedily,
+    text_snippet,
+    utc_to_naive_local,
+    warm_ups,
+)
 from version import __version__
 
 logger = logging.getLogger(__name__)
@@ -64,6 +94,440 @@ class OptedOutOfDataProcessing(commands.CommandError):
     pass
 
 
+class PrefixMatcher:
+    """Longest-match matcher of a fixed set of command prefixes, compiled once into a single regex."""
+
+    __slots__ = ('prefixes', '_regex')
+
+    prefixes: List[str]
+    _regex: Pattern
+
+    def __init__(self, prefixes: Iterable[str]):
+        self.prefixes = sorted(set(prefixes), key=len, reverse=True)  # Regex alternation takes the first match
+        self._regex = re.compile('|'.join(map(re.escape, self.prefixes)))
+
+    def match(self, content: str) -> List[str]:
+        """Return just the matching prefix if there is one, otherwise all prefixes (so that none matches)."""
+        match = self._regex.match(content)
+        return [match.group()] if match is not None else self.prefixes
+
+
+class PopulationCounter:
+    """Server and user counts maintained incrementally from gateway events, so that reading them is O(1).
+
+    Servers with "bot" in their name (bot testing/listing servers) are not counted. A user is counted once however many
+    counted servers they share with the bot, which is what the per-user reference count is for. As gateway events can
+    be missed (e.g. during a reconnect), the counts should be reconciled with the cache occasionally.
+
+    Users who joined since the last `take_user_id_changes()` are tracked, so that the worker's user ID HyperLogLog in
+    Redis can be extended incrementally. A HyperLogLog can't forget, so users who left are only dropped from it when
+    it's rebuilt from scratch, which happens after every reconciliation.
+    """
+
+    server_ids: Set[int]
+    user_reference_counts: Counter
+    _added_user_ids: Set[int]
+    _synced: bool
+
+    def __init__(self):
+        self.server_ids = set()
+        self.user_reference_counts = Counter()
+        self._added_user_ids = set()
+        self._synced = False
+
+    @property
+    def server_count(self) -> int:
+        return len(self.server_ids)
+
+    @property
+    def user_count(self) -> int:
+        return len(self.user_reference_counts)
+
+    @staticmethod
+    def is_counted(server: discord.Guild) -> bool:
+        return not server.name or 'bot' not in server.name.lower()
+
+    def add_server(self, server: discord.Guild):
+        if server.id in self.server_ids or not self.is_counted(server):
+            return
+        self.server_ids.add(server.id)
+        for member in server.members:
+            self._acquire_user(member.id)
+
+    def remove_server(self, server: discord.Guild):
+        if server.id not in self.server_ids:
+            return
+        self.server_ids.remove(server.id)
+        for member in server.members:
+            self._release_user(member.id)
+
+    def add_member(self, member: discord.Member):
+        if member.guild.id in self.server_ids:
+            self._acquire_user(member.id)
+
+    def remove_member(self, member: discord.Member):
+        if member.guild.id in self.server_ids:
+            self._release_user(member.id)
+
+    def reconcile(self, servers: Iterable[discord.Guild]):
+        """Recount everything from scratch. This is a full scan of all members, so only do it occasionally."""
+        counted_servers = [server for server in servers if self.is_counted(server)]
+        self.server_ids = {server.id for server in counted_servers}
+        self.user_reference_counts = Counter(member.id for server in counted_servers for member in server.members)
+        self.mark_unsynced()
+
+    def take_user_id_changes(self) -> Tuple[bool, Collection[int]]:
+        """Return whether the HyperLogLog must be rebuilt, and the user IDs to add to it (all of them if so)."""
+        if self._synced:
+            user_ids: Collection[int] = self._added_user_ids
+        else:
+            user_ids = list(self.user_reference_counts)
+        replace = not self._synced
+        self._added_user_ids = set()
+        self._synced = True
+        return replace, user_ids
+
+    def mark_unsynced(self):
+        """Make the next `take_user_id_changes()` request a rebuild, e.g. because writing the last changes failed."""
+        self._synced = False
+        self._added_user_ids = set()
+
+    def _acquire_user(self, user_id: int):
+        if not self.user_reference_counts[user_id] and self._synced:
+            self._added_user_ids.add(user_id)
+        self.user_reference_counts[user_id] += 1
+
+    def _release_user(self, user_id: int):
+        if self.user_reference_counts[user_id] <= 1:
+            self.user_reference_counts.pop(user_id, None)
+        else:
+            self.user_reference_counts[user_id] -= 1
+
+
+class LatencyHistogram:
+    """Latency histogram with logarithmic buckets, so that percentiles have a bounded relative error.
+
+    Bucket 0 holds everything up to `MIN_SECONDS`, and each next bucket is `GROWTH` times wider than the previous one.
+    With a growth of 2^(1/4), a reported percentile is at most ~19% above the actual value.
+    """
+
+    __slots__ = ('counts', 'count', 'sum')
+
+    MIN_SECONDS = 0.001
+    GROWTH = 2 ** 0.25
+    BUCKET_COUNT = 81  # Up to ~17 minutes, everything longer lands in the last bucket
+
+    counts: List[int]
+    count: int
+    sum: float
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKET_COUNT
+        self.count = 0
+        self.sum = 0.0
+
+    @classmethod
+    def bucket_upper_bound(cls, index: int) -> float:
+        return cls.MIN_SECONDS * cls.GROWTH**index
+
+    def record(self, seconds: float):
+        if seconds <= self.MIN_SECONDS:
+            index = 0
+        else:
+            index = min(math.ceil(math.log(seconds / self.MIN_SECONDS, self.GROWTH)), self.BUCKET_COUNT - 1)
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Return the upper bound of the bucket containing the q-quantile, or None if nothing was recorded."""
+        if not self.count:
+            return None
+        threshold = q * self.count
+        cumulative_count = 0
+        for index, bucket_count in enumerate(self.counts):
+            cumulative_count += bucket_count
+            if cumulative_count >= threshold:
+                return self.bucket_upper_bound(index)
+        return self.bucket_upper_bound(self.BUCKET_COUNT - 1)
+
+
+class CommandMetrics:
+    """Per-command latency histograms, split into phases:
+    queue (message creation to invocation), execution (invocation to completion) and send (Discord API calls of
+    `Somsiad.send`).
+    """
+
+    PHASES = ('queue', 'execution', 'send')
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    histograms: DefaultDict[str, Dict[str, LatencyHistogram]]
+
+    def __init__(self):
+        self.histograms = defaultdict(lambda: {phase: LatencyHistogram() for phase in self.PHASES})
+
+    def record(self, command_name: str, phase: str, seconds: float):
+        self.histograms[command_name][phase].record(max(seconds, 0.0))
+
+    def summarize(self) -> Dict[str, Dict[str, Dict[str, Optional[float]]]]:
+        """Return count, sum and p50/p95/p99 (in seconds) of each phase of each command."""
+        return {
+            command_name: {
+                phase: {
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    **{f'p{round(q * 100)}': histogram.quantile(q) for q in self.QUANTILES},
+                }
+                for phase, histogram in phase_histograms.items()
+            }
+            for command_name, phase_histograms in self.histograms.items()
+        }
+
+
+class EventLoopWatchdog:
+    """Detects the event loop being blocked by synchronous code, and captures what is blocking it.
+
+    A ticker on the loop stamps the time every `TICK_SECONDS`. A daemon thread checks the stamp, and once it's over
+    `LAG_THRESHOLD_SECONDS` late, samples the loop thread's stack - at that moment the blocking call is still on it.
+    When the loop gets back, the stall is logged, and reported to Sentry and the system channel (at most once per
+    `REPORT_COOLDOWN_SECONDS` for a given location). Each tick is a single sleep on the loop and a single comparison
+    in the thread, so the watchdog can stay on in production.
+    """
+
+    TICK_SECONDS = 0.1
+    LAG_THRESHOLD_SECONDS = 0.5
+    REPORT_COOLDOWN_SECONDS = 600
+    PROJECT_PATH = os.path.dirname(os.path.abspath(__file__))
+
+    def __init__(self, bot: 'Somsiad'):
+        self.bot = bot
+        self._last_tick_at = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+        self._stall_sample: Optional[Tuple[float, traceback.StackSummary]] = None
+        self._last_reported_at: Dict[str, float] = {}
+        self._ticker: Optional[asyncio.Task] = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._ticker = asyncio.get_running_loop().create_task(self._tick())
+        threading.Thread(target=self._watch, name='event-loop-watchdog', daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._ticker is not None:
+            self._ticker.cancel()
+
+    async def _tick(self):
+        self._loop_thread_id = threading.get_ident()
+        while True:
+            tick_at = time.monotonic()
+            self._last_tick_at = tick_at
+            await asyncio.sleep(self.TICK_SECONDS)
+            lag = time.monotonic() - tick_at - self.TICK_SECONDS
+            if lag >= self.LAG_THRESHOLD_SECONDS:
+                stall_sample, self._stall_sample = self._stall_sample, None
+                # A sample taken during an earlier stall mustn't be blamed for this one
+                self._report(lag, stall_sample[1] if stall_sample is not None and stall_sample[0] == tick_at else None)
+
+    def _watch(self):
+        while not self._stopped.wait(self.TICK_SECONDS):
+            last_tick_at = self._last_tick_at
+            if (
+                time.monotonic() - last_tick_at > self.TICK_SECONDS + self.LAG_THRESHOLD_SECONDS
+                and (self._stall_sample is None or self._stall_sample[0] != last_tick_at)
+            ):
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._stall_sample = (last_tick_at, traceback.extract_stack(frame))
+
+    def _find_offending_frame(self, stack: traceback.StackSummary) -> traceback.FrameSummary:
+        """Return the innermost frame of our own code, as that's what made the blocking call."""
+        for frame in reversed(stack):
+            if frame.filename.startswith(self.PROJECT_PATH) and 'site-packages' not in frame.filename:
+                return frame
+        return stack[-1]
+
+    def _report(self, lag: float, stack: Optional[traceback.StackSummary]):
+        if stack:
+            frame = self._find_offending_frame(stack)
+            location = f'{os.path.relpath(frame.filename, self.PROJECT_PATH)}:{frame.lineno} in {frame.name}'
+        else:
+            location = 'unknown location'
+        logger.warning(f'Event loop blocked for {lag:.2f} s at {location}')
+        now = time.monotonic()
+        if now - self._last_reported_at.get(location, -math.inf) < self.REPORT_COOLDOWN_SECONDS:
+            return
+        self._last_reported_at[location] = now
+        formatted_stack = ''.join(stack.format()) if stack else None
+        if configuration['sentry_dsn']:
+            with sentry_sdk.push_scope() as scope:
+                scope.set_tag('event_method', 'event_loop_watchdog')
+                scope.set_extra('lag_seconds', lag)
+                scope.set_extra('stack', formatted_stack)
+                sentry_sdk.capture_message(f'Event loop blocked at {location}', level='warning')
+        self.bot.loop.create_task(
+            self.bot.system_notify(
+                '🐢',
+                f'Pętla zdarzeń zablokowana na {round(lag, 2):n} s',
+                f'```{(formatted_stack or location)[-4000:]}```',  # The innermost frames matter most
+            )
+        )
+
+
+class OutboundQueue:
+    """Central queue of outbound Discord messages and message edits, keyed by channel.
+
+    Each channel is drained by its own worker, which spends the channel's rate limit budget - modeled as a token bucket
+    matching Discord's per-channel limit of `CHANNEL_BUDGET` requests per `CHANNEL_BUDGET_REFILL_SECONDS` - on the most
+    important operation first, i.e. interactive replies before background traffic. A queued edit of a message is
+    superseded by a newer edit of the same message, so that only the latest version goes out, with the higher of the two
+    priorities.
+    """
+
+    INTERACTIVE = 0
+    BACKGROUND = 1
+    CHANNEL_BUDGET = 5
+    CHANNEL_BUDGET_REFILL_SECONDS = 5.0
+
+    class Operation:
+        __slots__ = ('function', 'futures', 'merge_key', 'priority')
+
+        def __init__(self, function: Callable[[], Coroutine[Any, Any, Any]], merge_key: Optional[int], priority: int):
+            self.function = function
+            self.futures: List[asyncio.Future] = []
+            self.merge_key = merge_key
+            self.priority = priority
+
+    class Channel:
+        __slots__ = ('heap', 'pending_edits', 'tokens', 'refilled_at', 'worker')
+
+        def __init__(self, budget: float):
+            self.heap: List[Tuple[int, int, 'OutboundQueue.Operation']] = []
+            self.pending_edits: Dict[int, 'OutboundQueue.Operation'] = {}
+            self.tokens = budget
+            self.refilled_at = time.monotonic()
+            self.worker: Optional[asyncio.Task] = None
+
+    _channels: Dict[Tuple[str, int], Channel]
+
+    def __init__(self):
+        self._channels = {}
+        self._sequence = itertools.count()
+
+    @staticmethod
+    def key(destination: Union[discord.abc.Messageable, discord.abc.Snowflake]) -> Tuple[str, int]:
+        """Identify the destination's channel (users and members stand for their DM channels)."""
+        return ('user' if isinstance(destination, discord.abc.User) else 'channel', destination.id)
+
+    async def send(
+        self, destination: discord.abc.Messageable, *args, priority: int = BACKGROUND, **kwargs
+    ) -> discord.Message:
+        return await self.submit(self.key(destination), functools.partial(destination.send, *args, **kwargs), priority)
+
+    async def reply(self, message: discord.Message, *args, priority: int = INTERACTIVE, **kwargs) -> discord.Message:
+        return await self.submit(self.key(message.channel), functools.partial(message.reply, *args, **kwargs), priority)
+
+    async def edit(self, message: discord.Message, *, priority: int = BACKGROUND, **kwargs) -> discord.Message:
+        """Edit the message, unless a newer edit of it gets queued in the meantime (then both get its result)."""
+        return await self.submit(
+            self.key(message.channel), functools.partial(message.edit, **kwargs), priority, merge_key=message.id
+        )
+
+    def edit_in_background(self, message: discord.Message, *, priority: int = BACKGROUND, **kwargs):
+        """Like `edit`, but without waiting for the edit to go out, e.g. for progress updates."""
+        future = self.enqueue(
+            self.key(message.channel), functools.partial(message.edit, **kwargs), priority, merge_key=message.id
+        )
+        future.add_done_callback(
+            lambda future: future.cancelled()
+            or future.exception() is None
+            or logger.warning(f'Background edit of message {message.id} failed: {future.exception()}')
+        )
+
+    async def submit(
+        self,
+        key: Tuple[str, int],
+        function: Callable[[], Coroutine[Any, Any, Any]],
+        priority: int,
+        *,
+        merge_key: Optional[int] = None,
+    ) -> Any:
+        return await self.enqueue(key, function, priority, merge_key=merge_key)
+
+    def enqueue(
+        self,
+        key: Tuple[str, int],
+        function: Callable[[], Coroutine[Any, Any, Any]],
+        priority: int,
+        *,
+        merge_key: Optional[int] = None,
+    ) -> asyncio.Future:
+        """Queue the operation right away, returning a future of its result."""
+        loop = asyncio.get_running_loop()
+        channel = self._channels.get(key)
+        if channel is None:
+            channel = self._channels[key] = self.Channel(self.CHANNEL_BUDGET)
+        operation = channel.pending_edits.get(merge_key) if merge_key is not None else None
+        if operation is not None:
+            operation.function = function  # The queued edit is superseded
+            if priority < operation.priority:
+                # The heap can't be reprioritized in place, so push anew, leaving the old entry to be skipped
+                operation.priority = priority
+                heapq.heappush(channel.heap, (priority, next(self._sequence), operation))
+        else:
+            operation = self.Operation(function, merge_key, priority)
+            if merge_key is not None:
+                channel.pending_edits[merge_key] = operation
+            heapq.heappush(channel.heap, (priority, next(self._sequence), operation))
+        future = loop.create_future()
+        operation.futures.append(future)
+        if channel.worker is None or channel.worker.done():
+            channel.worker = loop.create_task(self._drain(key, channel))
+        return future
+
+    async def _drain(self, key: Tuple[str, int], channel: Channel):
+        while self._discard_superseded(channel):
+            await self._spend_token(channel)
+            self._discard_superseded(channel)  # Something may have been reprioritized in the meantime
+            _, _, operation = heapq.heappop(channel.heap)
+            if operation.merge_key is not None:
+                channel.pending_edits.pop(operation.merge_key, None)
+            try:
+                result = await operation.function()
+            except Exception as e:
+                for future in operation.futures:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for future in operation.futures:
+                    if not future.done():
+                        future.set_result(result)
+        # Forget the channel once its budget is fully refilled, unless it's busy again by then
+        asyncio.get_running_loop().call_later(self.CHANNEL_BUDGET_REFILL_SECONDS, self._forget_if_idle, key, channel)
+
+    @staticmethod
+    def _discard_superseded(channel: Channel) -> bool:
+        """Pop heap entries left behind by reprioritized operations off the top, returning whether any entry is left."""
+        while channel.heap and channel.heap[0][0] != channel.heap[0][2].priority:
+            heapq.heappop(channel.heap)
+        return bool(channel.heap)
+
+    def _forget_if_idle(self, key: Tuple[str, int], channel: Channel):
+        if self._channels.get(key) is channel and (channel.worker is None or channel.worker.done()):
+            del self._channels[key]
+
+    async def _spend_token(self, channel: Channel):
+        refill_rate = self.CHANNEL_BUDGET / self.CHANNEL_BUDGET_REFILL_SECONDS
+        now = time.monotonic()
+        channel.tokens = min(self.CHANNEL_BUDGET, channel.tokens + (now - channel.refilled_at) * refill_rate)
+        channel.refilled_at = now
+        if channel.tokens < 1:
+            await asyncio.sleep((1 - channel.tokens) / refill_rate)
+            channel.tokens = 1
+            channel.refilled_at = time.monotonic()
+        channel.tokens -= 1
+
+
 class Somsiad(commands.AutoShardedBot):
     COLOR = 0x5865F2
     USER_AGENT = f'SomsiadBot/{__version__}'
@@ -173,10 +637,21 @@ class Somsiad(commands.AutoShardedBot):
     storage_dir_path = os.path.join(os.path.expanduser('~'), '.local', 'share', 'somsiad')
     cache_dir_path = os.path.join(os.path.expanduser('~'), '.cache', 'somsiad')
 
+    POPULATION_RECONCILIATION_INTERVAL_SECONDS = 3600
+    MESSAGE_MAX_EMBEDS = 10
+    MESSAGE_MAX_EMBED_CHARACTERS = 6000
+    SCHEMA_LOCK_NAME = 'somsiad/lock/schema'
+    SCHEMA_LOCK_TIMEOUT_SECONDS = 300
+
     prefix_safe_aliases: Tuple[str]
+    prefix_safe_alias_regex: Pattern
     prefixes: Dict[int, Sequence[str]]
+    prefix_matchers: Dict[Optional[int], Tuple[PrefixMatcher, PrefixMatcher]]
+    population: PopulationCounter
+    command_metrics: CommandMetrics
+    event_loop_watchdog: EventLoopWatchdog
+    outbound: OutboundQueue
     diagnostics_on: bool
-    commands_being_processed: DefaultDict[str, int]
     ready_datetime: Optional[dt.datetime]
     session: aiohttp.ClientSession
     ch_client: aiochclient.ChClient
@@ -184,6 +659,7 @@ class Somsiad(commands.AutoShardedBot):
     youtube_client: Optional[YouTubeClient]
     system_channel: Optional[discord.TextChannel]
     public_channel: Optional[discord.TextChannel]
+    shutdown_hooks: List[Callable[[], Coroutine[Any, Any, None]]]
 
     def __init__(self):
         intents = discord.Intents.default()
@@ -196,53 +672,81 @@ class Somsiad(commands.AutoShardedBot):
             description='Zawsze pomocny Somsiad',
             case_insensitive=True,
             intents=intents,
+            shard_ids=cluster.layout.shard_ids,
+            shard_count=cluster.layout.shard_count,
         )
         if not os.path.exists(self.storage_dir_path):
             os.makedirs(self.storage_dir_path)
         if not os.path.exists(self.cache_dir_path):
             os.makedirs(self.cache_dir_path)
         self.prefix_safe_aliases = ()
+        self.prefix_safe_alias_regex = re.compile(r'(?!)')  # Never matches until commands are loaded
         self.prefixes = {}
+        self.prefix_matchers = {}
+        self.population = PopulationCounter()
+        self.command_metrics = CommandMetrics()
+        self.event_loop_watchdog = EventLoopWatchdog(self)
+        self.outbound = OutboundQueue()
+        self._schema_synchronized = asyncio.Event()
+        self._warm_up_task: Optional[asyncio.Task] = None
+        self._started_at = time.perf_counter()
+        self._population_reconciliation_task: Optional[asyncio.Task] = None
+        self._commands_being_processed_updates: Set[asyncio.Task] = set()
         self.diagnostics_on = False
-        self.commands_being_processed = defaultdict(int)
         self.ready_datetime = None
         self.google_client = None
         self.youtube_client = None
         self.system_channel = None
         self.public_channel = None
+        self.shutdown_hooks = []
 
     async def on_ready(self):
         psutil.cpu_percent()
         localize()
         self.ready_datetime = dt.datetime.now()
         assert await self.ch_client.is_alive()
+        self.population.reconcile(self.guilds)
+        if self._population_reconciliation_task is None or self._population_reconciliation_task.done():
+            self._population_reconciliation_task = self.loop.create_task(self.reconcile_population())
         logger.info('Preparing guilds data...')
-        data.Server.register_all(self.guilds)
-        with data.session(commit=True) as session:
-            for server in session.query(data.Server):
-                self.prefixes[server.id] = tuple(server.command_prefix.split('|')) if server.command_prefix else ()
-                if server.joined_at is None:
-                    discord_server = self.get_guild(server.id)
-                    if discord_server is not None and discord_server.me is not None:
-                        server.joined_at = utc_to_naive_local(discord_server.me.joined_at)
+        await data.Server.async_register_all(self.guilds)
+        async with data.async_session(commit=True) as session:
+            for server in (await session.execute(select(data.Server).where(data.Server.joined_at.is_(None)))).scalars():
+                discord_server = self.get_guild(server.id)
+                if discord_server is not None and discord_server.me is not None:
+                    server.joined_at = utc_to_naive_local(discord_server.me.joined_at)
         self.system_channel = cast(Optional[discord.TextChannel], await self.fetch_channel(517422572615499777))  # magic
         self.public_channel = cast(Optional[discord.TextChannel], await self.fetch_channel(479458695126974466))  # magic
         self.loop.create_task(self.cycle_presence())
-        logger.info('Somsiad ready!')
-        await self.system_notify('✅', 'Włączyłem się')
+        if self._warm_up_task is None:
+            self._warm_up_task = self.loop.create_task(self.warm_up())
+        logger.info(f'Somsiad ready in {time.perf_counter() - self._started_at:.2f} s!')
+        await self.system_notify(
+            '✅',
+            'Włączyłem się',
+            f'Proces {cluster.layout.worker_id + 1}/{cluster.layout.worker_count}, shardy {self.shard_ids}'
+            if cluster.layout.worker_count > 1
+            else None,
+        )
 
     async def on_error(self, event_method, *args, **kwargs):
         self.register_error(event_method, cast(Exception, sys.exc_info()[1]))
 
     async def on_command(self, ctx):
-        self.commands_being_processed[ctx.command.qualified_name] += 1
+        ctx._execution_started_at = time.perf_counter()
+        self.command_metrics.record(
+            ctx.command.qualified_name, 'queue', (utcnow() - ctx.message.created_at).total_seconds()
+        )
+        self._change_commands_being_processed(ctx, 1)
 
     async def on_command_completion(self, ctx):
-        self.commands_being_processed[ctx.command.qualified_name] -= 1
+        self._record_execution(ctx)
+        self._change_commands_being_processed(ctx, -1)
 
     async def on_command_error(self, ctx, error):
         if ctx.command is not None:
-            self.commands_being_processed[ctx.command.qualified_name] -= 1
+            self._record_execution(ctx)
+            self._change_commands_being_processed(ctx, -1)
         notice = None
         description = ''
         if isinstance(error, commands.NoPrivateMessage):
@@ -261,11 +765,46 @@ class Somsiad(commands.AutoShardedBot):
         if notice is not None:
             await self.send(ctx, embed=self.generate_embed('⚠️', notice, description))
 
+    def _change_commands_being_processed(self, ctx: commands.Context, change: int):
+        """Update the count of commands being processed in the background, so that Redis never holds up a command."""
+        update = self.loop.create_task(self._update_commands_being_processed(ctx.command.qualified_name, change))
+        self._commands_being_processed_updates.add(update)  # The loop only keeps weak references to tasks
+        update.add_done_callback(self._commands_being_processed_updates.discard)
+
+    async def _update_commands_being_processed(self, command_name: str, change: int):
+        try:
+            await change_commands_being_processed(cluster.layout.worker_id, command_name, change)
+        except Exception as e:
+            self.register_error('change_commands_being_processed', e)
+
+    def _record_execution(self, ctx: commands.Context):
+        execution_started_at = getattr(ctx, '_execution_started_at', None)
+        if execution_started_at is not None:
+            self.command_metrics.record(
+                ctx.command.qualified_name, 'execution', time.perf_counter() - execution_started_at
+            )
+
     async def on_guild_join(self, server):
-        data.Server.register(server)
+        self.population.add_server(server)
+        await data.Server.async_register(server)
+
+    async def on_guild_remove(self, server):
+        self.population.remove_server(server)
+
+    async def on_guild_update(self, before, after):
+        if PopulationCounter.is_counted(before) != PopulationCounter.is_counted(after):
+            self.population.remove_server(before)
+            self.population.add_server(after)
+
+    async def on_member_join(self, member):
+        self.population.add_member(member)
+
+    async def on_member_remove(self, member):
+        self.population.remove_member(member)
 
     async def add_cog(self, cog: commands.Cog, /, **kwargs) -> None:
-        data.create_all_tables()
+        # cog_load hooks may use the database, so they have to wait for the schema to be synchronized
+        await self._schema_synchronized.wait()
         return await super().add_cog(cog, **kwargs)
 
     async def load_and_start(self, cogs: Optional[Sequence[Type[commands.Cog]]] = None):
@@ -284,12 +823,24 @@ class Somsiad(commands.AutoShardedBot):
                     if configuration.get('google_custom_search_engine_id') is not None:
                         self.google_client = GoogleClient(configuration['google_key'], configuration['google_custom_search_engine_id'])
                 logger.info('Loading extensions...')
-                if cogs:
-                    for cog in cogs:
-                        await self.add_cog(cog(self))
+                phase_started_at = time.perf_counter()
                 plugins = [path.name[:-3] for path in os.scandir('plugins') if path.is_file() and path.name.endswith('.py')]
-                for plugin_name in plugins:
-                    await self.load_extension(f'plugins.{plugin_name}')
+                loading_tasks = [self.loop.create_task(self.add_cog(cog(self))) for cog in cogs or ()]
+                loading_tasks.extend(
+                    self.loop.create_task(self.load_extension(f'plugins.{plugin_name}')) for plugin_name in plugins
+                )
+                # Each task's first step executes its module synchronously, then blocks on the schema in add_cog,
+                # so once they all got to run, all models are defined
+                await asyncio.sleep(0)
+                logger.info(f'Imported {len(plugins)} extensions in {time.perf_counter() - phase_started_at:.2f} s')
+                phase_started_at = time.perf_counter()
+                async with async_redis_connection.lock(self.SCHEMA_LOCK_NAME, timeout=self.SCHEMA_LOCK_TIMEOUT_SECONDS):
+                    await asyncio.to_thread(data.create_all_tables)  # Workers of a cluster mustn't race on DDL
+                self._schema_synchronized.set()
+                logger.info(f'Synchronized database schema in {time.perf_counter() - phase_started_at:.2f} s')
+                phase_started_at = time.perf_counter()
+                await asyncio.gather(*loading_tasks)
+                logger.info(f'Loaded {len(self.cogs)} cogs in {time.perf_counter() - phase_started_at:.2f} s')
                 self.prefix_safe_aliases = tuple(
                     (
                         variant
@@ -301,6 +852,9 @@ class Somsiad(commands.AutoShardedBot):
                         )
                     )
                 )
+                self._compile_prefix_safe_alias_regex()
+                await clear_commands_being_processed(cluster.layout.worker_id)
+                self.event_loop_watchdog.start()
                 await self.start(configuration['discord_token'], reconnect=True)
 
     async def system_notify(
@@ -321,6 +875,12 @@ class Somsiad(commands.AutoShardedBot):
     async def close(self, code: int = 0):
         logger.info('Stopping the bot...')
         await self.system_notify(*(('🛑', 'Wyłączam się…') if not code else ('🔁', 'Restartuję się…')))
+        for shutdown_hook in self.shutdown_hooks:
+            try:
+                await shutdown_hook()
+            except Exception as e:
+                self.register_error('close', e)
+        self.event_loop_watchdog.stop()
         if self.session is not None:
             await self.session.close()
         await super().close()
@@ -335,18 +895,27 @@ class Somsiad(commands.AutoShardedBot):
 
     @property
     def server_count(self) -> int:
-        return len([server.id for server in self.guilds if not server.name or 'bot' not in server.name.lower()])
+        return self.population.server_count
 
     @property
     def user_count(self) -> int:
-        return len(
-            {
-                member.id
-                for server in self.guilds
-                for member in server.members
-                if not server.name or 'bot' not in server.name.lower()
-            }
-        )
+        return self.population.user_count
+
+    async def reconcile_population(self):
+        """Periodically correct any drift of the incrementally maintained population counts."""
+        while True:
+            await asyncio.sleep(self.POPULATION_RECONCILIATION_INTERVAL_SECONDS)
+            self.population.reconcile(self.guilds)
+
+    async def warm_up(self):
+        """Import lazily loaded modules and initialize heavy clients in the background, one at a time."""
+        started_at = time.perf_counter()
+        for load in (*(lazy_module.load for lazy_module in LazyModule.instances), *warm_ups):
+            try:
+                await asyncio.to_thread(load)
+            except Exception as e:
+                self.register_error('warm_up', e)
+        logger.info(f'Warmed up in {time.perf_counter() - started_at:.2f} s')
 
     async def cycle_presence(self):
         """Cycle through prefix safe commands in the presence."""
@@ -400,9 +969,11 @@ class Somsiad(commands.AutoShardedBot):
         elif isinstance(embed, discord.Embed):
             embeds = [embed]
         else:
-            if len(embed) > 10:
-                raise ValueError('no more than 10 embeds can be sent at the same time!')
             embeds = list(embed)
+        # len() of an embed is its character count the way Discord limits it
+        embed_packs = pack_greedily(
+            embeds, max_count=self.MESSAGE_MAX_EMBEDS, max_size=self.MESSAGE_MAX_EMBED_CHARACTERS
+        )
         destination = cast(discord.abc.Messageable, ctx.author if direct else ctx.channel)
         direct = direct or isinstance(destination, discord.abc.PrivateChannel)
         if direct:
@@ -420,7 +991,7 @@ class Somsiad(commands.AutoShardedBot):
         if self.diagnostics_on and ctx.author.id == self.owner_id:
             if content is None:
                 content = ''
-            content += self.format_diagnostics(ctx)
+            content += await self.format_diagnostics(ctx)
         if direct and not isinstance(ctx.channel, discord.abc.PrivateChannel):
             try:
                 await ctx.message.add_reaction('📫')
@@ -428,20 +999,34 @@ class Somsiad(commands.AutoShardedBot):
                 pass
         messages = []
         initial_send_function = cast(
-            Callable[..., Coroutine[Any, Any, discord.Message]], ctx.message.reply if reply else destination.send
+            Callable[..., Coroutine[Any, Any, discord.Message]],
+            functools.partial(self.outbound.reply, ctx.message)
+            if reply
+            else functools.partial(self.outbound.send, destination),
         )
+        send_started_at = time.perf_counter()
         try:
             messages = [
                 await initial_send_function(
                     content,
-                    embed=embeds[0] if embeds else None,
+                    embeds=embed_packs[0] if embed_packs else [],
                     file=file,
                     files=files,
                     delete_after=delete_after,
+                    priority=OutboundQueue.INTERACTIVE,
                 )
             ]
-            for extra_embed in embeds[1:]:
-                messages.append(await destination.send(embed=extra_embed, delete_after=delete_after))
+            for extra_embed_pack in embed_packs[1:]:
+                messages.append(
+                    await self.outbound.send(
+                        destination,
+                        embeds=extra_embed_pack,
+                        delete_after=delete_after,
+                        priority=OutboundQueue.INTERACTIVE,
+                    )
+                )
+            if getattr(ctx, 'command', None) is not None:
+                self.command_metrics.record(ctx.command.qualified_name, 'send', time.perf_counter() - send_started_at)
         except (discord.Forbidden, discord.NotFound):
             if ctx.guild is None or 'bot' in ctx.guild.name.lower():
                 return None
@@ -483,10 +1068,11 @@ class Somsiad(commands.AutoShardedBot):
     def get_random_emoji(self) -> str:
         return random.choice(self.EMOJIS)
 
-    def format_diagnostics(self, ctx: commands.Context) -> str:
+    async def format_diagnostics(self, ctx: commands.Context) -> str:
         processing_timedelta = utcnow() - ctx.message.created_at
+        commands_being_processed = await read_commands_being_processed(cluster.layout.worker_count)
         now_also = ', '.join(
-            (f'{command} ({number})' for command, number in self.commands_being_processed.items() if number > 0)
+            (f'{command} ({number})' for command, number in commands_being_processed.items() if number > 0)
         )
         process = psutil.Process()
         virtual_memory = psutil.virtual_memory()
@@ -539,24 +1125,57 @@ class Somsiad(commands.AutoShardedBot):
                         scope.set_context('server', {'id': ctx.guild.id, 'name': str(ctx.guild)})
                 sentry_sdk.capture_exception(error)
 
-    def _get_prefix(self, bot: commands.Bot, message: discord.Message) -> List[str]:
-        if message.guild is not None:
-            if message.guild.id not in AI_ALLOWED_SERVER_IDS:
-                prefixes = [f'<@!{bot.user.id}> ', f'<@{bot.user.id}> ', f'{bot.user} ']
+    def _compile_prefix_safe_alias_regex(self):
+        if self.prefix_safe_aliases:
+            self.prefix_safe_alias_regex = re.compile(
+                '|'.join(map(re.escape, self.prefix_safe_aliases)), re.IGNORECASE
+            )
+        self.prefix_matchers.clear()
+
+    def set_prefixes(self, server_id: int, prefixes: Sequence[str]):
+        self.prefixes[server_id] = tuple(prefixes)
+        self.prefix_matchers.pop(server_id, None)
+
+    async def store_prefixes(self, server_id: int, prefixes: Sequence[str]):
+        """Set the server's prefixes for this worker and share them with the rest of the cluster."""
+        self.set_prefixes(server_id, prefixes)
+        await write_prefixes(server_id, prefixes)
+
+    async def _load_prefixes(self, server_id: int):
+        prefixes = await read_prefixes(server_id)
+        if prefixes is None:
+            async with data.async_session() as session:
+                command_prefix = (
+                    await session.execute(select(data.Server.command_prefix).where(data.Server.id == server_id))
+                ).scalar_one_or_none()
+            prefixes = tuple(command_prefix.split('|')) if command_prefix else ()
+            await write_prefixes(server_id, prefixes)
+        # setdefault, as the prefixes may have been set in the meantime
+        self.prefixes.setdefault(server_id, prefixes)
+
+    def _compile_prefix_matchers(self, server_id: Optional[int]) -> Tuple[PrefixMatcher, PrefixMatcher]:
+        """Compile the server's matchers: regular, and including the default prefix for prefix-safe commands."""
+        default_prefixes = (configuration['command_prefix'] + ' ', configuration['command_prefix'])
+        if server_id is not None:
+            if server_id not in AI_ALLOWED_SERVER_IDS:
+                prefixes = [f'<@!{self.user.id}> ', f'<@{self.user.id}> ', f'{self.user} ']
             else:
                 prefixes = []
-            for extra_prefix in self.prefixes.get(message.guild.id) or (configuration['command_prefix'],):
+            for extra_prefix in self.prefixes.get(server_id) or (configuration['command_prefix'],):
                 prefixes.append(extra_prefix + ' ')
                 prefixes.append(extra_prefix)
         else:
-            prefixes.append(configuration['command_prefix'] + ' ')
-            prefixes.append(configuration['command_prefix'])
-            prefixes.append('')
-        if (
-            message.content.lower().startswith(self.prefix_safe_aliases)
-            and configuration['command_prefix'] not in prefixes
-        ):
-            prefixes.append(configuration['command_prefix'] + ' ')
-            prefixes.append(configuration['command_prefix'])
-        prefixes.sort(key=len, reverse=True)
-        return prefixes
+            prefixes = [*default_prefixes, '']
+        matchers = (PrefixMatcher(prefixes), PrefixMatcher((*prefixes, *default_prefixes)))
+        self.prefix_matchers[server_id] = matchers
+        return matchers
+
+    async def _get_prefix(self, bot: commands.Bot, message: discord.Message) -> List[str]:
+        server_id = message.guild.id if message.guild is not None else None
+        matchers = self.prefix_matchers.get(server_id)
+        if matchers is None:
+            if server_id is not None and server_id not in self.prefixes:
+                await self._load_prefixes(server_id)
+            matchers = self._compile_prefix_matchers(server_id)
+        is_prefix_safe = self.prefix_safe_alias_regex.match(message.content) is not None
+        return matchers[is_prefix_safe].match(message.content)
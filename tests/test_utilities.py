@@ -14,12 +14,15 @@
 import datetime as dt
 import unittest
 
+import discord
+
 from utilities import (
     first_url,
     human_amount_of_time,
     human_datetime,
     interpret_str_as_datetime,
     localize,
+    pack_greedily,
     text_snippet,
     with_preposition_form,
     word_number_form,
@@ -413,5 +416,70 @@ class TestInterpretStrAsDatetime(unittest.TestCase):
         self.assertEqual(intepreted_datetime, expected_datetime)
 
 
+class TestPackGreedily(unittest.TestCase):
+    MAX_EMBEDS = 10
+    MAX_EMBED_CHARACTERS = 6000
+
+    def pack_embeds(self, embeds):
+        return pack_greedily(embeds, max_count=self.MAX_EMBEDS, max_size=self.MAX_EMBED_CHARACTERS)
+
+    def test_nothing(self):
+        self.assertEqual(self.pack_embeds([]), [])
+
+    def test_single_embed(self):
+        embed = discord.Embed(title='Tytuł')
+        self.assertEqual(self.pack_embeds([embed]), [[embed]])
+
+    def test_embed_size_counts_all_text(self):
+        embed = discord.Embed(title='a' * 100, description='b' * 200)
+        embed.add_field(name='c' * 10, value='d' * 20)
+        embed.add_field(name='e' * 30, value='f' * 40)
+        embed.set_footer(text='g' * 50)
+        embed.set_author(name='h' * 60)
+        self.assertEqual(len(embed), 510)
+
+    def test_count_limit(self):
+        embeds = [discord.Embed(title='x') for _ in range(25)]
+        packs = self.pack_embeds(embeds)
+        self.assertEqual([len(pack) for pack in packs], [10, 10, 5])
+        self.assertEqual([embed for pack in packs for embed in pack], embeds)
+
+    def test_size_limit_exactly_reached(self):
+        embeds = [discord.Embed(description='x' * 2000) for _ in range(4)]
+        self.assertEqual([len(pack) for pack in self.pack_embeds(embeds)], [3, 1])
+
+    def test_size_limit_exceeded_by_one(self):
+        embeds = [discord.Embed(description='x' * 3000), discord.Embed(description='x' * 3001)]
+        self.assertEqual([len(pack) for pack in self.pack_embeds(embeds)], [1, 1])
+
+    def test_size_limit_counts_fields(self):
+        embeds = []
+        for _ in range(3):
+            embed = discord.Embed(title='x' * 56)
+            for _ in range(25):
+                embed.add_field(name='y' * 40, value='z' * 40)
+            embeds.append(embed)  # 56 + 25 * 80 = 2056 characters
+        self.assertEqual([len(pack) for pack in self.pack_embeds(embeds)], [2, 1])
+
+    def test_oversized_embed_gets_own_pack(self):
+        small_embed = discord.Embed(title='x')
+        oversized_embed = discord.Embed(description='x' * 4096)
+        oversized_embed.add_field(name='y', value='y' * 1024)
+        oversized_embed.add_field(name='z', value='z' * 1024)
+        self.assertEqual(
+            self.pack_embeds([small_embed, oversized_embed, small_embed]),
+            [[small_embed], [oversized_embed], [small_embed]],
+        )
+
+    def test_order_preserved(self):
+        sizes = [3000, 100, 2950, 2000, 10, 6000, 1]
+        embeds = [discord.Embed(description='x' * size) for size in sizes]
+        packs = self.pack_embeds(embeds)
+        self.assertEqual([embed for pack in packs for embed in pack], embeds)
+        self.assertEqual(
+            [[len(embed) for embed in pack] for pack in packs], [[3000, 100], [2950, 2000, 10], [6000], [1]]
+        )
+
+
 if __name__ == '__main__':
     unittest.main()
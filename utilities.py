@@ -13,16 +13,61 @@
 
 import calendar
 import datetime as dt
+import functools
+import importlib
 import locale
 from math import ceil
 import os
 import re
 from dataclasses import dataclass
 from numbers import Number
-from typing import Optional, Sequence, Tuple, Union
+from types import ModuleType
+from typing import Any, Callable, Iterable, List, Optional, Sequence, Tuple, TypeVar, Union
 
-import numpy as np
-from googleapiclient.discovery import build
+
+class LazyModule:
+    """Stand-in for a heavy module, which gets imported on first attribute access instead of at startup.
+
+    All lazy modules are also imported by `warm_up` in the background after the bot is ready, so that usually not even
+    the first use pays for the import. `on_load` is called with the module right after it's imported.
+    """
+
+    instances: List['LazyModule'] = []
+
+    def __init__(self, name: str, *, on_load: Optional[Callable[[ModuleType], Any]] = None):
+        self._name = name
+        self._on_load = on_load
+        self._module: Optional[ModuleType] = None
+        self.instances.append(self)
+
+    def load(self) -> ModuleType:
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._on_load is not None:
+                self._on_load(module)
+            self._module = module
+        return self._module
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.load(), name)
+
+    def __repr__(self) -> str:
+        return f'<LazyModule {self._name}{" (loaded)" if self._module is not None else ""}>'
+
+
+warm_ups: List[Callable[[], Any]] = []
+
+
+def warm_up(function: Callable[[], Any]) -> Callable[[], Any]:
+    """Decorator registering a (blocking) function to be run in the background warm-up after the bot is ready."""
+    warm_ups.append(function)
+    return function
+
+
+T = TypeVar('T')
+
+np = LazyModule('numpy')
+googleapiclient_discovery = LazyModule('googleapiclient.discovery')
 
 AI_ALLOWED_SERVER_IDS = [276488080914120704, 294182757209473024, 479458694354960385, 682561082719731742]
 
@@ -77,8 +122,13 @@ class GoogleClient:
         type: Optional[str]
 
     def __init__(self, developer_key: str, custom_search_engine_id: str):
+        self.developer_key = developer_key
         self.custom_search_engine_id = custom_search_engine_id
-        self.search_client = build('customsearch', 'v1', developerKey=developer_key).cse()
+        warm_up(lambda: self.search_client)
+
+    @functools.cached_property
+    def search_client(self):
+        return googleapiclient_discovery.build('customsearch', 'v1', developerKey=self.developer_key).cse()
 
     def search(
         self, query: str, *, language: str = 'pl', safe: str = 'active', search_type: str = None
@@ -141,7 +191,12 @@ class YouTubeClient:
         thumbnail_url: str
 
     def __init__(self, developer_key: str):
-        self.search_client = build('youtube', 'v3', developerKey=developer_key).search()
+        self.developer_key = developer_key
+        warm_up(lambda: self.search_client)
+
+    @functools.cached_property
+    def search_client(self):
+        return googleapiclient_discovery.build('youtube', 'v3', developerKey=self.developer_key).search()
 
     def search(self, query: str) -> Optional[YouTubeResult]:
         list_query = self.search_client.list(q=query, part='snippet', maxResults=1, type='video')
@@ -195,6 +250,23 @@ def text_snippet(text: str, limit: int) -> str:
     return '…'
 
 
+def pack_greedily(
+    items: Iterable[T], *, max_count: int, max_size: int, size: Callable[[T], int] = len
+) -> List[List[T]]:
+    """Split items, in order, into as few packs as possible, with each pack holding at most `max_count` items of total
+    `size` at most `max_size`. An item bigger than `max_size` on its own gets a pack of its own."""
+    packs: List[List[T]] = []
+    pack_size = 0
+    for item in items:
+        item_size = size(item)
+        if not packs or len(packs[-1]) >= max_count or pack_size + item_size > max_size:
+            packs.append([])
+            pack_size = 0
+        packs[-1].append(item)
+        pack_size += item_size
+    return packs
+
+
 def with_preposition_form(number: Union[int, float]) -> str:
     """Return the gramatically correct form of the "with" preposition in Polish."""
     while number > 1000:
@@ -426,7 +498,7 @@ def md_link(text: str, url: Optional[str], *, unroll=True) -> str:
     return f'[{text}]({url})' if url else text
 
 
-def rolling_average(data: Sequence[Number], roll: int, pad_mode: str = 'constant') -> np.ndarray:
+def rolling_average(data: Sequence[Number], roll: int, pad_mode: str = 'constant') -> 'np.ndarray':
     data_np = np.pad(data, roll // 2, pad_mode)
     data_np = np.cumsum(data_np)
     data_np[roll:] = data_np[roll:] - data_np[:-roll]
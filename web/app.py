@@ -1,13 +1,14 @@
 import calendar
 import datetime as dt
+import json
 import locale
 import os
 import random
-from typing import Optional
+from typing import Dict, Optional
 
 import markdown
 import redis
-from flask import Flask, render_template
+from flask import Flask, Response, render_template
 
 EMOJIS = [
     '🐜',
@@ -102,10 +103,19 @@ EMOJIS = [
 locale.setlocale(locale.LC_ALL, os.getenv('LC_ALL'))
 calendar.setfirstweekday(calendar.MONDAY)
 
+STATUS_KEY = 'somsiad/status'
+COMMAND_LATENCY_KEY = 'somsiad/command_latency'  # Suffixed with /<worker ID>
+HEARTBEAT_MAX_AGE = dt.timedelta(seconds=15)
+
 redis_connection = redis.Redis.from_url(os.environ['REDIS_URL'])
 application = Flask(__name__)
 
 
+def read_status() -> Dict[bytes, bytes]:
+    """Read all bot status fields written by the bot's heartbeat in a single round trip."""
+    return redis_connection.hgetall(STATUS_KEY)
+
+
 @application.errorhandler(404)
 def page_not_found(e):
     return render_template('404.html'), 404
@@ -113,20 +123,24 @@ def page_not_found(e):
 
 @application.route('/')
 def index():
-    heartbeat_raw = redis_connection.get('somsiad/heartbeat')
+    status = read_status()
+
+    heartbeat_raw = status.get(b'heartbeat')
     heartbeat: Optional[dt.datetime] = (
         dt.datetime.fromisoformat(heartbeat_raw.decode('utf-8')) if heartbeat_raw else None
     )
+    if heartbeat is not None and dt.datetime.now(dt.timezone.utc) - heartbeat > HEARTBEAT_MAX_AGE:
+        heartbeat = None
 
-    server_count_raw = redis_connection.get('somsiad/server_count')
+    server_count_raw = status.get(b'server_count')
     server_count: Optional[int] = int(server_count_raw.decode('utf-8')) if server_count_raw else None
     server_count_display: str = f'{server_count:n}' if server_count else 'Ileś'
 
-    user_count_raw = redis_connection.get('somsiad/user_count')
+    user_count_raw = status.get(b'user_count')
     user_count: Optional[int] = int(user_count_raw.decode('utf-8')) if user_count_raw else None
     user_count_display: str = f'{user_count:n}' if user_count else 'Ileś'
 
-    version_raw = redis_connection.get('somsiad/version')
+    version_raw = status.get(b'version')
     version: str = version_raw.decode('utf-8') if version_raw else '0.0.0'
 
     emoji: str = random.choice(EMOJIS)
@@ -157,3 +171,31 @@ def terms_of_service():
         title="Somsiad / Warunki świadczenia usługi",
         content=markdown.markdown(open('documents/warunki-swiadczenia-uslugi.md').read()),
     )
+
+
+@application.route('/metrics')
+def metrics():
+    """Expose command latency percentiles exported by the bot, in Prometheus text format."""
+    lines = [
+        '# HELP somsiad_command_latency_seconds Command latency by phase since bot startup.',
+        '# TYPE somsiad_command_latency_seconds summary',
+    ]
+    worker_count_raw = redis_connection.hget(STATUS_KEY, 'worker_count')
+    worker_count = int(worker_count_raw) if worker_count_raw else 1
+    pipeline = redis_connection.pipeline(transaction=False)
+    for worker_id in range(worker_count):
+        pipeline.hgetall(f'{COMMAND_LATENCY_KEY}/{worker_id}')
+    for worker_id, worker_latencies in enumerate(pipeline.execute()):
+        for command_name_raw, phases_raw in sorted(worker_latencies.items()):
+            command_name = command_name_raw.decode('utf-8').replace('\\', '\\\\').replace('"', '\\"')
+            for phase, stats in json.loads(phases_raw).items():
+                labels = f'command="{command_name}",phase="{phase}",worker="{worker_id}"'
+                for quantile in ('0.5', '0.95', '0.99'):
+                    value = stats[f'p{round(float(quantile) * 100)}']
+                    lines.append(
+                        f'somsiad_command_latency_seconds{{{labels},quantile="{quantile}"}} '
+                        f'{"NaN" if value is None else value}'
+                    )
+                lines.append(f'somsiad_command_latency_seconds_sum{{{labels}}} {stats["sum"]}')
+                lines.append(f'somsiad_command_latency_seconds_count{{{labels}}} {stats["count"]}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')